@@ -99,6 +99,42 @@ def check_threshold(feature_name, raw_value, residue=False):
 
     return float(val)
 
+def get_feature_categories(update_features, coarse_grained=False):
+    """Feature categories (ProteinFeaturizer methods) that must be rerun to
+    update the given categories or feature names, with all of the columns
+    each category writes"""
+    by_category = residue_features_by_category if coarse_grained else \
+        atom_features_by_category
+    return OrderedDict([(feat_type, feat_names) for feat_type, feat_names in \
+        by_category.items() if feat_type in update_features or \
+        any(feat_name in update_features for feat_name in feat_names)])
+
+#Categories that read the stored columns of other categories instead of
+#calculating them
+feature_dependencies = {
+    "get_deepsite_features": ["get_charge_and_electrostatics",
+                              "get_evolutionary_conservation_score"]
+}
+
+def get_feature_columns(update_features, coarse_grained=False):
+    """Columns recalculated to update the given categories or feature names:
+    every column of a requested category, otherwise only the requested
+    feature names"""
+    return [feat_name for feat_type, feat_names in get_feature_categories(
+        update_features, coarse_grained=coarse_grained).items() \
+        for feat_name in feat_names if feat_type in update_features or \
+        feat_name in update_features]
+
+def get_feature_dependencies(update_features, coarse_grained=False):
+    """Columns read but not recalculated when updating the given categories
+    or feature names. They must be loaded from the stored features first"""
+    by_category = residue_features_by_category if coarse_grained else \
+        atom_features_by_category
+    columns = get_feature_columns(update_features, coarse_grained=coarse_grained)
+    return [feat_name for feat_type in get_feature_categories(update_features,
+        coarse_grained=coarse_grained) for dep_type in feature_dependencies.get(feat_type, []) \
+        for feat_name in by_category.get(dep_type, []) if feat_name not in columns]
+
 non_geom_features_names = ["get_atom_type", "get_charge_and_electrostatics",
     "get_charge_and_electrostatics", "get_hydrophobicity", "get_residue",
     "get_deepsite_features", "get_evolutionary_conservation_score"]
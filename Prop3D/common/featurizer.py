@@ -14,6 +14,7 @@ from toil.realtimeLogger import RealtimeLogger
 from Prop3D.util.pdb import InvalidPDB
 from Prop3D.util import natural_keys, silence_stdout, silence_stderr
 from Prop3D.util.iostore import IOStore
+from Prop3D.util.stages import stage
 from Prop3D.parsers import mgltools
 from Prop3D.parsers.FreeSASA import run_freesasa_biopython
 from Prop3D.parsers.Electrostatics import APBS, Pdb2pqr
@@ -29,7 +30,8 @@ from Prop3D.common.features import atom_features, residue_features, \
 
 class ProteinFeaturizer(Structure):
     def __init__(self, path, cath_domain, job, work_dir,
-      input_format="pdb", force_feature_calculation=False, update_features=None, features_path=None, **kwds):
+      input_format="pdb", force_feature_calculation=False, update_features=None, features_path=None,
+      chain_features=None, **kwds):
         feature_mode = "w+" if force_feature_calculation else "r"
         if features_path is None: # and update_features is not None:
             features_path = work_dir
@@ -44,6 +46,18 @@ class ProteinFeaturizer(Structure):
         self.work_dir = work_dir
         self.update_features = update_features
 
+        if chain_features is not None:
+            self.use_chain_features(chain_features)
+
+    def use_chain_features(self, chain_file):
+        """Use DSSP, APBS and EPPIC results precomputed for the entire chain
+        (see generate_data.calculate_chain_features) instead of running the
+        tools for this domain. Only the residues in this domain are kept."""
+        from Prop3D.generate_data.calculate_chain_features import load_chain_features
+        residue_ids = [self._remove_inscodes(r).get_id() for r in self.structure.get_residues()]
+        self._dssp, self._pqr, self._eppic = load_chain_features(chain_file,
+            residue_ids=residue_ids)
+
     def calculate_flat_features(self, coarse_grained=False, only_aa=False, only_atom=False,
       non_geom_features=False, use_deepsite_features=False, write=True):
         if coarse_grained:
@@ -201,7 +215,8 @@ class ProteinFeaturizer(Structure):
 
         if not hasattr(self, "_autodock"):
             prep = mgltools.PrepareReceptor(job=self.job, work_dir=self.work_dir)
-            self._autodock = prep.get_autodock_atom_types(self.path)
+            with stage("autodock"):
+                self._autodock = prep.get_autodock_atom_types(self.path)
 
         try:
             atom_type, h_bond_donor = self._autodock[int(atom.serial_number)]
@@ -275,13 +290,14 @@ class ProteinFeaturizer(Structure):
         else:
             raise RuntimeError("Input must be Atom or Residue, not {}".format(atom_or_residue))
 
-        if self.update_features is not None:
-            if "electrostatic_potential" not in self.update_features and \
-              "is_electropositive" not in self.update_features and \
-              "is_electronegative" not in self.update_features:
-                 only_charge = True
-            if "get_charge_and_electrostatics" not in self.update_features:
+        if self.update_features is not None and \
+          "get_charge_and_electrostatics" not in self.update_features:
+            #Only run the tools for the requested features
+            feat_names = residue_features_by_category["get_charge_and_electrostatics"]
+            if not any(f in self.update_features for f in feat_names):
                 calculate = False
+            elif not any(f in self.update_features for f in feat_names[3:]):
+                only_charge = True
 
         atoms = pd.concat([self.get_charge_and_electrostatics_for_atom(
             self._remove_altloc(a)) for a in residue], axis=0)
@@ -317,13 +333,14 @@ class ProteinFeaturizer(Structure):
         if not isinstance(atom, PDB.Atom.Atom):
             raise RuntimeErorr("Input must be Atom")
 
-        if self.update_features is not None:
-            if "electrostatic_potential" not in self.update_features and \
-              "is_electropositive" not in self.update_features and \
-              "is_electronegative" not in self.update_features:
-                 only_charge = True
-            if "get_charge_and_electrostatics" not in self.update_features:
+        if self.update_features is not None and \
+          "get_charge_and_electrostatics" not in self.update_features:
+            #Only run the tools for the requested features
+            feat_names = atom_features_by_category["get_charge_and_electrostatics"]
+            if not any(f in self.update_features for f in feat_names):
                 calculate = False
+            elif not any(f in self.update_features for f in feat_names[3:]):
+                only_charge = True
 
         if not hasattr(self, "_pqr"):
             self._pqr = {}
@@ -331,10 +348,12 @@ class ProteinFeaturizer(Structure):
             try:
                 if only_charge:
                     pdb2pqr = Pdb2pqr(work_dir=self.work_dir, job=self.job)
-                    self._pqr = pdb2pqr.get_charge_from_pdb_file(self.path, with_charge=False)
+                    with stage("pdb2pqr"):
+                        self._pqr = pdb2pqr.get_charge_from_pdb_file(self.path, with_charge=False)
                 else:
                     apbs = APBS(work_dir=self.work_dir, job=self.job)
-                    self._pqr = apbs.get_atom_potentials_from_pdb(self.path)
+                    with stage("apbs"):
+                        self._pqr = apbs.get_atom_potentials_from_pdb(self.path)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except Exception as e:
@@ -351,6 +370,9 @@ class ProteinFeaturizer(Structure):
         if calculate:
             if only_charge:
                 charge_value = self._pqr.get(atom_id, np.nan)
+                if isinstance(charge_value, tuple):
+                    #Precomputed chain features store charge and potential
+                    charge_value = charge_value[0]
                 electrostatic_pot_value = np.nan
             else:
                 try:
@@ -413,7 +435,8 @@ class ProteinFeaturizer(Structure):
 
         if not hasattr(self, "_cx"):
             cx = CX(work_dir=self.work_dir, job=self.job)
-            self._cx = cx.get_concavity(self.path)
+            with stage("cx"):
+                self._cx = cx.get_concavity(self.path)
 
         concavity_value = self._cx.get(atom.serial_number, np.NaN)
 
@@ -497,7 +520,8 @@ class ProteinFeaturizer(Structure):
             raise RuntimeErorr("Input must be Atom")
 
         if not hasattr(self, "_sasa"):
-            self._sasa = run_freesasa_biopython(self.path)
+            with stage("freesasa"):
+                self._sasa = run_freesasa_biopython(self.path)
 
         sasa, sasa_struct = self._sasa
 
@@ -539,7 +563,8 @@ class ProteinFeaturizer(Structure):
 
         if not hasattr(self, "_dssp"):
             dssp = DSSP(work_dir=self.work_dir, job=self.job)
-            self._dssp = dssp.get_dssp(self.structure, self.path)
+            with stage("dssp"):
+                self._dssp = dssp.get_dssp(self.structure, self.path)
 
         residue_key = [residue.parent.get_id(), residue.get_id()] #[self.chain, residue.get_id()]
         try:
@@ -623,7 +648,8 @@ class ProteinFeaturizer(Structure):
 
         if not hasattr(self, "_dssp"):
             dssp = DSSP(work_dir=self.work_dir, job=self.job)
-            self._dssp = dssp.get_dssp(self.structure, self.path)
+            with stage("dssp"):
+                self._dssp = dssp.get_dssp(self.structure, self.path)
 
         try:
             atom_ss = self._dssp[residue.get_full_id()[2:]][2]
@@ -679,7 +705,8 @@ class ProteinFeaturizer(Structure):
 
         if not hasattr(self, "_autodock"):
             prep = mgltools.PrepareReceptor(job=self.job, work_dir=self.work_dir)
-            self._autodock = prep.get_autodock_atom_types(self.path, verify=True)
+            with stage("autodock"):
+                self._autodock = prep.get_autodock_atom_types(self.path, verify=True)
 
         try:
             atom_type, h_bond_donor = self._autodock[atom.serial_number]
@@ -732,9 +759,9 @@ class ProteinFeaturizer(Structure):
         idx = residue.get_id()
 
         if self.update_features is not None and \
-          ("get_evolutionary_conservation_score" not in self.update_features or \
-          "is_conserved" not in self.update_features or \
-          "eppic_entropy" not in self.update_features):
+          "get_evolutionary_conservation_score" not in self.update_features and \
+          "is_conserved" not in self.update_features and \
+          "eppic_entropy" not in self.update_features:
             #No need to update
             return self.atom_features.loc[atom.serial_number, cols] if use_atom else \
                 self.residue_features.loc[idx, cols]
@@ -746,13 +773,15 @@ class ProteinFeaturizer(Structure):
             try:
                 eppic_api = EPPICApi(self.pdb[:4], eppic_store, pdbe_store,
                     use_representative_chains=False, work_dir=self.work_dir)
-                self._eppic = eppic_api.get_entropy_scores(self.chain)
+                with stage("eppic"):
+                    self._eppic = eppic_api.get_entropy_scores(self.chain)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except:
                 if run_eppic_for_domain_on_failure:
                     eppic_local = EPPICLocal(work_dir=self.work_dir, job=self.job)
-                    self._eppic = eppic_local.get_entropy_scores(self.path)
+                    with stage("eppic_local"):
+                        self._eppic = eppic_local.get_entropy_scores(self.path)
                 else:
                     self._eppic = {}
 
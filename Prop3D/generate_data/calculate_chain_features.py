@@ -0,0 +1,215 @@
+import os
+import traceback
+from collections import defaultdict
+
+import pandas as pd
+from Bio.PDB import PDBParser
+from botocore.exceptions import ClientError
+
+from toil.realtimeLogger import RealtimeLogger
+
+from Prop3D.util import safe_remove
+from Prop3D.util.pdb import s3_download_pdb
+from Prop3D.util.toil import map_job
+from Prop3D.parsers.dssp import DSSP
+from Prop3D.parsers.Electrostatics import APBS
+from Prop3D.parsers.eppic import EPPICApi
+
+from Prop3D.generate_data.prepare_protein import extract_domain, prepare_domain
+from Prop3D.generate_data import data_stores
+
+DSSP_COLUMNS = ["index", "aa", "ss", "rasa", "phi", "psi"]
+
+def get_chain_key(cath_domain):
+    """Chain level key for a CATH domain (or pdb+chain), e.g. 1abcA01 -> 1abc/A"""
+    return "{}/{}".format(cath_domain[:4].lower(), cath_domain[4])
+
+def group_domains_by_chain(cath_domains):
+    """Group CATH domains that share the same PDB chain"""
+    chains = defaultdict(list)
+    for cath_domain in cath_domains:
+        chains[get_chain_key(cath_domain)].append(cath_domain)
+    return chains
+
+def chain_features_exist(chain_key, store=None):
+    if store is None:
+        store = data_stores.chain_features
+    return store.exists(chain_key+".h5")
+
+def _residue_columns(residue_ids):
+    het, resi, ins = zip(*residue_ids) if len(residue_ids)>0 else ([], [], [])
+    return {"HET_FLAG":list(het), "resi":list(resi), "ins":list(ins)}
+
+def dssp_to_df(dssp):
+    keys = list(dssp.keys())
+    values = [dssp[k][:len(DSSP_COLUMNS)] for k in keys]
+    df = pd.DataFrame(values, columns=DSSP_COLUMNS)
+    df = df.assign(chain=[k[0] for k in keys], **_residue_columns([k[1] for k in keys]))
+    df["aa"] = df["aa"].astype(str)
+    df["ss"] = df["ss"].astype(str)
+    return df
+
+def pqr_to_df(pqr):
+    keys = list(pqr.keys())
+    charge, potential = zip(*pqr.values()) if len(keys)>0 else ([], [])
+    return pd.DataFrame({
+        **_residue_columns([k[0] for k in keys]),
+        "atom_name":[k[1][0] for k in keys],
+        "charge":list(charge),
+        "electrostatic_potential":list(potential)})
+
+def eppic_to_df(entropy_scores):
+    return pd.DataFrame({
+        "pdbResidueNumber":list(map(str, entropy_scores.keys())),
+        "entropyScore":list(entropy_scores.values())})
+
+def calculate_chain_features(job, chain_key, work_dir=None, force=False, store=None):
+    """Run the expensive, per-chain tools (DSSP, APBS and EPPIC entropy) once for
+    an entire PDB chain and save the per-residue and per-atom results into
+    the chain feature store as '{pdb}/{chain}.h5'. Every CATH domain on
+    this chain can then slice its residues out of the results instead of
+    re-running the tools (see ProteinFeaturizer(chain_features=...))
+
+    Parameters
+    ----------
+    chain_key : str
+        Chain to run in the form '{pdb}/{chain}', see get_chain_key
+    force : bool
+        Recalculate even if chain features already exist
+
+    Returns
+    -------
+    The chain_key
+    """
+    if work_dir is None:
+        if job is not None and hasattr(job, "fileStore"):
+            work_dir = job.fileStore.getLocalTempDir()
+        else:
+            work_dir = os.getcwd()
+
+    if store is None:
+        store = data_stores.chain_features
+
+    if not force and chain_features_exist(chain_key, store=store):
+        RealtimeLogger.info("Chain features already exist for {}".format(chain_key))
+        return chain_key
+
+    pdb, chain = chain_key.split("/")
+    name = "{}{}".format(pdb, chain)
+
+    files_to_remove = []
+
+    #Clean and prepare full chain the same way as a domain, but without slicing
+    pdb_file, _, _ = s3_download_pdb(pdb, work_dir=work_dir)
+    files_to_remove.append(pdb_file)
+    chain_file, _ = extract_domain(pdb_file, name, None, chain=chain, work_dir=work_dir)
+    files_to_remove.append(chain_file)
+    prepared_file, _ = prepare_domain(chain_file, chain, name, work_dir=work_dir, job=job)
+    files_to_remove.append(prepared_file)
+
+    structure = PDBParser(QUIET=True).get_structure(name, prepared_file)
+
+    chain_file = os.path.join(work_dir, "{}.h5".format(name))
+    files_to_remove.append(chain_file)
+
+    dssp = DSSP(work_dir=work_dir, job=job).get_dssp(structure, prepared_file)
+    dssp_to_df(dssp).to_hdf(chain_file, "dssp", format="table", complevel=9, complib="bzip2")
+
+    pqr = APBS(work_dir=work_dir, job=job).get_atom_potentials_from_pdb(prepared_file)
+    pqr_to_df(pqr).to_hdf(chain_file, "pqr", format="table", complevel=9, complib="bzip2")
+
+    try:
+        eppic_api = EPPICApi(pdb, data_stores.eppic_store, data_stores.pdbe_store,
+            use_representative_chains=False, work_dir=work_dir)
+        entropy_scores = eppic_api.get_entropy_scores(chain)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        RealtimeLogger.info("EPPIC failed for chain {}: {}".format(chain_key,
+            traceback.format_exc()))
+        entropy_scores = {}
+    eppic_to_df(entropy_scores).to_hdf(chain_file, "eppic", format="table",
+        complevel=9, complib="bzip2")
+
+    store.write_output_file(chain_file, chain_key+".h5")
+
+    safe_remove(files_to_remove)
+
+    RealtimeLogger.info("Finished chain features for {}".format(chain_key))
+
+    return chain_key
+
+def safe_calculate_chain_features(job, chain_key, *args, **kwds):
+    """Chain features are optional; domains fall back to running the tools
+    themselves if the chain could not be processed"""
+    try:
+        return calculate_chain_features(job, chain_key, *args, **kwds)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        RealtimeLogger.info("Failed calculating chain features for {}: {}".format(
+            chain_key, traceback.format_exc()))
+
+def precompute_chains(job, cath_domains, force=False):
+    """Spawn one chain feature job per unique PDB chain in cath_domains"""
+    chains = [c for c in group_domains_by_chain(cath_domains).keys() if \
+        force or not chain_features_exist(c)]
+    RealtimeLogger.info("Precomputing features for {} chains from {} domains".format(
+        len(chains), len(cath_domains)))
+    if len(chains) > 0:
+        map_job(job, safe_calculate_chain_features, chains, force=force)
+
+def download_chain_features(cath_domain, work_dir=None, store=None):
+    """Download the chain features for the chain of a CATH domain. Returns None
+    if they have not been precomputed"""
+    if work_dir is None:
+        work_dir = os.getcwd()
+
+    if store is None:
+        store = data_stores.chain_features
+
+    chain_key = get_chain_key(cath_domain)
+    chain_file = os.path.join(work_dir, "{}.chain.h5".format(cath_domain[:5]))
+
+    try:
+        if not store.exists(chain_key+".h5"):
+            return None
+        store.read_input_file(chain_key+".h5", chain_file)
+    except (ClientError, RuntimeError):
+        return None
+
+    return chain_file
+
+def load_chain_features(chain_file, residue_ids=None):
+    """Read chain features back in the formats that ProteinFeaturizer uses
+    internally, only keeping the residues in residue_ids if given.
+
+    Returns
+    -------
+    dssp : dict
+        (chain, residue_id) -> (index, aa, ss, rasa, phi, psi), same as Bio.PDB.DSSP
+    pqr : dict
+        (residue_id, (atom_name, ' ')) -> (charge, electrostatic_potential)
+    eppic : dict
+        pdbResidueNumber -> entropyScore
+    """
+    res_cols = ["HET_FLAG", "resi", "ins"]
+
+    def select(df):
+        if residue_ids is None:
+            return df
+        keep = pd.MultiIndex.from_frame(df[res_cols]).isin(list(residue_ids))
+        return df[keep]
+
+    dssp_df = select(pd.read_hdf(chain_file, "dssp"))
+    dssp = {(row.chain, (row.HET_FLAG, int(row.resi), row.ins)):tuple(
+        getattr(row, c) for c in DSSP_COLUMNS) for row in dssp_df.itertuples()}
+
+    pqr_df = select(pd.read_hdf(chain_file, "pqr"))
+    pqr = {((row.HET_FLAG, int(row.resi), row.ins), (row.atom_name, " ")): \
+        (row.charge, row.electrostatic_potential) for row in pqr_df.itertuples()}
+
+    eppic_df = pd.read_hdf(chain_file, "eppic")
+    eppic = defaultdict(lambda: 1, zip(eppic_df.pdbResidueNumber, eppic_df.entropyScore))
+
+    return dssp, pqr, eppic
@@ -284,7 +284,7 @@ def cluster_binding_site_sequences_with_seqID(job, seqID, cathcode=None, work_di
 #     for distance in ["maxsub", "rmsd", "tm"]:
 #         job.addChildJobFn(distance, cathcode=cathcode, work_dir=work_dir, output_dir=output_dir)
 #
-def cluster_binding_site_structures(job, cathFileStoreID, cathcode=None, work_dir=None, output_dir="", cores=1, memory="1G"):
+def cluster_binding_site_structures(job, cathFileStoreID, cathcode=None, work_dir=None, output_dir="", incremental=False, recluster=False, threshold=0.5, cores=1, memory="1G"):
     #Run max cluster on all binding site structures
     #Save clusters
     if work_dir is None:
@@ -314,9 +314,10 @@ def cluster_binding_site_structures(job, cathFileStoreID, cathcode=None, work_di
     RealtimeLogger.info("RUNNING MaxCluster one_vs_all")
 
     run_cath_hierarchy(job, cathcode, cluster_binding_site_structures_in_superfamily,
-        cathFileStoreID, all_binding_sites, output_dir=output_dir)
+        cathFileStoreID, all_binding_sites, output_dir=output_dir, incremental=incremental,
+        recluster=recluster, threshold=threshold)
 
-def cluster_binding_site_structures_in_superfamily(job, cathcode, cathFileStoreID, file_list, work_dir=None, output_dir="", cores=20, memory="96G"):
+def cluster_binding_site_structures_in_superfamily(job, cathcode, cathFileStoreID, file_list, work_dir=None, output_dir="", incremental=False, recluster=False, threshold=0.5, cores=20, memory="96G"):
     if work_dir is None:
         work_dir = job.fileStore.getLocalTempDir()
 
@@ -327,6 +328,28 @@ def cluster_binding_site_structures_in_superfamily(job, cathcode, cathFileStoreI
         "binding_sites_3d", cathcode.replace(".", "/")))+"/"
     RealtimeLogger.info("PREFIX {}".format(cath_files_prefix))
 
+    if incremental:
+        #Only compare new binding sites to the centroids of the last run,
+        #threshold is 1-TM-score
+        sfam_files = [f for f in file_list if f.startswith(cath_files_prefix)]
+        if len(sfam_files) == 0:
+            return
+
+        clusters_prefix = "binding_sites_3d/clusters/{}".format(cathcode.replace(".", "/"))
+        state = mc.update_clusters(sfam_files, clusters_prefix, threshold=threshold,
+            distance="TM", recluster=recluster, n_jobs=cores)
+
+        RealtimeLogger.info("Binding sites in {}: {} structures, {} clusters, {} updates since full clustering".format(
+            cathcode, len(state.assignments), len(state.centroids), state.n_updates))
+
+        bs_cluster_file = os.path.join(work_dir, "binding_site_clusters.h5")
+        state.assignments.to_hdf(bs_cluster_file, "table", format="table",
+            complevel=9, complib="bzip2", min_itemsize=1024)
+        eppic_interfaces_store.write_output_file(bs_cluster_file,
+            "{}/binding_site_clusters.h5".format(clusters_prefix))
+        safe_remove(bs_cluster_file)
+        return
+
     cath_domain_files = [(i, domain_file) for i, domain_file in enumerate(file_list) \
         if domain_file.startswith(cath_files_prefix)][:1]
 
@@ -10,17 +10,22 @@ import glob
 
 import h5pyd
 import numpy as np
+import pandas as pd
 
 from Prop3D.common.featurizer import ProteinFeaturizer
+from Prop3D.common.features import get_feature_columns, get_feature_dependencies
 
 from Prop3D.util import safe_remove
 from Prop3D.util.iostore import IOStore
+from Prop3D.util.stages import stage, count
 from Prop3D.util.pdb import InvalidPDB, get_atom_lines
 from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks
 from Prop3D.util.toil import map_job
 from Prop3D.util.cath import run_cath_hierarchy, download_cath_domain
 
 from Prop3D.generate_data import data_stores
+from Prop3D.generate_data.calculate_chain_features import download_chain_features
+from Prop3D.generate_data.completion import mark_completed
 
 from toil.realtimeLogger import RealtimeLogger
 from botocore.exceptions import ClientError
@@ -50,7 +55,8 @@ class CalculateFeaturesError(RuntimeError):
             f"errors/{self.jobStoreName}/{os.path.basename(fail_file)}")
         safe_remove(fail_file)
 
-def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features=None, domain_file=None, work_dir=None):
+def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features=None, domain_file=None, work_dir=None,
+  use_chain_features=False):
     if work_dir is None:
         if job is not None and hasattr(job, "fileStore"):
             work_dir = job.fileStore.getLocalTempDir()
@@ -71,42 +77,18 @@ def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features
 
 
     if update_features is not None:
-        if False:
-            #Download existing features from older method
-            fail = False
-            for ext in ("atom.h5", "residue.h5", "edges.txt.gz"):
-                try:
-                    data_stores.cath_features.read_input_file(
-                        "{}_{}".format(s3_cath_key, ext),
-                        os.path.join(work_dir, "{}_{}".format(cath_domain, ext)))
-                except ClientError:
-                    #Ignore, just recalculate
-                    update_features = None
-                    fail = True
-                    break
-            if fail:
-                RealtimeLogger.info("Failed to download old features")
-        else:
-            #Save features for cath domain in new seperate h5 files to be red in by the Featurizer
-            store = h5pyd.File(cath_full_h5, mode="r", use_cache=False)
+        #Only update columns in place if the domain already has feature tables,
+        #otherwise calculate everything
+        with h5pyd.File(cath_full_h5, mode="r", use_cache=False, retries=100) as store:
             try:
                 feat_files = list(store[cath_key].keys())
-                if len(feat_files) == 3 and "atom" in feat_files and \
-                  "residue" in feat_files and feat_files and "edges":
-                    for feature_type, index_col in (("atoms", "serial_number"), ("residues", "residue_id")):
-                        df = pd.DataFrame(store[f"{cath_key}/{feature_type}"]).set_index(index_col)
-                        feature_file = os.path.join(work_dir, f"{cath_domain}_{feature_type:-1]}.h5")
-                        df.to_hdf(feature_file, "table")
-                        del df
-                        to_remove.append(feature_file)
-                else:
+                if "atom" not in feat_files or "residue" not in feat_files:
                     update_features = None
             except KeyError:
-                feats_exist = False
-            finally:
-                store.close()
-
+                update_features = None
 
+        if update_features is None:
+            RealtimeLogger.info("No existing features for {}, calculating all features".format(cath_key))
 
     if s3_cath_key is not None:
         domain_file = os.path.join(work_dir, "{}.pdb".format(cath_domain))
@@ -123,21 +105,50 @@ def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features
         cath_domain = None
         output_name = cath_key
 
+    chain_file = None
+    if use_chain_features and cath_domain is not None:
+        #Slice DSSP, APBS and EPPIC results from precomputed chain, if available
+        chain_file = download_chain_features(cath_domain, work_dir=work_dir)
+        if chain_file is None:
+            RealtimeLogger.info("No chain features for {}, running tools for domain".format(cath_domain))
+        else:
+            to_remove.append(chain_file)
+
     try:
+        #Features are always calculated from scratch; when updating, only the
+        #requested categories are run and their columns written back
         structure = ProteinFeaturizer(
             domain_file, cath_domain, job, work_dir,
-            force_feature_calculation=update_features is None,
-            update_features=update_features)
+            force_feature_calculation=True,
+            update_features=update_features,
+            chain_features=chain_file)
     except:
         import traceback as tb
         RealtimeLogger.info(f"{tb.format_exc()}")
         raise
 
+    if update_features is not None:
+        if update_feature_columns(cath_full_h5, cath_key, structure, update_features):
+            RealtimeLogger.info("Finished updating features {} for: {} {}".format(
+                update_features, cathcode, output_name))
+            safe_remove(domain_file)
+            for f in to_remove:
+                safe_remove(f)
+            return
+
+        #Stored tables are for different atoms, rewrite them with all features
+        RealtimeLogger.info("Calculating all features for {}".format(cath_key))
+        structure = ProteinFeaturizer(
+            domain_file, cath_domain, job, work_dir,
+            force_feature_calculation=True,
+            chain_features=chain_file)
+
     for ext, calculate in (("atom", structure.calculate_flat_features),
                            ("residue", structure.calculate_flat_residue_features),
                            ("edges", partial(structure.calculate_graph, edgelist=True))):
         try:
-            out, _ = calculate(write=False)
+            with stage(f"{ext}_features"):
+                out, _ = calculate(write=False)
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception as e:
@@ -163,7 +174,8 @@ def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features
         column_dtypes = {col:special_col_types.get(col, '<f8') for col in df.columns}
         rec_arr = df.to_records(index=False, column_dtypes=column_dtypes)
 
-        with h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+        with stage(f"{ext}_hsds_write"), h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+            count("hsds_bytes", rec_arr.nbytes)
             if f"{cath_key}/{ext}" in store.keys():
                 try:
                     del store[f"{cath_key}/{ext}"]
@@ -178,15 +190,128 @@ def calculate_features(job, cath_full_h5, cath_domain, cathcode, update_features
                 RealtimeLogger.info(f"OLD DS is: {ds1}")
                 ds1[...] = rec_arr                     # assign new values to data
 
+            if cathcode is not None:
+                #Update completion index so schedulers do not have to list domain groups
+                mark_completed(store, cathcode, cath_domain, ext)
+
         RealtimeLogger.info("Finished {} features for: {} {}".format(ext, cathcode, output_name))
 
     RealtimeLogger.info("Finished features for: {} {}".format(cathcode, output_name))
 
     safe_remove(domain_file)
 
-    if update_features:
-        for f in to_remove:
-            safe_remove(f)
+    for f in to_remove:
+        safe_remove(f)
+
+def update_feature_columns(cath_full_h5, cath_key, structure, update_features):
+    """Recompute only the feature categories needed for update_features and
+    write the requested columns back into the existing atom and residue
+    tables. Columns the recomputed categories depend on are read from the
+    stored tables instead of being calculated again; all other columns are
+    left untouched.
+
+    Parameters
+    ----------
+    cath_full_h5 : str
+        Path to HSDS file
+    cath_key : str
+        Group of domain in HSDS file
+    structure : ProteinFeaturizer
+        Domain created with force_feature_calculation=True and update_features
+    update_features : list
+        Feature category names (e.g. get_ss) or feature names (e.g. is_helix)
+
+    Returns
+    -------
+    False if the atoms or residues of the domain no longer match the stored
+    tables and nothing was written, so all features must be recalculated.
+    True otherwise.
+    """
+    tables = []
+    with h5pyd.File(cath_full_h5, mode="r", use_cache=False, retries=100) as store:
+        for ext, coarse_grained, key_col in (("atom", False, "serial_number"), ("residue", True, "residue_id")):
+            columns = get_feature_columns(update_features, coarse_grained=coarse_grained)
+            if len(columns) == 0:
+                continue
+
+            features = structure.residue_features if coarse_grained else structure.atom_features
+            ds = store[f"{cath_key}/{ext}"]
+
+            #Position in the structure of each stored row
+            order = _row_order(_table_keys(ds[key_col]), _structure_keys(features, coarse_grained))
+            if len(order) != len(features) or (order < 0).any():
+                RealtimeLogger.info("Rows of {} do not match the structure, unable to update in place".format(
+                    f"{cath_key}/{ext}"))
+                return False
+
+            #Load stored columns that are read by the recomputed categories
+            for col in get_feature_dependencies(update_features, coarse_grained=coarse_grained):
+                if col in ds.dtype.names:
+                    values = np.full(len(features), np.nan)
+                    values[order] = np.asarray(ds[col], dtype=np.float64)
+                    features[col] = values
+
+            missing_columns = [col for col in columns if col not in ds.dtype.names]
+            tables.append((ext, coarse_grained, columns, order, missing_columns))
+
+    for ext, coarse_grained, columns, order, missing_columns in tables:
+        RealtimeLogger.info("Updating {} {} columns for {}: {}".format(len(columns), ext,
+            cath_key, columns))
+
+        with stage(f"{ext}_features"):
+            structure.calculate_flat_features(coarse_grained=coarse_grained, write=False)
+        features = structure.residue_features if coarse_grained else structure.atom_features
+        df = features.reindex(columns=columns).astype(np.float64).iloc[order]
+
+        with stage(f"{ext}_hsds_update"), h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+            if len(missing_columns) > 0:
+                #New feature columns, cannot update in place
+                RealtimeLogger.info("Adding columns {} to {}, rewriting table".format(
+                    missing_columns, f"{cath_key}/{ext}"))
+                _rewrite_table_columns(store, f"{cath_key}/{ext}", df)
+                continue
+
+            ds = store[f"{cath_key}/{ext}"]
+            for col in columns:
+                ds[col] = df[col].values
+            count("hsds_bytes", df.values.nbytes)
+
+    return True
+
+def _table_keys(values):
+    return [k.decode("utf-8").strip() if isinstance(k, bytes) else str(k).strip() for k in values]
+
+def _structure_keys(features, coarse_grained):
+    """Row keys of the atom or residue features as written by get_pdb_dataframe"""
+    if coarse_grained:
+        return ["".join(map(str, idx[1:])).strip() for idx in features.index]
+    return [str(idx).strip() for idx in features.index]
+
+def _row_order(stored_keys, keys):
+    """Position in keys of each stored key, -1 if missing. Repeated keys (e.g.
+    residue_id of a residue and a HETATM with the same number) are matched in
+    order of occurrence"""
+    stored_keys, keys = pd.Series(stored_keys, dtype=object), pd.Series(keys, dtype=object)
+    stored_keys = pd.MultiIndex.from_arrays([stored_keys.values,
+        stored_keys.groupby(stored_keys).cumcount().values])
+    keys = pd.MultiIndex.from_arrays([keys.values, keys.groupby(keys).cumcount().values])
+    return keys.get_indexer(stored_keys)
+
+def _rewrite_table_columns(store, table_key, new_columns):
+    """Fallback for update_feature_columns: replace or add the given columns,
+    already in the order of the stored rows, and rewrite the whole table"""
+    old_df = pd.DataFrame(store[table_key][...])
+    if len(old_df) != len(new_columns):
+        raise ValueError("Cannot update {}: table has {} rows, not {}".format(
+            table_key, len(old_df), len(new_columns)))
+
+    for col in new_columns.columns:
+        old_df[col] = new_columns[col].values
+
+    del store[table_key]
+    store.create_table(table_key, data=old_df.to_records(index=False),
+        chunks=True, compression="gzip", compression_opts=9)
+    count("hsds_bytes", old_df.values.nbytes)
 
 def calculate_features_for_sfam(job, sfam_id, update_features, further_parallelize=True, use_cath=True):
     work_dir = job.fileStore.getLocalTempDir()
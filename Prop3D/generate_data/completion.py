@@ -0,0 +1,324 @@
+"""Completion index for the CATH HSDS store.
+
+Each superfamily has a small 'completion' group with two datasets:
+'domains' (sorted domain names) and 'status' (one uint8 per domain with a bit
+set for each feature table that has been written: atom=1, residue=2, edges=4).
+The feature writer sets the bits of its own domain after each table is
+written, which is a single element write that never touches other domains.
+Schedulers read the state of an entire superfamily in two requests plus one
+listing of its domains, which is used to add domains that are missing from
+the index (update_completion_index). Existing bits are never reset.
+
+An index built for a store without one (e.g. the first run of the scheduler)
+does not check the feature tables of every domain, which would be one request
+per domain. Its zero bits mean unknown instead of not done: is_completed
+returns None for those domains, so each domain job checks its own group.
+"""
+import numpy as np
+import pandas as pd
+from toil.realtimeLogger import RealtimeLogger
+
+FEATURE_BITS = {"atom": 1, "residue": 2, "edges": 4}
+ALL_FEATURES = 7
+
+_domain_index_cache = {}
+
+def _sfam_key(superfamily):
+    return superfamily.replace(".", "/").strip("/")
+
+def _decode(domain):
+    return domain.decode("utf-8") if isinstance(domain, bytes) else domain
+
+def _status_from_groups(store, superfamily, cath_domains):
+    """Status of each domain from the feature tables in its group. Slow, one
+    request per domain, only used to build the index for an existing store"""
+    status = np.zeros(len(cath_domains), dtype=np.uint8)
+    for i, cath_domain in enumerate(cath_domains):
+        try:
+            feature_tables = store[f"{superfamily}/domains/{cath_domain}"].keys()
+        except KeyError:
+            continue
+        for ext, bit in FEATURE_BITS.items():
+            if ext in feature_tables:
+                status[i] |= bit
+    return status
+
+def create_completion_index(store, superfamily, cath_domains=None, from_groups=False,
+  checked=True):
+    """Create (or replace) the completion index of a superfamily. This resets
+    the bits of every domain, use update_completion_index to keep them
+
+    Parameters
+    ----------
+    store : h5pyd.File
+        Open CATH HSDS file in append mode
+    superfamily : str
+        Superfamily as 1/10/8/10 or 1.10.8.10
+    cath_domains : list or None
+        All domains in the superfamily. If None, list them from the store
+    from_groups : bool
+        Set the status of each domain from its existing feature tables instead
+        of starting with nothing completed. Use when adding an index to a store
+        that already has features.
+    checked : bool
+        If False (and not from_groups), a domain without bits may still have
+        its features, see is_completed
+    """
+    superfamily = _sfam_key(superfamily)
+
+    if cath_domains is None:
+        cath_domains = list(store[f"{superfamily}/domains"].keys())
+
+    cath_domains = sorted(set(cath_domains))
+
+    if from_groups:
+        status = _status_from_groups(store, superfamily, cath_domains)
+    else:
+        status = np.zeros(len(cath_domains), dtype=np.uint8)
+
+    group = store.require_group(f"{superfamily}/completion")
+    for name in ("domains", "status"):
+        if name in group.keys():
+            del group[name]
+
+    #Resizable so that new domains can be appended without rewriting the bits
+    name_size = max([16]+[len(d) for d in cath_domains])
+    group.create_dataset("domains", data=np.array(cath_domains, dtype="S{}".format(name_size)),
+        maxshape=(None,), chunks=True)
+    group.create_dataset("status", data=status, maxshape=(None,), chunks=True)
+    group.attrs["checked"] = bool(from_groups or checked)
+
+    _domain_index_cache.pop(superfamily, None)
+
+    return pd.Series(status, index=cath_domains, name="status")
+
+def _read_index(store, superfamily):
+    group = store[f"{superfamily}/completion"]
+    cath_domains = [_decode(d) for d in group["domains"][...]]
+    status = group["status"][...]
+    _domain_index_cache[superfamily] = {d:i for i, d in enumerate(cath_domains)}
+    return pd.Series(status, index=cath_domains, name="status")
+
+def _append_to_index(store, superfamily, cath_domains, status):
+    group = store[f"{superfamily}/completion"]
+    domains, status_dset = group["domains"], group["status"]
+    n = len(domains)
+    names = np.array(cath_domains, dtype=domains.dtype)
+    if max(len(d) for d in cath_domains) <= domains.dtype.itemsize:
+        try:
+            domains.resize((n+len(cath_domains),))
+            status_dset.resize((n+len(cath_domains),))
+            domains[n:] = names
+            status_dset[n:] = status
+            return
+        except (TypeError, ValueError):
+            pass
+
+    #Index created before it was resizable, bits set between the read and the
+    #rewrite are lost
+    old = _read_index(store, superfamily)
+    create_completion_index(store, superfamily, list(old.index)+list(cath_domains),
+        checked=bool(group.attrs.get("checked", True)))
+    rewritten = store[f"{superfamily}/completion/status"]
+    positions = {d: i for i, d in enumerate(_decode(d) for d in
+        store[f"{superfamily}/completion/domains"][...])}
+    all_status = np.zeros(len(positions), dtype=np.uint8)
+    for cath_domain, value in zip(list(old.index)+list(cath_domains),
+      list(old.values)+list(status)):
+        all_status[positions[cath_domain]] = value
+    rewritten[...] = all_status
+
+def update_completion_index(store, superfamily, cath_domains=None):
+    """Add the domains of a superfamily that are missing from its completion
+    index, with their status read from their groups, keeping the bits of the
+    others. Without an index, one is created with unknown status (see
+    is_completed)
+
+    Parameters
+    ----------
+    store : h5pyd.File
+        Open CATH HSDS file in append mode
+    superfamily : str
+        Superfamily as 1/10/8/10 or 1.10.8.10
+    cath_domains : list or None
+        All domains in the superfamily. If None, list them from the store
+
+    Returns
+    -------
+    pd.Series of the status of each domain in cath_domains
+    """
+    superfamily = _sfam_key(superfamily)
+
+    if cath_domains is None:
+        cath_domains = list(store[f"{superfamily}/domains"].keys())
+
+    try:
+        index = _read_index(store, superfamily)
+    except KeyError:
+        RealtimeLogger.info("Creating completion index for {}".format(superfamily))
+        return create_completion_index(store, superfamily, cath_domains, checked=False)
+
+    new_domains = sorted(set(cath_domains)-set(index.index))
+    if len(new_domains) > 0:
+        RealtimeLogger.info("Adding {} domains to completion index for {}".format(
+            len(new_domains), superfamily))
+        _append_to_index(store, superfamily, new_domains,
+            _status_from_groups(store, superfamily, new_domains))
+        index = _read_index(store, superfamily)
+
+    return index[index.index.isin(cath_domains)]
+
+def get_completion_index(store, superfamily, create=True):
+    """Status of every domain in a superfamily as a pd.Series of bit flags
+    indexed by domain name. When create is True, the index is first
+    reconciled with the domains in the store (update_completion_index),
+    otherwise it is read as is and None is returned if there is none"""
+    superfamily = _sfam_key(superfamily)
+    if create:
+        return update_completion_index(store, superfamily)
+
+    try:
+        return _read_index(store, superfamily)
+    except KeyError:
+        return None
+
+def list_superfamilies(store):
+    """Keys (e.g. 1/10/8/10) of every superfamily in the store, one listing
+    per group of the C, A and T levels"""
+    superfamilies = [""]
+    for _ in range(4):
+        superfamilies = ["{}/{}".format(parent, key).strip("/") for parent in superfamilies \
+            for key in (store[parent] if parent else store).keys() if key.isdigit()]
+    return superfamilies
+
+def get_domain_status(store, superfamilies, create=True):
+    """Completion status of every domain in the given superfamilies
+
+    Returns
+    -------
+    pd.DataFrame with columns cath_domain, cathcode and status
+    """
+    if isinstance(superfamilies, str):
+        superfamilies = [superfamilies]
+
+    domains = []
+    for superfamily in superfamilies:
+        index = get_completion_index(store, superfamily, create=create)
+        if index is None:
+            continue
+        domains.append(pd.DataFrame({
+            "cath_domain": index.index,
+            "cathcode": _sfam_key(superfamily),
+            "status": index.values}))
+
+    if len(domains) == 0:
+        return pd.DataFrame(columns=["cath_domain", "cathcode", "status"])
+
+    return pd.concat(domains, axis=0, ignore_index=True)
+
+def get_completed_domains(store, superfamilies, features=ALL_FEATURES, create=True):
+    """Domains that have all of the given feature bits set
+
+    Parameters
+    ----------
+    store : h5pyd.File
+    superfamilies : str or list of str
+    features : int or list of str
+        Bit mask or feature table names, default all three tables
+
+    Returns
+    -------
+    pd.DataFrame with columns cath_domain, cathcode and status
+    """
+    if not isinstance(features, int):
+        features = sum(FEATURE_BITS[ext] for ext in features)
+
+    domains = get_domain_status(store, superfamilies, create=create)
+    return domains[(domains["status"].astype(int) & features) == features].reset_index(drop=True)
+
+def _domain_position(store, superfamily, cath_domain):
+    """Position of a domain in the completion index. Cached positions are
+    checked against the stored name with a single element read, since the
+    index may have been rebuilt by another process"""
+    domains = store[f"{superfamily}/completion/domains"]
+    position = _domain_index_cache.get(superfamily, {}).get(cath_domain)
+    if position is not None and position < len(domains) and \
+      _decode(domains[position]) == cath_domain:
+        return position
+
+    _domain_index_cache[superfamily] = {_decode(d):i for i, d in enumerate(domains[...])}
+    return _domain_index_cache[superfamily].get(cath_domain)
+
+def mark_completed(store, superfamily, cath_domain, feature_type, completed=True):
+    """Set (or clear) the bit of one feature table for a domain. Domains are
+    only written by their own job, so reading and writing the one element
+    does not race with other domains. The index is never rebuilt here, since
+    a rebuild from one job would overwrite the bits other jobs are setting;
+    schedulers create it before starting the jobs of a superfamily.
+
+    Returns
+    -------
+    The new status of the domain or None if the superfamily has no index or
+    the domain is not in it
+    """
+    superfamily = _sfam_key(superfamily)
+    bit = FEATURE_BITS[feature_type]
+
+    try:
+        position = _domain_position(store, superfamily, cath_domain)
+    except KeyError:
+        RealtimeLogger.info("No completion index for {}, not marking {}".format(
+            superfamily, cath_domain))
+        return None
+
+    if position is None:
+        #Domain added after the index was created
+        RealtimeLogger.info("{} not in completion index for {}, add it with "
+            "update_completion_index".format(cath_domain, superfamily))
+        return None
+
+    status = store[f"{superfamily}/completion/status"]
+    value = int(status[position])
+    value = value | bit if completed else value & ~bit
+    status[position] = value
+
+    return value
+
+def is_completed(store, superfamily, cath_domain, features=ALL_FEATURES):
+    """Check one domain in the index. Returns None if it is not known: the
+    superfamily has no index, the domain is not in it, or the index was not
+    checked against the feature tables and the features are not all set.
+    Callers then check the domain group"""
+    superfamily = _sfam_key(superfamily)
+    try:
+        position = _domain_position(store, superfamily, cath_domain)
+        if position is None:
+            return None
+        value = int(store[f"{superfamily}/completion/status"][position])
+        if value & features == features:
+            return True
+        if not store[f"{superfamily}/completion"].attrs.get("checked", True):
+            return None
+    except KeyError:
+        return None
+    return False
+
+def check_completed(store, superfamily, cath_domain, features=ALL_FEATURES):
+    """is_completed, checking the feature tables in the domain group when the
+    index does not know. Tables found there are marked in the index. The
+    store must be open in append mode"""
+    completed = is_completed(store, superfamily, cath_domain, features=features)
+    if completed is not None:
+        return completed
+
+    try:
+        feature_tables = store[f"{_sfam_key(superfamily)}/domains/{cath_domain}"].keys()
+    except KeyError:
+        return False
+
+    status = 0
+    for ext, bit in FEATURE_BITS.items():
+        if ext in feature_tables:
+            mark_completed(store, superfamily, cath_domain, ext)
+            status |= bit
+    return status & features == features
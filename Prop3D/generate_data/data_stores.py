@@ -1,15 +1,24 @@
+import os
 from Prop3D.util.iostore import IOStore
 
-prepared_cath_structures = IOStore.get("aws:us-east-1:prepared-cath-structures")
-cath_api_service = IOStore.get("aws:us-east-1:cath-api-service")
+def _cached(store_string):
+    """Wrap stores that are read many times by every worker in a local
+    CachedIOStore if PROP3D_IOSTORE_CACHE is set"""
+    if "PROP3D_IOSTORE_CACHE" in os.environ:
+        return IOStore.get("cached:"+store_string)
+    return IOStore.get(store_string)
+
+prepared_cath_structures = _cached("aws:us-east-1:prepared-cath-structures")
+cath_api_service = _cached("aws:us-east-1:cath-api-service")
 cath_features = IOStore.get("aws:us-east-1:cath-features")
 data_eppic_cath_features = IOStore.get("aws:us-east-1:data-eppic-cath-features")
+chain_features = IOStore.get("aws:us-east-1:Prop3D-chain-features")
 
 eppic_interfaces = IOStore.get("aws:us-east-1:eppic-interfaces")
-eppic_store = IOStore.get("aws:us-east-1:Prop3D-eppic-service")
-pdbe_store = IOStore.get("aws:us-east-1:Prop3D-pdbe-service")
+eppic_store = _cached("aws:us-east-1:Prop3D-eppic-service")
+pdbe_store = _cached("aws:us-east-1:Prop3D-pdbe-service")
 eppic_local_store = IOStore.get("aws:us-east-1:Prop3D-eppic-local")
-raw_pdb_store = IOStore.get("aws:us-east-1:Prop3D-raw-pdb")
+raw_pdb_store = _cached("aws:us-east-1:Prop3D-raw-pdb")
 
 def eppic_interfaces_sync(output_dir=None):
     if output_dir is not None:
@@ -4,6 +4,8 @@ import logging
 import shutil
 import json
 import itertools as it
+import asyncio
+import uuid
 from multiprocessing.pool import ThreadPool
 from itertools import groupby
 
@@ -18,8 +20,9 @@ except ImportError:
 
 from Bio.PDB.Polypeptide import three_to_one
 
-from Prop3D.util.iostore import IOStore
+from Prop3D.util.iostore import IOStore, run_async
 from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks
+from Prop3D.util.intervals import interval_join, nearest_intervals
 from Prop3D.util import natural_keys, safe_remove
 from Prop3D.util.toil import map_job, map_job_rv, map_job_rv_list
 from Prop3D.util.cath import run_cath_hierarchy
@@ -115,11 +118,15 @@ def get_top_cath_domains_to_loop_contacts(df_):
     return contact_info
 
 class OutputWriter(object):
-    def __init__(self, work_dir, store):
+    def __init__(self, work_dir, store, batch=None):
         self.work_dir = work_dir
         self.store = store
+        self.batch = batch
 
     def write(self, df, output_type):
+        if self.batch is not None:
+            self.batch.add_output(df, output_type)
+            return
         self.write_pdb(df, output_type)
         self.write_cath(df, output_type)
 
@@ -161,9 +168,10 @@ class Status(object):
         "dli_residues": None
     }
 
-    def __init__(self, pdbId, store, work_dir=None, manual_status=False):
+    def __init__(self, pdbId, store, work_dir=None, manual_status=False, batch=None):
         self.pdbId = pdbId
         self.store = store
+        self.batch = batch
         self.exists = False
         self.work_dir = work_dir if work_dir is not None else os.getcwd()
 
@@ -192,6 +200,10 @@ class Status(object):
         return self.status.items()
 
     def write(self):
+        if self.batch is not None:
+            self.batch.add_status(self.pdbId, self.status)
+            return
+
         with open(self.path, "w") as fh:
             json.dump(self.status, fh)
 
@@ -213,16 +225,25 @@ class Status(object):
         self.exists = True
 
     def manual_status(self):
+        """Rebuild the status from the interface files in the store. All files
+        are listed and read concurrently with the async IOStore API"""
         pdb_key = "pdb/{}".format(self.pdbId)
-        for key in self.store.list_input_directory(pdb_key):
-            if "status" in key: continue
 
-            fname = os.path.splitext(key[len(pdb_key)+1:])[0]
-            intId, output_type = fname.split("_", 1)
+        async def read_all():
+            try:
+                keys = [key for key in await self.store.alist(pdb_key) if "status" not in key]
+                fnames = [os.path.join(self.work_dir, os.path.splitext(
+                    key[len(pdb_key)+1:])[0]) for key in keys]
+                await asyncio.gather(*[self.store.aread(key, fname) for key, fname \
+                    in zip(keys, fnames)])
+                return fnames
+            finally:
+                #The client belongs to this event loop, which ends with read_all
+                await self.store.aclose()
+
+        for fname in run_async(read_all()):
+            intId, output_type = os.path.basename(fname).split("_", 1)
 
-            fname = os.path.join(work_dir, fname)
-            self.store.read_input_file(key, fname)
-            pd.read_hdf(fname, "table")
             df = pd.HDFStore(fname)
             self[intId][output_type] = df.get_storer('table').nrows
             df.close()
@@ -276,18 +297,164 @@ class Status(object):
             return True
         return False
 
+class BatchWriter(object):
+    """Collect interactome outputs and status of many PDBs in memory and write
+    them to the store as one HDF file per flush (batch/<batch_id>.h5, a table
+    for each output type and one for the status of each interface). A one
+    row per PDB index is written next to it (index/<batch_id>.h5) so finished
+    PDBs can be found without reading the status of each PDB.
+
+    Outputs are also written per CATH domain, one file for all interfaces of
+    the domain in the flush (cath/<code>/<domain>_<batch_id>_<type>.h5), which
+    is what calculate_eppic_ddi lists and reads.
+
+    Outputs of a PDB are only kept once its status is added, so a PDB that
+    fails part way does not leave outputs without a status.
+    """
+    STATUS_COUNTS = list(Status.TEMPLATE.keys())
+
+    def __init__(self, store, work_dir=None, batch_id=None, flush_every=100):
+        self.store = store
+        self.work_dir = work_dir if work_dir is not None else os.getcwd()
+        self.batch_id = batch_id if batch_id is not None else uuid.uuid4().hex
+        self.flush_every = flush_every
+        self.n_flushes = 0
+        self.outputs = {}
+        self.pending = []
+        self.status = []
+        self.pdbs = []
+
+    def add_output(self, df, output_type):
+        self.pending.append((output_type, df))
+
+    def discard(self):
+        """Drop the outputs of the current PDB"""
+        self.pending = []
+
+    def add_status(self, pdbId, status):
+        for output_type, df in self.pending:
+            self.outputs.setdefault(output_type, []).append(df)
+        self.pending = []
+
+        for intId, int_status in status.items():
+            if isinstance(int_status, dict):
+                row = {k:int_status.get(k) for k in self.STATUS_COUNTS}
+                row.update({"pdb":pdbId, "interfaceId":str(intId),
+                    "error":str(int_status.get("error", ""))})
+                self.status.append(row)
+
+        self.pdbs.append({
+            "pdb": pdbId,
+            "numInterfaces": status.get("numInterfaces", 0),
+            "error": str(status.get("error", ""))})
+
+        if self.flush_every is not None and len(self.pdbs) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write all collected PDBs to the store"""
+        #Outputs without a status are from a PDB that did not finish
+        self.discard()
+
+        if len(self.pdbs) == 0:
+            return
+
+        key = "{}-{}".format(self.batch_id, self.n_flushes)
+        batch_file = os.path.join(self.work_dir, "batch-{}.h5".format(key))
+        index_file = os.path.join(self.work_dir, "index-{}.h5".format(key))
+
+        with pd.HDFStore(batch_file, "w", complevel=9, complib="bzip2") as store:
+            for output_type, dfs in self.outputs.items():
+                df = pd.concat(dfs, axis=0, ignore_index=True)
+                data_columns = [c for c in ("pdb", "firstCathCode", "firstCathDomain") \
+                    if c in df.columns]
+                store.append(output_type, df, format="table", data_columns=data_columns,
+                    min_itemsize=1024)
+            if len(self.status) > 0:
+                store.append("status", pd.DataFrame(self.status).astype(
+                    {k:float for k in self.STATUS_COUNTS}), format="table",
+                    data_columns=["pdb"], min_itemsize=256)
+        self.store.write_output_file(batch_file, "batch/{}.h5".format(key))
+
+        for output_type, dfs in self.outputs.items():
+            df = pd.concat(dfs, axis=0, ignore_index=True)
+            for (cathcode, cath_domain), cath_df in df.groupby(
+              ["firstCathCode", "firstCathDomain"], as_index=False):
+                cath_key = "cath/{}/{}_{}_{}.h5".format(cathcode.replace(".", "/"),
+                    cath_domain, key, output_type)
+                cath_file = os.path.join(self.work_dir, cath_key.replace("/", "_"))
+                cath_df.to_hdf(cath_file, key="table", format="table", complevel=9,
+                    complib="bzip2", min_itemsize=1024)
+                self.store.write_output_file(cath_file, cath_key)
+                safe_remove(cath_file)
+
+        #Index is written after the batch so every PDB in it has its outputs
+        index = pd.DataFrame(self.pdbs).assign(batch=key)
+        index.to_hdf(index_file, key="table", format="table", complevel=9,
+            complib="bzip2", min_itemsize=256)
+        self.store.write_output_file(index_file, "index/{}.h5".format(key))
+
+        RealtimeLogger.info("Wrote {} PDBs to batch {}".format(len(self.pdbs), key))
+
+        safe_remove([batch_file, index_file])
+        self.outputs = {}
+        self.status = []
+        self.pdbs = []
+        self.n_flushes += 1
+
+def _index_keys(store):
+    return ["index/{}".format(k) if not k.startswith("index/") else k for k in \
+        store.list_input_directory("index/") if k.endswith(".h5")]
+
+def get_completed_pdbs(store, work_dir=None):
+    """Index of all PDBs written by BatchWriter (pdb, numInterfaces, error and
+    batch), read from the consolidated index and any newer parts"""
+    work_dir = work_dir if work_dir is not None else os.getcwd()
+    index = []
+    for key in _index_keys(store):
+        index_file = os.path.join(work_dir, key.replace("/", "_"))
+        store.read_input_file(key, index_file)
+        index.append(pd.read_hdf(index_file, "table"))
+        safe_remove(index_file)
+
+    if len(index) == 0:
+        return pd.DataFrame(columns=["pdb", "numInterfaces", "error", "batch"])
+
+    return pd.concat(index, axis=0, ignore_index=True).drop_duplicates("pdb", keep="last")
+
+def consolidate_index(job=None, store=None):
+    """Merge all index parts into index/all.h5 so the next lookup is one read"""
+    if store is None:
+        store = data_stores.eppic_interfaces
+    work_dir = job.fileStore.getLocalTempDir() if job is not None else os.getcwd()
+    keys = _index_keys(store)
+    if len(keys) <= 1:
+        return
+
+    index = get_completed_pdbs(store, work_dir=work_dir)
+    index_file = os.path.join(work_dir, "index-all.h5")
+    index.to_hdf(index_file, key="table", format="table", complevel=9,
+        complib="bzip2", min_itemsize=256)
+    store.write_output_file(index_file, "index/all.h5")
+    safe_remove(index_file)
+
+    for key in keys:
+        if key != "index/all.h5":
+            store.remove_file(key)
+
 class EPPICInteractome(object):
     resSide = ["first", "second"]
 
-    def __init__(self, job, pdbId, cathFileStoreID, store, manual_status=True, work_dir=None):
+    def __init__(self, job, pdbId, cathFileStoreID, store, manual_status=True, work_dir=None,
+      batch=None):
         self.job = job
         self.pdbId = pdbId
         self.cathFileStoreID = cathFileStoreID
         self.manual_status = manual_status
         self.work_dir = work_dir if work_dir is not None else os.getcwd()
 
-        self.status = Status(pdbId, store, work_dir=work_dir)
-        self.writer = OutputWriter(work_dir, store)
+        self.status = Status(pdbId, store, work_dir=work_dir, batch=batch)
+        self.writer = OutputWriter(work_dir, store, batch=batch)
 
         self.skip_intIds = self.status.finished_interfaces()
 
@@ -370,6 +537,7 @@ class EPPICInteractome(object):
             return
 
         self.domain_domain_contacts = self.loop_loop_contacts = interfaceContacts
+        self.domain_loop_contacts = self.loop_domain_contacts = None
 
         for side, chain in interfaceResidues.groupby("side"):
             self.process_interface_side(intId, side, chain, chainLetts[side])
@@ -382,24 +550,24 @@ class EPPICInteractome(object):
 
     def process_interface_side(self, intId, side, chain, chainLett):
         chain_residues = chain.assign(pdb=self.pdbId.lower(), chain=chainLett)
-        self.cath_chain = self.cath[self.cath["chain"]==chainLett]
-        self.cath_chain = pd.merge(
-            self.cath_chain[["cath_domain", "cathcode", "pdb", "chain",
-                "cathStartResidueNumber", "cathStopResidueNumber"]],
-            chain_residues,
-            how="left", on=["pdb", "chain"])
-
-        domain_residues = self.cath_chain[
-            (self.cath_chain["residueNumber"] >= self.cath_chain["cathStartResidueNumber"]) & \
-            (self.cath_chain["residueNumber"] <= self.cath_chain["cathStopResidueNumber"])]
-        domain_residues = domain_residues.drop(columns=
-            ["cathStartResidueNumber", "cathStopResidueNumber"])
-
-        loop_residues = self.cath_chain[
-            (self.cath_chain["residueNumber"] < self.cath_chain["cathStartResidueNumber"]) & \
-            (self.cath_chain["residueNumber"] > self.cath_chain["cathStopResidueNumber"])]
-        loop_residues = loop_residues.drop(columns=
-            ["cathStartResidueNumber", "cathStopResidueNumber"])
+        self.cath_chain = self.cath[self.cath["chain"]==chainLett][["cath_domain",
+            "cathcode", "pdb", "chain", "cathStartResidueNumber", "cathStopResidueNumber"]]
+
+        #Map each residue to the CATH domain segment that contains it, residues
+        #outside of every domain are loops. Like the inner join this replaced,
+        #chains without any CATH domain have neither domain nor loop residues,
+        #so they never appear in the dli/lli outputs
+        residues = interval_join(chain_residues, self.cath_chain, "residueNumber",
+            "cathStartResidueNumber", "cathStopResidueNumber", by=["pdb", "chain"],
+            how="left")
+        residues = residues.drop(columns=["cathStartResidueNumber", "cathStopResidueNumber"])
+
+        in_domain = residues["cath_domain"].notna()
+        domain_residues = residues[in_domain]
+        if self.cath_chain.empty:
+            loop_residues = residues.iloc[:0]
+        else:
+            loop_residues = residues[~in_domain]
 
         #Create DDI interactome by merging with contacts
         self.domain_domain_contacts = pd.merge(
@@ -443,41 +611,38 @@ class EPPICInteractome(object):
             self.domain_loop_contacts = self._update_contact_columns(self.domain_loop_contacts, side)
 
     def get_domain_loop_interactions(self, intId):
-        #Get Domain:Loop interactions closest domains
-        domain_loop_contacts_to_cath = pd.merge(
-            self.domain_loop_contacts,
-            self.cath_chain[["pdb", "chain", "cath_domain", "cathcode", "cathStartResidueNumber", "cathStopResidueNumber"]],
-            left_on=["pdb", "secondChain"],
-            right_on=["pdb", "chain"])
-        domain_loop_contacts_to_cath = domain_loop_contacts_to_cath[
-            (domain_loop_contacts_to_cath["secondResNumber"]>domain_loop_contacts_to_cath["cathStopResidueNumber"]) &\
-            (domain_loop_contacts_to_cath["secondResNumber"]<domain_loop_contacts_to_cath["cathStartResidueNumber"])]
-
-        #Get distance from 2nd PDB Res to start and ends of closest CATH domains
-        dist_to_start = domain_loop_contacts_to_cath["cathStartResidueNumber"]-domain_loop_contacts_to_cath["secondResNumber"]
-        dist_to_end = domain_loop_contacts_to_cath["secondResNumber"]-domain_loop_contacts_to_cath["cathStopResidueNumber"]
-
-        if len(dist_to_start) > 0 and len(dist_to_end) > 0:
-            distance = pd.concat((dist_to_start, dist_to_end), axis=1).abs()
-            domain_loop_contacts_to_cath = domain_loop_contacts_to_cath.assign(
-                distance=distance.min(), position=distance.idxmin())
-
-            top_cath_domain_loops_contacts = domain_loop_contacts_to_cath.groupby(
-                ["firstCathDomain", "firstResNumber", "secondResNumber"]).apply(
-                    get_top_cath_domains_to_loop_contacts)
-
-            #Save DLI binding sites for PDB file
-            self.domain_loop_binding_sites = get_binding_sites(self.domain_loop_contacts)
-            self.writer.write(self.domain_loop_binding_sites, "dli")
-            self.status[intId]["dli"] = len(self.domain_loop_binding_sites)
-
-            #Save DLI contacts for PDB file with info on each residue
-            self.writer.write(self.domain_loop_contacts, "dli_residues")
-            self.status[intId]["dli_residues"] = len(self.domain_loop_contacts)
-
-        else:
+        if self.domain_loop_contacts is None or self.domain_loop_contacts.empty:
             self.status[intId]["dli"] = 0
             self.status[intId]["dli_residues"] = 0
+            return
+
+        #Get the CATH domains closest to each loop residue on the second chain
+        previous, following = nearest_intervals(
+            self.domain_loop_contacts, self.cath, "secondResNumber",
+            "cathStartResidueNumber", "cathStopResidueNumber",
+            left_by=["pdb", "secondChain"], right_by=["pdb", "chain"],
+            columns=["cath_domain", "cathcode"])
+
+        #Closest domain first, keep the second only if they are equidistant
+        swap = following["distance"] < previous["distance"].fillna(np.inf)
+        closest1 = previous.where(~swap, following, axis=0)
+        closest2 = following.where(~swap, previous, axis=0)
+        closest2 = closest2.where(closest2["distance"]==closest1["distance"], axis=0)
+
+        for i, closest in enumerate((closest1, closest2), start=1):
+            self.domain_loop_contacts = self.domain_loop_contacts.assign(**{
+                "secondCathDomainClosest{}".format(i): closest["cath_domain"],
+                "secondCathCodeClosest{}".format(i): closest["cathcode"],
+                "secondCathDomainDistance{}".format(i): closest["distance"]})
+
+        #Save DLI binding sites for PDB file
+        self.domain_loop_binding_sites = self._get_binding_sites(self.domain_loop_contacts)
+        self.writer.write(self.domain_loop_binding_sites, "dli")
+        self.status[intId]["dli"] = len(self.domain_loop_binding_sites)
+
+        #Save DLI contacts for PDB file with info on each residue
+        self.writer.write(self.domain_loop_contacts, "dli_residues")
+        self.status[intId]["dli_residues"] = len(self.domain_loop_contacts)
 
     def get_binding_sites(self, intId, contacts, binding_site_type):
         if not contacts.empty:
@@ -504,20 +669,25 @@ class EPPICInteractome(object):
             cath = filter_hdf(cath_file, "table", pdb=self.pdbId)
             safe_remove(cath_file)
 
-        cath["srange_start"] = cath["srange_start"].astype(str)
-        cath["srange_stop"] = cath["srange_stop"].astype(str)
+        cath = cath.assign(
+            srange_start=cath["srange_start"].astype(str),
+            srange_stop=cath["srange_stop"].astype(str))
+
+        #Look up the sequential residue number of both ends of each CATH range
+        #in one index of (chain, pdbResidueNumber)
+        residue_info = residue_info.drop_duplicates(["chain", "pdbResidueNumber"])
+        residue_index = pd.MultiIndex.from_frame(residue_info[["chain", "pdbResidueNumber"]])
+        residue_numbers = residue_info["residueNumber"].values
 
-        for i, cath_side in enumerate(("start", "stop")):
-            cath_col = "srange_{}".format(cath_side)
-            cath = pd.merge(
-                cath,
-                residue_info.rename(columns={"pdbResidueNumber":cath_col}),
-                on=["chain", cath_col],
-                how="inner")
-            cath = cath.rename(columns={"residueNumber":"cath{}ResidueNumber".format(
-                cath_side.title())})
+        found = np.ones(len(cath), dtype=bool)
+        for cath_side in ("start", "stop"):
+            positions = residue_index.get_indexer(pd.MultiIndex.from_arrays(
+                [cath["chain"].values, cath["srange_{}".format(cath_side)].values]))
+            found &= positions >= 0
+            cath = cath.assign(**{"cath{}ResidueNumber".format(cath_side.title()):
+                np.where(positions >= 0, residue_numbers[np.clip(positions, 0, None)], -1)})
 
-        return cath
+        return cath[found]
 
     def _update_contact_columns(self, df, side):
         if "pdb_x" in df.columns:
@@ -595,7 +765,7 @@ class EPPICInteractome(object):
                 "secondCathDomain", "secondChain", "secondResi", "secondResn"
             ]
 
-        binding_sites = contacts.groupby(columns, as_index=False)
+        binding_sites = contacts.groupby(columns, as_index=False, dropna=False)
         binding_sites = binding_sites.apply(collapse_binding_site).reset_index(drop=True)
         binding_sites = binding_sites.assign(reverse=False)
 
@@ -612,18 +782,20 @@ class EPPICInteractome(object):
 
         return binding_sites
 
-def process_pdb(job, pdbId, cathFileStoreID, manual_status=False, work_dir=None):
+def process_pdb(job, pdbId, cathFileStoreID, manual_status=False, work_dir=None, batch=None):
     work_dir = work_dir if work_dir is not None else job.fileStore.getLocalTempDir()
     try:
         interactome = EPPICInteractome(job, pdbId, cathFileStoreID, data_stores.eppic_interfaces,
-            manual_status=manual_status, work_dir=work_dir)
+            manual_status=manual_status, work_dir=work_dir, batch=batch)
         interactome.run()
     except (SystemExit, KeyboardInterrupt):
         raise
     except:
+        if batch is not None:
+            batch.discard()
         return
 
-def process_pdb_group(job, pdb_group, cathFileStoreID, further_parallelize=False):
+def process_pdb_group(job, pdb_group, cathFileStoreID, further_parallelize=False, batch=False):
     work_dir = job.fileStore.getLocalTempDir()
 
     if further_parallelize:
@@ -633,16 +805,27 @@ def process_pdb_group(job, pdb_group, cathFileStoreID, further_parallelize=False
         cath = filter_hdf(cath_file, "table", columns=["cath_domain", "cathcode",
             "pdb", "chain", "srange_start", "srange_stop"], drop_duplicates=True)
         cath = cath[cath["pdb"].isin(pdb_group)]
-        for pdbId in pdb_group:
-            try:
-                process_pdb(job, pdbId, cath, work_dir=work_dir)
-            except (SystemExit, KeyboardInterrupt):
-                raise
-            except Exception as e:
-                import traceback
-                RealtimeLogger.info("Failed getting interactome for {}: {} - {}".format(
-                    pdbId, e.__class__.__name__, e))
-                RealtimeLogger.info(traceback.format_exc())
+
+        if batch:
+            batch = BatchWriter(data_stores.eppic_interfaces, work_dir=work_dir,
+                batch_id="{}-{}".format(pdb_group[0], uuid.uuid4().hex[:8]))
+        else:
+            batch = None
+
+        try:
+            for pdbId in pdb_group:
+                try:
+                    process_pdb(job, pdbId, cath, work_dir=work_dir, batch=batch)
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception as e:
+                    import traceback
+                    RealtimeLogger.info("Failed getting interactome for {}: {} - {}".format(
+                        pdbId, e.__class__.__name__, e))
+                    RealtimeLogger.info(traceback.format_exc())
+        finally:
+            if batch is not None:
+                batch.flush()
 
 def merge_cath(job, cathFileStoreID, further_parallelize=False):
     work_dir = job.fileStore.getLocalTempDir()
@@ -662,7 +845,13 @@ def merge_cath(job, cathFileStoreID, further_parallelize=False):
                 pass
 
 def start_toil(job, cathFileStoreID, force=False, split_groups=False, filter_obsolete=True,
-  further_parallelize=True):
+  further_parallelize=True, batch_size=None):
+    """Get the EPPIC interactome for every PDB in CATH.
+
+    If batch_size is set, PDBs are run in groups of batch_size and the results
+    of each group are written with BatchWriter instead of a file per PDB,
+    interface and output type. Finished PDBs are then found in the batch index.
+    """
     work_dir = job.fileStore.getLocalTempDir()
     cath_file = job.fileStore.readGlobalFile(cathFileStoreID, cache=True)
 
@@ -674,10 +863,12 @@ def start_toil(job, cathFileStoreID, force=False, split_groups=False, filter_obs
         pdb = pdb[~pdb.isin(obsolete)]
 
     if not force:
-        keys = list(data_stores.eppic_interfaces.list_input_directory())
+        done_pdbs = list(get_completed_pdbs(data_stores.eppic_interfaces,
+            work_dir=work_dir)["pdb"])
 
-        all_files = list(data_stores.eppic_interfaces.list_input_directory("pdb"))
-        done_pdbs = [f.split("/")[1] for f in all_files if "status.json" in f]
+        if batch_size is None:
+            all_files = list(data_stores.eppic_interfaces.list_input_directory("pdb"))
+            done_pdbs += [f.split("/")[1] for f in all_files if "status.json" in f]
 
         # done_pdbs = []
         # for pdbId, files in groupby(data_stores.eppic_interfaces.list_input_directory(), lambda k: k.split("/")[1]):
@@ -691,7 +882,12 @@ def start_toil(job, cathFileStoreID, force=False, split_groups=False, filter_obs
     else:
         RealtimeLogger.info("Running CATH ({} domains)".format(len(pdb)))
 
-    if split_groups:
+    if batch_size is not None:
+        pdbs = list(pdb["pdb"].drop_duplicates())
+        pdb_groups = [pdbs[i:i+batch_size] for i in range(0, len(pdbs), batch_size)]
+        map_job(job, process_pdb_group, pdb_groups, cathFileStoreID, False, True)
+        job.addFollowOnJobFn(consolidate_index)
+    elif split_groups:
         pdb = pdb.assign(group=pdb["pdb"].str[:3])
         pdb_groups = pdb.groupby("group")["pdb"].apply(list)
         map_job(job, process_pdb_group, pdb_groups, cathFileStoreID, further_parallelize)
@@ -708,6 +904,7 @@ if __name__ == "__main__":
 
     parser = Job.Runner.getDefaultArgumentParser()
     parser.add_argument("--force", default=False, action="store_true")
+    parser.add_argument("--batch_size", type=int, default=None)
     options = parser.parse_args()
     options.logLevel = "DEBUG"
     options.clean = "always"
@@ -719,7 +916,8 @@ if __name__ == "__main__":
     with Toil(options) as workflow:
         cathFileURL = 'file://' + os.path.abspath("cath.h5")
         cathFileID = workflow.importFile(cathFileURL)
-        workflow.start(Job.wrapJobFn(start_toil, cathFileID, options.force))
+        workflow.start(Job.wrapJobFn(start_toil, cathFileID, options.force,
+            batch_size=options.batch_size))
 
     # status_key = "pdb/{}/status.json".format(pdbId)
     # status_file = os.path.join(work_dir, "{}_status.json".format(pdbId))
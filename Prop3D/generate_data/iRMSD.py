@@ -1,8 +1,7 @@
 from __future__ import print_function
 import os
-from collections import defaultdict
 
-from prodigy.predict_IC import calculate_ic, Prodigy
+from prodigy.predict_IC import Prodigy
 import Bio.PDB
 from Bio.PDB import Select
 import pandas as pd
@@ -12,6 +11,8 @@ import numpy as np
 from Prop3D.parsers.superpose import Align
 from Prop3D.parsers.zrank import ZRank
 from Prop3D.util.pdb import read_pdb, replace_chains, extract_chains, rottrans, get_all_chains
+from Prop3D.util import kabsch
+from Prop3D.util.contacts import ContactMap, compare_contacts
 
 from toil.realtimeLogger import RealtimeLogger
 
@@ -22,8 +23,10 @@ def get_cm(coords):
     return np.mean(coords, axis=0)
 
 def get_cm_5(pdb):
-    coords = read_pdb(pdb)
-    cm = get_cm(coords)
+    return cm_5(get_cm(read_pdb(pdb)))
+
+def cm_5(cm):
+    """The center of mass and points 5A away from it along each axis"""
     points = np.tile(cm, (7,1))
     for i in range(3):
         for k, j in enumerate((-1,1)):
@@ -52,7 +55,9 @@ class Complex(Select):
         self.chain2 = chain2
         self.temp = temp
         self.method = method
+        self.d_cutoff = d_cutoff
         self.s = Complex.parser.get_structure("ref", pdb)
+        self._contacts = {}
         if face1 is not None and face2 is not None:
             try:
                 RealtimeLogger.info("ALL MOL RESI : {}".format([r.id[1] for r in self.s[0][chain1]]))
@@ -69,34 +74,11 @@ class Complex(Select):
         self.prodigy = Prodigy(self.s, selection, temp, strict=False)
         self.prodigy.predict(distance_cutoff=d_cutoff, acc_threshold=0.05)
 
-        try:
-            self.interface = set([r.id for rs in calculate_ic(self.s,
-                d_cutoff=10.) for r in rs])
-        except ValueError:
-            #No contatcs at 10 Angtroms!
-            self.interface = set()
-
-        self.neighbors = {c.id:defaultdict(list) for c in self.s.get_chains()}
-
-        for resA, resB in self.prodigy.ic_network:
-            cA, cB = resA.parent.id, resB.parent.id
-            ## Checking for 1st residue (if his chain exist, then if
-            ## it is referenced and finally if his partner is already present)
-            if resA not in self.neighbors[cA]:
-                self.neighbors[cA][resA].append(resB)
-            elif resB not in self.neighbors[cA][resA]:
-                self.neighbors[cA][resA].append(resB)
-            ## Checking for 2nd residue
-            if resB not in self.neighbors[cB]:
-                self.neighbors[cB][resB].append(resB)
-            elif resA not in self.neighbors[cB][resB]:
-                self.neighbors[cB][resB].append(resA)
-
-        self.neighbors_id = {}
-
-        for key in self.neighbors[chain1]:
-            self.neighbors_id[key.id[1]] = sorted([res.id[1] for res in \
-                self.neighbors[chain1][key]])
+        #Residues of each chain within 10 Angtroms of the other chain
+        self.interface = tuple(set(face) for face in self.contacts(10.).interface())
+
+        self.neighbors_id = {res[1]: sorted(r[1] for r in neighbors) for res, neighbors in \
+            self.contacts().neighbors().items()}
 
         if get_stats:
             self.results = self._get_stats()
@@ -201,8 +183,9 @@ class Complex(Select):
         })
 
     def radius_of_gyration(self):
-        face1 = get_coords(list(self.neighbors[self.chain1].keys()))
-        face2 = get_coords(list(self.neighbors[self.chain2].keys()))
+        ids1, ids2 = self.contacts().interface()
+        face1 = get_coords([self.s[0][self.chain1][r] for r in ids1])
+        face2 = get_coords([self.s[0][self.chain2][r] for r in ids2])
         r1 = radius_of_gyration(face1)
         r2 = radius_of_gyration(face2)
         rI = radius_of_gyration(np.concatenate((face1, face2), axis=0))
@@ -238,12 +221,20 @@ class Complex(Select):
             work_dir=self.work_dir, job=self.job)
 
     def compare(self, moving):
-        c1, c2 = self.chain1, self.chain2
-        self_chain = self.set_chains("X", "Y")
-        irmsd, irmsd_A, irmsd_B, irmsd_avg, irmsd_best = self_chain.iRMSD(moving)
-        i_rms, i_tm = self_chain.I_RMS(moving)
-        l_rms, l_tm = self_chain.L_RMS(moving)
-        mm_rmsd, mm_tm_score = self_chain.MM_TM_score(moving)
+        matched = self.match_coordinates(moving)
+        if matched is not None:
+            #Superposed in memory, chains do not need to be renamed
+            self_chain = self
+        else:
+            self_chain = self.set_chains("X", "Y")
+        irmsd, irmsd_A, irmsd_B, irmsd_avg, irmsd_best = self_chain.iRMSD(moving, matched=matched)
+        i_rms, i_tm = self_chain.I_RMS(moving, matched=matched)
+        l_rms, l_tm = self_chain.L_RMS(moving, matched=matched)
+        if matched is not None:
+            #With matched residues the complex alignment is the same as L_RMS
+            mm_rmsd, mm_tm_score = l_rms, l_tm
+        else:
+            mm_rmsd, mm_tm_score = self_chain.MM_TM_score(moving)
         results = {
             "iRMSD": irmsd,
             "iRMSD_A": irmsd_A,
@@ -256,7 +247,7 @@ class Complex(Select):
             "L_TM": l_tm,
             "mm_tm-score": mm_tm_score,
             "mm_rmsd": mm_rmsd,
-            "fcc": self_chain.fcc(moving)
+            "fcc": self.fcc(moving)
         }
         return pd.Series(results)
 
@@ -285,9 +276,114 @@ class Complex(Select):
         )
 
     def accept_residue(self, residue):
-        return int(residue.id in self.interface)
+        chain = residue.get_parent().id
+        if chain == self.chain1:
+            return int(residue.id in self.interface[0])
+        elif chain == self.chain2:
+            return int(residue.id in self.interface[1])
+        return 0
+
+    def _atom_coords(self, chain, atoms="CA", residues=None):
+        """Coordinates of atoms in a chain keyed by (residue id, residue name,
+        atom name). All atoms if atoms is None"""
+        coords = {}
+        for residue in self.s[0][chain]:
+            if residues is not None and residue.id not in residues:
+                continue
+            for atom in residue:
+                if atoms is None or atom.get_id() in atoms:
+                    coords[(residue.id, residue.get_resname(), atom.get_id())] = atom.get_coord()
+        return coords
+
+    def match_coordinates(self, other, atoms="CA", residues=None, min_coverage=0.9):
+        """Match atoms of chain1 and chain2 to the same atoms in other by
+        residue number, residue name and atom name, e.g. for decoys of the
+        same complex.
+
+        Parameters
+        ----------
+        atoms : str or list of str
+            Atom names to match. All atoms if None
+        residues : set or (set, set)
+            Only use residues with these Bio.PDB ids (from this complex). A
+            pair is used as the residues of chain1 and chain2
+        min_coverage : float
+            Minimum fraction of the atoms of each chain (in both complexes)
+            that must be matched
+
+        Returns
+        -------
+        (coords, other_coords, in_chain1, residue_ids) or None if there is
+        no reliable correspondence. coords and other_coords are (N, 3)
+        arrays, in_chain1 is a boolean mask of the atoms from chain1 and
+        residue_ids are the Bio.PDB ids of the residue of each atom
+        """
+        if isinstance(atoms, str):
+            atoms = [atoms]
+
+        coords, other_coords, in_chain1, residue_ids = [], [], [], []
+        for chain, other_chain, first in ((self.chain1, other.chain1, True),
+          (self.chain2, other.chain2, False)):
+            try:
+                atoms1 = self._atom_coords(chain, atoms)
+                atoms2 = other._atom_coords(other_chain, atoms)
+            except KeyError:
+                return None
+
+            common = [key for key in atoms1 if key in atoms2]
+            if len(common) == 0 or len(common) < min_coverage*max(len(atoms1), len(atoms2)):
+                return None
+
+            coords += [atoms1[key] for key in common]
+            other_coords += [atoms2[key] for key in common]
+            in_chain1 += [first]*len(common)
+            residue_ids += [key[0] for key in common]
+
+        if len(coords) == 0:
+            return None
+
+        matched = np.array(coords, dtype=float), np.array(other_coords, dtype=float), \
+            np.array(in_chain1, dtype=bool), residue_ids
+
+        if residues is not None:
+            return self.select_residues(matched, residues)
+
+        return matched
+
+    @staticmethod
+    def select_residues(matched, residues):
+        """Only keep the atoms of matched (from match_coordinates) in residues,
+        a set of Bio.PDB ids or a pair of sets for chain1 and chain2. Returns
+        None if no atoms are left"""
+        coords, other_coords, in_chain1, residue_ids = matched
+        if isinstance(residues, (set, frozenset)):
+            residues = (residues, residues)
+        keep = np.array([r in residues[0 if first else 1] for r, first in \
+            zip(residue_ids, in_chain1)], dtype=bool)
+        if not keep.any():
+            return None
+        return coords[keep], other_coords[keep], in_chain1[keep], \
+            [r for r, k in zip(residue_ids, keep) if k]
+
+    def _superpose_matched(self, other, residues=None, matched=None):
+        """RMSD and TM-score of other superposed onto this complex using
+        matched CA atoms, or None if the residues do not correspond. matched
+        is the output of match_coordinates(other) if it is already known"""
+        if matched is None:
+            matched = self.match_coordinates(other, residues=residues)
+        elif residues is not None:
+            matched = self.select_residues(matched, residues)
+        if matched is None:
+            return None
+        coords, other_coords, _, _ = matched
+        _, rmsd, tm_score = kabsch.superpose(other_coords, coords)
+        return float(rmsd), float(tm_score)
+
+    def L_RMS(self, other, matched=None):
+        matched = self._superpose_matched(other, matched=matched)
+        if matched is not None:
+            return matched
 
-    def L_RMS(self, other):
         aligner = Align()
         f, rmsd, tm_score, _ = aligner.align(
             self.pdb, self.chain1+self.chain2,
@@ -297,9 +393,14 @@ class Complex(Select):
         os.remove(f)
         return rmsd, tm_score
 
-    def I_RMS(self, moving):
-        if len(self.interface) == 0 or len(moving.interface) == 0:
+    def I_RMS(self, moving, matched=None):
+        if len(self.interface[0]) == 0 or len(moving.interface[0]) == 0:
             return None, None
+
+        matched = self._superpose_matched(moving, residues=self.interface, matched=matched)
+        if matched is not None:
+            return matched
+
         interface1 = self.save_interface()
         interface2 = moving.save_interface()
         aligner = Align()
@@ -314,6 +415,11 @@ class Complex(Select):
         return rmsd, tm_score
 
     def MM_TM_score(self, other):
+        #With matched residues the complex alignment is the same as L_RMS
+        matched = self._superpose_matched(other)
+        if matched is not None:
+            return matched
+
         aligner = Align()
         f, mm_rmsd, mm_tm_score, _ = aligner.align(
             self.pdb, self.chain1+self.chain2,
@@ -325,25 +431,50 @@ class Complex(Select):
         os.remove(f)
         return mm_rmsd, mm_tm_score
 
+    def contacts(self, cutoff=None):
+        """Residue contacts between chain1 and chain2, cached per cutoff
+        (default d_cutoff)"""
+        cutoff = cutoff if cutoff is not None else self.d_cutoff
+        if cutoff not in self._contacts:
+            self._contacts[cutoff] = ContactMap.from_structure(self.s, self.chain1,
+                self.chain2, cutoff=cutoff)
+        return self._contacts[cutoff]
+
+    def compare_contacts(self, decoys, cutoff=None, index=None):
+        """fcc, precision, recall and Jaccard of the contacts of many decoys
+        (Complex objects or ContactMaps) with this complex as the reference"""
+        decoys = [d.contacts(cutoff) if isinstance(d, Complex) else d for d in decoys]
+        return compare_contacts(self.contacts(cutoff), decoys, index=index)
+
     def fcc(self, moving):
         "Defined the fraction of native contacts between 2 interfaces"
+        #Chain 1 and chain 2 match in both complexes, but they might have different IDs
+        return float(self.compare_contacts([moving])["fcc"].iloc[0])
 
-        #Gets the number of contacts for the reference interface
-        total = sum(len(l) for l in list(self.neighbors_id.values()))
+    def _iRMSD_matched(self, moving, matched=None):
+        if matched is None:
+            matched = self.match_coordinates(moving)
+        if matched is None:
+            return None
+        coords, moving_coords, in_chain1, _ = matched
 
-        #Assume chain 1 and chain 2 match in both complexes, but they might have different IDs
-        chain_map = {self.chain1:moving.chain1, self.chain2:moving.chain2}
+        chain_cm = lambda c, chain: get_cm(get_coords(c.s[0][chain]))[None]
+        cm1, cm2 = chain_cm(self, self.chain1), chain_cm(self, self.chain2)
+        moving_cm1, moving_cm2 = chain_cm(moving, moving.chain1), chain_cm(moving, moving.chain2)
 
-        #Finds each common pairs for the 2 interfaces
-        common = sum(len(set([r for r in self.neighbors_id[res_id]]).intersection(\
-            set([r for r in moving.neighbors_id[res_id]]))) \
-            for res_id in self.neighbors_id if res_id in moving.neighbors_id)
+        #Superimpose A' to A and B' to B
+        rot_A, trans_A, _ = kabsch.kabsch(moving_coords[in_chain1], coords[in_chain1])
+        rot_B, trans_B, _ = kabsch.kabsch(moving_coords[~in_chain1], coords[~in_chain1])
 
-        fcc = float(common)/total if total>0 else 0.0
+        #Center of mass of ref, A' -> A and B' -> B
+        move = lambda cm, rot, trans: cm_5(kabsch.transform(cm, rot, trans)[0])
+        cm_ref = np.vstack((cm_5(cm1[0]), cm_5(cm2[0])))
+        cm_A = np.vstack((move(moving_cm1, rot_A, trans_A), move(moving_cm2, rot_A, trans_A)))
+        cm_B = np.vstack((move(moving_cm1, rot_B, trans_B), move(moving_cm2, rot_B, trans_B)))
 
-        return fcc
+        return cm_ref, cm_A, cm_B
 
-    def iRMSD(self, moving):
+    def _iRMSD_aligned(self, moving):
         #Extract domains
         c1_1f = extract_chains(self.pdb, self.chain1)
         c1_2f = extract_chains(self.pdb, self.chain2)
@@ -380,6 +511,15 @@ class Complex(Select):
         #Center of Mass of B' -> B
         cm_B = np.vstack((get_cm_5(best2_2_1), get_cm_5(best2_2)))
 
+        return cm_ref, cm_A, cm_B
+
+    def iRMSD(self, moving, matched=None):
+        matched = self._iRMSD_matched(moving, matched=matched)
+        if matched is not None:
+            cm_ref, cm_A, cm_B = matched
+        else:
+            cm_ref, cm_A, cm_B = self._iRMSD_aligned(moving)
+
         cm_best = np.vstack((cm_A[:7,], cm_B[7:,]))
 
         rmsdA = rmsd(cm_ref, cm_A)
@@ -390,10 +530,6 @@ class Complex(Select):
         return irmsd, rmsdA, rmsdB, irmsd_avg, irmsd_best
 
     def match_residues(self, other, r=5.5):
-        from sklearn.metrics import jaccard_similarity_score
-        face1, face2 = list(zip(*calculate_ic(s, distance_cutoff=r)))
-        face1_pred = set([r.id[1] for r in face1])
-        face2_pred = set([r.id[1] for r in face2])
-        face1_score = jaccard_similarity_score(face1, face1_pred)
-        face2_score = jaccard_similarity_score(face2, face2_pred)
-        return face1_score, face2_score
+        """Jaccard index of the interface residues of each chain"""
+        scores = self.compare_contacts([other], cutoff=r).iloc[0]
+        return scores["interface_jaccard_1"], scores["interface_jaccard_2"]
@@ -9,14 +9,19 @@ from toil.realtimeLogger import RealtimeLogger
 from Prop3D.util import safe_remove
 from Prop3D.util.iostore import IOStore
 from Prop3D.util.cath import run_cath_hierarchy, run_cath_hierarchy_h5
-from Prop3D.util.hdf import get_file, filter_hdf_chunks
-from Prop3D.util.toil import map_job, map_job_follow_ons
+from Prop3D.util.hdf import get_file, read_hdf_table
+from Prop3D.util.toil import map_job, map_job_follow_ons, map_job_batched
 from Prop3D.util.pdb import get_atom_lines
+from Prop3D.util.stages import stage, stage_context
 
 from Prop3D.generate_data.prepare_protein import process_domain
 from Prop3D.generate_data.calculate_features import calculate_features
 from Prop3D.generate_data.calculate_features_hsds import calculate_features as calculate_features_hsds
 from Prop3D.generate_data.set_cath_h5_toil import create_h5_hierarchy
+from Prop3D.generate_data.completion import get_completed_domains, get_domain_status, \
+    list_superfamilies, check_completed, ALL_FEATURES
+from Prop3D.generate_data.calculate_chain_features import precompute_chains, \
+    group_domains_by_chain, safe_calculate_chain_features
 
 from Prop3D.generate_data import data_stores
 
@@ -29,12 +34,25 @@ logging.getLogger('s3transfer').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 def get_domain_structure_and_features(job, cath_domain, superfamily,
-  cathFileStoreID, update_features=None, further_parallelize=False, force=False, use_hsds=True):
+  cathFileStoreID, update_features=None, further_parallelize=False, force=False, use_hsds=True,
+  use_chain_features=False):
     """1) Run Features depends on prepared strucutre Structure"""
+    with stage_context(cath_domain=cath_domain, superfamily=superfamily), stage("domain"):
+        return _get_domain_structure_and_features(job, cath_domain, superfamily,
+            cathFileStoreID, update_features=update_features,
+            further_parallelize=further_parallelize, force=force, use_hsds=use_hsds,
+            use_chain_features=use_chain_features)
+
+def _get_domain_structure_and_features(job, cath_domain, superfamily,
+  cathFileStoreID, update_features=None, further_parallelize=False, force=False, use_hsds=True,
+  use_chain_features=False):
     RealtimeLogger.info("get_domain_structure_and_features Process domain "+cath_domain)
 
+    feature_kwds = {}
     if use_hsds:
         calc_features_func = calculate_features_hsds
+        if use_chain_features:
+            feature_kwds["use_chain_features"] = True
     else:
         calc_features_func = calculate_features
 
@@ -47,7 +65,7 @@ def get_domain_structure_and_features(job, cath_domain, superfamily,
         should_prepare_structure = True
         further_parallelize = False
         force=True
-        h5_key = os.path.basename(os.path.basename(cath_domain))[0]
+        h5_key = os.path.splitext(os.path.basename(cath_domain))[0]
 
     if force or (isinstance(force, int) and force==2) or should_prepare_structure:
         #Get Processed domain file first
@@ -57,7 +75,8 @@ def get_domain_structure_and_features(job, cath_domain, superfamily,
                 cathFileStoreID=cathFileStoreID)
         else:
             try:
-                prepared_file, _, _, local_file = process_domain(job, cath_domain, superfamily, cathFileStoreID=cathFileStoreID)
+                with stage("process_domain"):
+                    prepared_file, _, _, local_file = process_domain(job, cath_domain, superfamily, cathFileStoreID=cathFileStoreID)
                 local_domain_file = prepared_file if local_file else None
             except (SystemExit, KeyboardInterrupt):
                 raise
@@ -71,16 +90,16 @@ def get_domain_structure_and_features(job, cath_domain, superfamily,
             ('atom.h5', 'residue.h5', 'edges.h5')]
         feats_exist = all([data_stores.cath_features.exists(f) for f in feat_files])
     elif not force and use_hsds:
-        with h5pyd.File(cathFileStoreID, mode="r", use_cache=False, retries=100) as store:
-            try:
-                feat_files = list(store[f"/{superfamily}/domains/{cath_domain}"].keys())
-                if len(feat_files) == 3 and "atom" in feat_files and \
-                  "residue" in feat_files and feat_files and "edges":
-                    feats_exist = True
-                else:
+        with h5pyd.File(cathFileStoreID, mode="a", use_cache=False, retries=100) as store:
+            if superfamily is not None:
+                #Checks the domain group if the completion index does not know
+                feats_exist = check_completed(store, superfamily, cath_domain)
+            else:
+                try:
+                    feat_files = list(store[h5_key].keys())
+                    feats_exist = all(ext in feat_files for ext in ("atom", "residue", "edges"))
+                except KeyError:
                     feats_exist = False
-            except KeyError:
-                feats_exist = False
     else:
         feats_exist = False
 
@@ -90,12 +109,15 @@ def get_domain_structure_and_features(job, cath_domain, superfamily,
         #Calculate features Processed domain file
         if further_parallelize:
             job.addFollowOnJobFn(calc_features_func, cathFileStoreID, cath_domain,
-                superfamily, update_features=update_features, domain_file=local_domain_file)
+                superfamily, update_features=update_features, domain_file=local_domain_file,
+                **feature_kwds)
         else:
             RealtimeLogger.info("get_domain_structure_and_features calculate_features")
             try:
-                calc_features_func(job, cathFileStoreID, cath_domain, superfamily,
-                    update_features=update_features, domain_file=local_domain_file)
+                with stage("calculate_features"):
+                    calc_features_func(job, cathFileStoreID, cath_domain, superfamily,
+                        update_features=update_features, domain_file=local_domain_file,
+                        **feature_kwds)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except:
@@ -110,12 +132,13 @@ def get_domain_structure_and_features(job, cath_domain, superfamily,
         safe_remove(done_file)
 
 def process_superfamily(job, superfamily, cathFileStoreID, update_features=None,
-  force=False, use_hsds=True, further_parallize=True):
+  force=False, use_hsds=True, further_parallize=True, use_chain_features=False,
+  batch_time=None, batch_cores=1):
 
     cathcode = superfamily.replace("/", ".")
     if not use_hsds:
         cath_file = job.fileStore.readGlobalFile(cathFileStoreID, cache=True)
-        cath_domains = filter_hdf_chunks(
+        cath_domains = read_hdf_table(
             cath_file,
             "table",
             columns=["cath_domain"],
@@ -124,22 +147,14 @@ def process_superfamily(job, superfamily, cathFileStoreID, update_features=None,
     else:
         with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
             cath_domains = list(store[f"{superfamily}/domains"].keys())
-        cath_domains = cath_domains
 
     if not force and update_features is None:
         if use_hsds:
             try:
                 RealtimeLogger.info("Finding completed domains...")
-                # with h5pyd.File(cathFileStoreID, mode="a", use_cache=False, retries=100) as store:
-                #     processed_domains = defaultdict(int)
-                #     def count_feature_types(name):
-                #         if name.count("/") == 6:
-                #             #Name looks like 1/2/3/4/domains/xx/atom
-                #             domain = name.split("/")[-2]
-                #             processed_domains[domain] += 1
-                #     store[superfamily].visit(count_feature_types)
-                #     done_domains = [domain for domain, count in processed_domains.items() if count==3]
-                done_domains = []
+                #Builds the completion index from the domain groups if it does not exist yet
+                with h5pyd.File(cathFileStoreID, mode="a", use_cache=False, retries=100) as store:
+                    done_domains = get_completed_domains(store, superfamily)["cath_domain"].tolist()
             except KeyError as e:
                 raise RuntimeError(f"Must create hsds file first. Key not found {e}")
         else:
@@ -167,24 +182,61 @@ def process_superfamily(job, superfamily, cathFileStoreID, update_features=None,
         RealtimeLogger.info("Running {} domains from {}".format(len(cath_domains), cathcode))
 
     if further_parallize:
-        map_job(job, get_domain_structure_and_features, cath_domains,
-            superfamily, cathFileStoreID, update_features=update_features,
-            further_parallelize=False, use_hsds=use_hsds, force=False)
+        if batch_time is not None:
+            #Group domains into jobs of about batch_time seconds based on their length
+            domain_lengths = get_domain_lengths(cathFileStoreID, superfamily, cath_domains) \
+                if use_hsds else None
+            map_func = map_job_batched
+            map_kwds = {"sizes":domain_lengths, "target_time":batch_time,
+                "batch_cores":batch_cores}
+        else:
+            map_func = map_job
+            map_kwds = {}
+
+        if use_chain_features:
+            #Run DSSP, APBS and EPPIC once per chain before any domain is featurized
+            chains_job = job.addChildJobFn(precompute_chains, cath_domains)
+            chains_job.addFollowOnJobFn(map_func, get_domain_structure_and_features, cath_domains,
+                superfamily, cathFileStoreID, update_features=update_features,
+                further_parallelize=False, use_hsds=use_hsds, force=False,
+                use_chain_features=True, **map_kwds)
+        else:
+            map_func(job, get_domain_structure_and_features, cath_domains,
+                superfamily, cathFileStoreID, update_features=update_features,
+                further_parallelize=False, use_hsds=use_hsds, force=False, **map_kwds)
     else:
+        if use_chain_features:
+            for chain_key in group_domains_by_chain(cath_domains):
+                safe_calculate_chain_features(job, chain_key)
+
         RealtimeLogger.info("Looping over domain")
         for domain in cath_domains:
             try:
                 RealtimeLogger.info("Processing domain "+domain)
                 get_domain_structure_and_features(job, domain, superfamily,
                     cathFileStoreID, update_features=update_features,
-                    further_parallelize=False, use_hsds=use_hsds, force=force)
+                    further_parallelize=False, use_hsds=use_hsds, force=force,
+                    use_chain_features=use_chain_features)
             except (SystemExit, KeyboardInterrupt):
                 raise
             except:
                 pass
 
+def get_domain_lengths(cath_full_h5, superfamily, cath_domains):
+    """Number of residues in each domain from the CATH domain list, used as the
+    cost of each domain when batching"""
+    domain_lengths = {}
+    with h5pyd.File(cath_full_h5, mode="r", use_cache=False, retries=100) as store:
+        for cath_domain in cath_domains:
+            try:
+                domain_lengths[cath_domain] = store[f"{superfamily}/domains/{cath_domain}"].attrs["domain_length"]
+            except KeyError:
+                pass
+    return domain_lengths
+
 def start_domain_and_features(job, cathFileStoreID, cathcode=None, skip_cathcode=None,
-  update_features=None, use_hsds=True, work_dir=None, pdbs=None, force=False):
+  update_features=None, use_hsds=True, work_dir=None, pdbs=None, force=False,
+  use_chain_features=False, batch_time=None, batch_cores=1):
     if not use_hsds:
         cath_hierarchy_runner = run_cath_hierarchy
     else:
@@ -205,7 +257,7 @@ def start_domain_and_features(job, cathFileStoreID, cathcode=None, skip_cathcode
             if not use_hsds:
                 cath_file = job.fileStore.readGlobalFile(cathFileStoreID, cache=True)
 
-                cath_domains = filter_hdf_chunks(
+                cath_domains = read_hdf_table(
                     cath_file,
                     "table",
                     columns=["cath_domain", "cathcode"],
@@ -217,35 +269,25 @@ def start_domain_and_features(job, cathFileStoreID, cathcode=None, skip_cathcode
                         if domain.endswith("edges.txt.gz")]
 
             else:
-                with h5pyd.File(cathFileStoreID, mode="r", use_cache=False) as store:
+                with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
                     try:
                         cath_domains = pd.DataFrame([(cath_domain, sfam) for sfam in fixed_sfams \
                             for cath_domain in store[f"{sfam}/domains"].keys()], columns=["cath_domain", "cathcode"])
                     except KeyError:
                         raise RuntimeError(f"Must create hsds file first. Key not found {sfam}/domains")
 
-                    # try:
-                    #     check = [f"{sfam}/domains" for sfam in fixed_sfams]
-                    #     RealtimeLogger.info(f"Checking {check}")
-                    #     done_domains = [domain for sfam in fixed_sfams for domain in \
-                    #         store[f"{sfam}/domains"].keys() if \
-                    #         len(store[f"{sfam}/domains/{domain}"].keys())==3]
-                    # except KeyError as e:
-                    #     raise RuntimeError(f"Must create hsds file first. Key not found {e}")
-
-            num_domains_to_run = 500000
-            #domains_to_run = cath_domains[~cath_domains["cath_domain"].isin(done_domains)]
-            #num_domains_to_run = len(domains_to_run)
-            num_sfams_to_run = 7000 #len(cath_domains["cathcode"].drop_duplicates())
+                    #Two requests per superfamily from the completion index
+                    done_domains = get_completed_domains(store, fixed_sfams)["cath_domain"].tolist()
+
         else:
             #No update and forced
             RealtimeLogger.info(f"Counting # of domains from {fixed_sfams}")
             with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
                 try:
-                    cath_domains = sum(1 for sfam in fixed_sfams for cath_domain in \
-                        store[f"{sfam}/domains"].keys())
+                    cath_domains = pd.DataFrame([(cath_domain, sfam) for sfam in fixed_sfams \
+                        for cath_domain in store[f"{sfam}/domains"].keys()], columns=["cath_domain", "cathcode"])
                 except KeyError:
-                    raise RuntiemError("Must create hsds file first")
+                    raise RuntimeError("Must create hsds file first")
     elif pdbs is not None:
         assert use_hsds
         with h5pyd.File(cathFileStoreID, mode="r", use_cache=False) as store:
@@ -262,20 +304,27 @@ def start_domain_and_features(job, cathFileStoreID, cathcode=None, skip_cathcode
         return
     else:
         #No cath code proved, use all
-        if update_features is None and not force:
-            num_sfams_to_run = "all"
-            num_domains_to_run = 500000
+        if not use_hsds:
+            cath_file = job.fileStore.readGlobalFile(cathFileStoreID, cache=True)
+            cath_domains = read_hdf_table(
+                cath_file,
+                "table",
+                columns=["cath_domain", "cathcode"],
+                drop_duplicates=True)
         else:
-            #FIX: find all completed domains?
-            num_sfams_to_run = "all"
-            num_domains_to_run = 500000
+            #Two requests per superfamily from the completion index
+            with h5pyd.File(cathFileStoreID, mode="a", use_cache=False) as store:
+                cath_domains = get_domain_status(store, list_superfamilies(store))
+            if update_features is None and not force:
+                done_domains = cath_domains.loc[(cath_domains["status"].astype(int) & ALL_FEATURES)==ALL_FEATURES,
+                    "cath_domain"].tolist()
 
     if update_features is None and done_domains is not None:
         domains_to_run = cath_domains[~cath_domains["cath_domain"].isin(done_domains)]
-        num_domains_to_run = len(domains_to_run)
-        num_sfams_to_run = len(cath_domains["cathcode"].drop_duplicates())
     else:
-        num_domains_to_run = 500000
+        domains_to_run = cath_domains
+    num_domains_to_run = len(domains_to_run)
+    num_sfams_to_run = len(domains_to_run["cathcode"].drop_duplicates())
 
     RealtimeLogger.info("Domains to from {} superfamilies to run: {}".format(
         num_sfams_to_run, num_domains_to_run))
@@ -284,19 +333,22 @@ def start_domain_and_features(job, cathFileStoreID, cathcode=None, skip_cathcode
         #Start CATH hiearchy
         RealtimeLogger.info("Starting CATH Hierachy")
         cath_hierarchy_runner(job, cathcode, process_superfamily, cathFileStoreID,
-            skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds, force=force)
+            skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds, force=force,
+            use_chain_features=use_chain_features, batch_time=batch_time, batch_cores=batch_cores)
     else:
         superfamilies = domains_to_run["cathcode"].drop_duplicates().str.replace(".", "/")
         if skip_cathcode is not None and len(skip_cathcode) > 0:
             superfamilies = superfamilies[~superfamilies.isin(skip_cathcode)]
         RealtimeLogger.info("Superfamilies to run: {}".format(len(superfamilies)))
         map_job(job, process_superfamily, superfamilies, cathFileStoreID,
-            update_features=update_features, force=force)
+            update_features=update_features, force=force, use_chain_features=use_chain_features,
+            batch_time=batch_time, batch_cores=batch_cores)
 
     #Build Interactome
     #job.addChildJobFn()
 
-def start_toil(job, cathFileStoreID, cathcode=None, skip_cathcode=None, pdbs=None, update_features=None, use_hsds=True, work_dir=None, force=False):
+def start_toil(job, cathFileStoreID, cathcode=None, skip_cathcode=None, pdbs=None, update_features=None, use_hsds=True, work_dir=None, force=False,
+  use_chain_features=False, batch_time=None, batch_cores=1):
     RealtimeLogger.info("RUNN START")
     if work_dir is None:
         if job is not None and hasattr(job, "fileStore"):
@@ -313,7 +365,8 @@ def start_toil(job, cathFileStoreID, cathcode=None, skip_cathcode=None, pdbs=Non
 
     job.addFollowOnJobFn(start_domain_and_features, cathFileStoreID, cathcode=cathcode,
         skip_cathcode=skip_cathcode, update_features=update_features, use_hsds=use_hsds,
-        pdbs=pdbs, force=force)
+        pdbs=pdbs, force=force, use_chain_features=use_chain_features,
+        batch_time=batch_time, batch_cores=batch_cores)
 
 def str2boolorval(v):
     def is_num(a):
@@ -371,6 +424,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--work_dir",
         default=os.getcwd())
+    parser.add_argument(
+        "--chain_features",
+        action="store_true",
+        default=False,
+        help="Run DSSP, APBS and EPPIC once per PDB chain and share the results with every CATH domain on that chain")
+    parser.add_argument(
+        "--batch_time",
+        type=float,
+        default=None,
+        help="Group domains into jobs that are expected to run for this many seconds instead of one job per domain")
+    parser.add_argument(
+        "--batch_cores",
+        type=int,
+        default=1,
+        help="Number of cores used to run domains inside each batch. Only used with --batch_time")
     parser.add_argument("--hs_username", default=None, help="HSDS username. If not provided it will use hsinfo")
     parser.add_argument("--hs_password", default=None, help="HSDS username. If not provided it will use hsinfo")
     parser.add_argument("--hs_endpoint", default=None, help="HSDS username. If not provided it will use hsinfo")
@@ -440,7 +508,9 @@ if __name__ == "__main__":
                 cathFileStoreID = options.hsds_file
             job = Job.wrapJobFn(start_toil, cathFileStoreID, cathcode=options.cathcode,
                 skip_cathcode=options.skip_cathcode, pdbs=options.pdb, update_features=options.features,
-                use_hsds=not options.no_hsds, work_dir=options.work_dir, force=options.force)
+                use_hsds=not options.no_hsds, work_dir=options.work_dir, force=options.force,
+                use_chain_features=options.chain_features, batch_time=options.batch_time,
+                batch_cores=options.batch_cores)
             workflow.start(job)
         else:
             workflow.restart()
@@ -16,7 +16,8 @@ from botocore.exceptions import ClientError
 from Prop3D.util.iostore import IOStore
 from Prop3D.generate_data.job_utils import map_job
 from Prop3D.util.cath import run_cath_hierarchy, download_cath_domain
-from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks
+from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks, \
+    to_hdf_table, create_table_indexes
 
 from toil.realtimeLogger import RealtimeLogger
 
@@ -249,10 +250,8 @@ def create_small_description_file(job):
             "cathcode", "class", "architechture", "topology", "homology",
             "nsegments", "nseg", "srange_start", "srange_stop", "slength"]]
         cath_chunk = cath_chunk.assign(chunk=chunk_id)
-        cath_chunk.to_hdf(small_desc_file, "table",
-            format="table", table=True, mode="a", append=True,
-            complevel=9, complib="bzip2", min_itemsize=1024,
-            data_columns=["cath_domain", "cathcode"])
+        to_hdf_table(cath_chunk, small_desc_file, "table", mode="a", append=True,
+            index=False)
         del cath_chunk
 
         try:
@@ -260,6 +259,9 @@ def create_small_description_file(job):
         except OSError:
             pass
 
+    #Index once after all chunks are appended
+    create_table_indexes(small_desc_file, "table")
+
     in_store.write_output_file(small_desc_file, os.path.basename(small_desc_file))
 
 def start_toil(job, cathFileID, download_all=False, check=False, skip_ids=None):
@@ -1,4 +1,4 @@
-import os, sys
+import os
 import subprocess
 import shutil
 import gzip
@@ -32,9 +32,12 @@ from Prop3D.parsers.MODELLER import MODELLER
 from Prop3D.util.iostore import IOStore
 from Prop3D.util.toil import map_job
 from Prop3D.util.hdf import get_file
-from Prop3D.util import SubprocessChain, safe_remove
-from Prop3D.util.pdb import get_first_chain, get_all_chains, PDB_TOOLS, s3_download_pdb
+from Prop3D.util import safe_remove
+from Prop3D.util.pdb import get_first_chain, get_all_chains, s3_download_pdb
 from Prop3D.util.cath import download_cath_domain
+from Prop3D.pdb_tools.pipeline import pipeline
+from Prop3D.util.stages import stage, timed
+from Prop3D.util.cache import ArtifactCache
 
 from Prop3D.generate_data import data_stores
 
@@ -60,6 +63,7 @@ class PrepareProteinError(RuntimeError):
         store.write_output_file(fail_file, "errors/"+os.path.basename(fail_file))
         safe_remove(fail_file)
 
+@timed()
 def extract_domain(pdb_file, cath_domain, sfam_id, chain=None, rename_chain=None,
   striphet=True, rslices=None, work_dir=None):
     """Extract a domain from a protein structure and cleans the output to make
@@ -125,58 +129,38 @@ def extract_domain(pdb_file, cath_domain, sfam_id, chain=None, rename_chain=None
             raise RuntimeError("Error processing chains in PDB: {}".format(input))
 
 
-    commands = [
-        #Pick first model
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_selmodel.py"), "-1", input]
-    ]
-    prep_steps = ["pdb_selmodel.py -1 {}".format(input)]
+    #Pick first model
+    pipe = pipeline(input).selmodel(1)
 
     if chain in all_chains:
         #Select desired chain
-        commands.append([sys.executable, os.path.join(PDB_TOOLS, "pdb_selchain.py"), "-{}".format(chain)])
-        prep_steps.append("pdb_selchain.py -{}".format(chain))
+        pipe.selchain(chain)
     elif len(all_chains) == 1 and all_chains[0] == " ":
         #No chain specified, rechain
-        commands.append([sys.executable, os.path.join(PDB_TOOLS, "pdb_chain.py"), "-"+chain[:1]])
-        prep_steps.append( "pdb_chain.py -{}".format(chain[:1]))
+        pipe.chain(chain[:1])
     else:
         raise RuntimeError("Invalid PDB, chain specified ({}) not in chains ({})".format(chain, all_chains))
 
-    commands += [
-        #Remove altLocs
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_delocc.py")],
-        #Remove HETATMS
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_striphet.py")],
-    ]
-
-    prep_steps += ["pdb_delocc.py", "pdb_striphet.py"]
+    #Remove altLocs and HETATMS
+    pipe.delocc().striphet()
 
     if rslices is not None:
         #Slice up chain with given ranges
-        commands += [[sys.executable, os.path.join(PDB_TOOLS, "pdb_rslice.py")]+rslices]
-        prep_steps += ["pdb_rslice.py {}".format(" ".join(rslices))]
+        pipe.rslice(*rslices)
 
     #Make it tidy
-    commands += [[sys.executable, os.path.join(PDB_TOOLS, "pdb_tidy.py")]]
-    prep_steps += ["pdb_tidy.py"]
+    pipe.tidy()
 
     if rename_chain is not None and (isinstance(rename_chain, str) or \
       (isinstance(rename_chain, bool) and rename_chain)):
         #Rename chain to given name if set in arguments
+        pipe.chain("1" if isinstance(rename_chain, bool) else rename_chain)
 
-        if isinstance(rename_chain, bool) and rename_chain:
-            new_chain = "-1"
-        else:
-            new_chain = "-{}".format(rename_chain)
-
-        commands.append([sys.executable, os.path.join(PDB_TOOLS, "pdb_chain.py"),
-            new_chain])
-        prep_steps += ["pdb_chain.py {}".format(new_chain)]
+    prep_steps = ["{} {}".format(pipe.prep_steps[0], input)]+pipe.prep_steps[1:]
 
-    #Run all commands
+    #Run all steps in one pass
     print("Running", prep_steps)
-    with open(domain_file, "w") as output:
-        SubprocessChain(commands, output)
+    pipe.write(domain_file)
 
     #Make sure output domain_file is not empty
     with open(domain_file) as f:
@@ -188,8 +172,17 @@ def extract_domain(pdb_file, cath_domain, sfam_id, chain=None, rename_chain=None
 
     return domain_file, prep_steps
 
+def _run_prep_stage(cache, stage_name, func, input_file, params=None):
+    """Run one preparation stage, or copy its output from the artifact cache
+    if it has already been run on the same input"""
+    with stage(stage_name):
+        if cache is None:
+            return func(input_file)
+        return cache.run_stage(stage_name, func, input_file, params=params)
+
+@timed()
 def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
-  perform_cns_min=False, work_dir=None, job=None, cleanup=True):
+  perform_cns_min=False, work_dir=None, job=None, cleanup=True, cache=None):
     """Prepare a single domain for use in Prop3D. This method modifies a PDB
     file by adding hydrogens with PDB2PQR (ff=parse, ph=propka) and minimizing
     using rosetta (lbfgs_armijo_nonmonotone with tolerance 0.001). Finally,
@@ -204,6 +197,10 @@ def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
     pdb_file : str
         Path to PDB file of chain to prepare. Must not be gzipped or contain
         more than one chain.
+    cache : ArtifactCache or None
+        Cache for the output of each fixer, pdb2pqr and CNS so reruns on the
+        same input start after the last completed stage. Default is set from
+        the PROP3D_PREP_CACHE environment variable, or no cache if unset.
 
     Returns
     -------
@@ -235,6 +232,9 @@ def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
 
     prefix = pdb_file.split(".", 1)[0]
 
+    if cache is None:
+        cache = ArtifactCache.from_env()
+
     pdb2pqr = Pdb2pqr(work_dir=work_dir, job=job)
     scwrl = SCWRL(work_dir=work_dir, job=job).fix_rotamers
     modeller = MODELLER(work_dir=work_dir, job=job).remodel_structure
@@ -246,7 +246,11 @@ def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
         try:
             #If failed 1st time, add correct sidechain rotamers (SCWRL)
             #If failed 2nd time, turn CA models into full atom models (MODELLER)
-            fixed_pdb = fixer(pdb_file) if fixer is not None else pdb_file
+            if fixer is not None:
+                fixed_pdb = _run_prep_stage(cache, fixer.__self__.__class__.__name__,
+                    fixer, pdb_file)
+            else:
+                fixed_pdb = pdb_file
             if fixer is not None:
                 #Remove "fixed" pdb file at end
                 files_to_remove.append(fixed_pdb)
@@ -260,7 +264,9 @@ def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
 
         try:
             #Protonate PDB, Minimize structure, and assign partial charges
-            protonated_pdb = pdb2pqr.debump_add_h(fixed_pdb, ff="parse")
+            protonated_pdb = _run_prep_stage(cache, "pdb2pqr",
+                lambda f: pdb2pqr.debump_add_h(f, ff="parse"), fixed_pdb,
+                params={"ff":"parse"})
             break
         except Exception as error:
             #Failed, try again with different fixer
@@ -282,32 +288,27 @@ def prepare_domain(pdb_file, chain, cath_domain, sfam_id=None,
 
         #Perform CNS minimization
         minimize = CNSMinimize(work_dir=work_dir, job=job)
-        protonated_pdb = minimize(protonated_pdb)
+        protonated_pdb = _run_prep_stage(cache, "cns", minimize, protonated_pdb)
 
     #Remove pdb2pqr file (or CNS file) at end
     files_to_remove.append(protonated_pdb)
 
-    #Clean
-    commands = [
-        #Remove header
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_stripheader.py"), protonated_pdb],
-        #Rename chain to given chain
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_chain.py"), "-{}".format(chain)],
-        #Make it tidy
-        [sys.executable, os.path.join(PDB_TOOLS, "pdb_tidy.py")]
-    ]
+    #Clean: remove header, rename chain to given chain, and make it tidy
+    clean = pipeline(protonated_pdb).stripheader().chain(chain).tidy()
 
     cleaned_file = prefix+".pdb"
-    with open(cleaned_file, "w") as cleaned:
-        SubprocessChain(commands, cleaned)
+    with stage("clean"):
+        clean.write(cleaned_file)
 
     if cleanup:
         safe_remove(files_to_remove)
 
     prep_steps = [fixer.__class__.__name__.rsplit(".")[-1]] if fixer is not None \
         else []
-    prep_steps += ["pdb2pqr", "pdb_stripheader.py", "pdb_chain.py -{}".format(chain),
-        "pdb_tidy.py"]
+    prep_steps += ["pdb2pqr"]+clean.prep_steps
+
+    if cache is not None:
+        RealtimeLogger.info("Preparation cache stats: {}".format(cache.stats()))
 
     return cleaned_file, prep_steps
 
@@ -354,7 +355,8 @@ def _process_domain(job, cath_domain, cathcode, cathFileStoreID=None, force_chai
                 return None, None, None, False
 
             #Download cath domain from s3 bucket or cath api
-            domain_file = download_cath_domain(cath_domain, cathcode, work_dir=work_dir)
+            with stage("download"):
+                domain_file = download_cath_domain(cath_domain, cathcode, work_dir=work_dir)
             chain = cath_domain[4]
             if cathcode is not None:
                 files_to_remove.append(domain_file)
@@ -426,7 +428,8 @@ def _process_domain(job, cath_domain, cathcode, cathFileStoreID=None, force_chai
 
     if not local_file:
         #Write prepared domain file to store
-        data_stores.prepared_cath_structures.write_output_file(prepared_file, cath_key)
+        with stage("upload"):
+            data_stores.prepared_cath_structures.write_output_file(prepared_file, cath_key)
         files_to_remove.append(prepared_file)
     RealtimeLogger.info("Finished preparing domain: {}".format(domain_file))
 
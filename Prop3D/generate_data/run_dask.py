@@ -0,0 +1,253 @@
+"""Run feature generation with Dask instead of Toil.
+
+Domains are split into partitions that never mix superfamilies. Partitions
+are sized by estimated cost (domain_length from the CATH domain list, see
+util.toil.BatchCostEstimator). Each partition runs process_domain and then
+calculate_features for each of its domains on a dask worker, and the worker
+writes the features to HSDS directly. Only a small summary per domain comes
+back to the client. At most max_in_flight partitions are submitted at a
+time, so memory on the scheduler stays bounded. Work stealing between workers
+and the dashboard (http://localhost:8787) come from dask.distributed.
+
+With chain features, the chains that a partition needs are processed first
+(chain_features stage of run_local). Each chain is run once, in a task for
+the first partition that needs it, and every partition depends on the chain
+tasks of its domains.
+
+If dask.distributed is not installed, partitions run as a dask.bag on the
+multiprocessing scheduler (util.dask.setup_dask) instead.
+
+Example:
+
+    python -m Prop3D.generate_data.run_dask --hsds_file /home/user/cath.h5 \\
+        -c 1.10.8.10 2.30.30.100 --workers 32 --memory_limit 4GB
+"""
+import os
+from itertools import islice
+
+from toil.realtimeLogger import RealtimeLogger
+
+from Prop3D.util.toil import BatchCostEstimator, make_batches
+from Prop3D.util.dask import setup_dask, setup_dask_cluster
+from Prop3D.generate_data.main import get_domain_lengths
+from Prop3D.generate_data.run_local import run_stage, get_domains_to_run, STAGES
+from Prop3D.generate_data.calculate_chain_features import get_chain_key
+
+def partition_domains(cath_full_h5, domains, target_time=600, estimator=None):
+    """Group (cath_domain, superfamily) pairs into partitions of about target_time
+    seconds, keeping each superfamily separate
+
+    Returns
+    -------
+    List of partitions, each a list of (cath_domain, superfamily)
+    """
+    if estimator is None:
+        estimator = BatchCostEstimator()
+
+    by_superfamily = {}
+    for cath_domain, superfamily in domains:
+        by_superfamily.setdefault(superfamily, []).append(cath_domain)
+
+    partitions = []
+    for superfamily, cath_domains in by_superfamily.items():
+        domain_lengths = get_domain_lengths(cath_full_h5, superfamily, cath_domains)
+        #Longest first so the expensive domains are started early
+        cath_domains = sorted(cath_domains, key=lambda d: estimator.size(domain_lengths.get(d)),
+            reverse=True)
+        sizes = [estimator.size(domain_lengths.get(d)) for d in cath_domains]
+        for batch, _ in make_batches(cath_domains, sizes, estimator, target_time=target_time):
+            partitions.append([(d, superfamily) for d in batch])
+
+    return partitions
+
+def group_chains(partitions):
+    """Chains to process for each partition, each chain in the first partition
+    that needs it
+
+    Returns
+    -------
+    groups : list of lists of chain keys, one per partition
+    depends : list of lists, the partitions whose chain groups each partition needs
+    """
+    owner = {}
+    groups, depends = [], []
+    for i, partition in enumerate(partitions):
+        chains = sorted(set(get_chain_key(cath_domain) for cath_domain, _ in partition))
+        groups.append([c for c in chains if c not in owner])
+        owner.update((c, i) for c in groups[-1])
+        depends.append(sorted(set(owner[c] for c in chains)))
+    return groups, depends
+
+def run_chains(chain_keys, superfamily, cath_full_h5, work_dir, force=False):
+    """Run the chain_features stage for each chain key
+
+    Returns
+    -------
+    A list of (chain_key, superfamily, stage, runtime, error)
+    """
+    return [(chain_key, superfamily, "chain_features")+run_stage("chain_features", chain_key,
+        superfamily, cath_full_h5, work_dir, {"force": force}) for chain_key in chain_keys]
+
+def run_partition(partition, cath_full_h5, work_dir, stages=STAGES, feature_kwds=None,
+  chains=None):
+    """Run all stages for each domain in a partition on one worker. chains is
+    not used, it holds the chain tasks that must finish first
+
+    Returns
+    -------
+    A list of (cath_domain, superfamily, stage, runtime, error)
+    """
+    if feature_kwds is None:
+        feature_kwds = {}
+
+    results = []
+    for cath_domain, superfamily in partition:
+        for stage_name in stages:
+            runtime, error = run_stage(stage_name, cath_domain, superfamily, cath_full_h5,
+                work_dir, feature_kwds)
+            results.append((cath_domain, superfamily, stage_name, runtime, error))
+            if error is not None:
+                #Do not calculate features for a domain that could not be prepared
+                break
+    return results
+
+def run_dask(cath_full_h5, cathcode, work_dir=None, client=None, stages=STAGES,
+  target_time=600, max_in_flight=None, update_features=None, use_chain_features=False,
+  force=False, n_workers=None, memory_limit="auto"):
+    """Run the pipeline for superfamilies with Dask
+
+    Parameters
+    ----------
+    cath_full_h5 : str
+        Path to CATH HSDS file
+    cathcode : str or list
+        Superfamilies to run, e.g. 1.10.8.10
+    client : dask.distributed.Client
+        Existing client. If None, start a LocalCluster with n_workers and
+        memory_limit, or fall back to dask.bag if distributed is missing
+    target_time : float
+        Estimated seconds of work in each partition
+    max_in_flight : int
+        Maximum number of partitions submitted at once. Default is 2 per worker
+
+    Returns
+    -------
+    A list of (cath_domain, superfamily, stage, runtime, error)
+    """
+    if work_dir is None:
+        work_dir = os.getcwd()
+
+    if not isinstance(cathcode, (list, tuple)):
+        cathcode = [cathcode]
+    superfamilies = ["/".join(map(str, c)) if isinstance(c, (list, tuple)) else \
+        c.replace(".", "/") for c in cathcode]
+
+    domains = get_domains_to_run(cath_full_h5, superfamilies, force=force,
+        update_features=update_features)
+    partitions = partition_domains(cath_full_h5, domains, target_time=target_time)
+
+    feature_kwds = {"update_features": update_features,
+        "skip_completed": not force and update_features is None}
+    if use_chain_features:
+        feature_kwds["use_chain_features"] = True
+
+    if use_chain_features and "calculate_features" in stages:
+        chain_groups, chain_depends = group_chains(partitions)
+    else:
+        chain_groups, chain_depends = [[] for _ in partitions], [[] for _ in partitions]
+
+    RealtimeLogger.info("Running {} domains in {} partitions".format(len(domains), len(partitions)))
+
+    if client is None:
+        try:
+            client = setup_dask_cluster(n_workers=n_workers, memory_limit=memory_limit)
+        except ImportError:
+            client = None
+
+    if client is None:
+        import dask.bag as db
+        setup_dask(n_workers if n_workers is not None else os.cpu_count())
+        chain_results = []
+        chain_tasks = [(group, partition[0][1]) for group, partition in \
+            zip(chain_groups, partitions) if len(group) > 0]
+        if len(chain_tasks) > 0:
+            #All chains finish before any partition starts
+            chain_bag = db.from_sequence(chain_tasks, npartitions=len(chain_tasks))
+            chain_results = list(chain_bag.starmap(run_chains, cath_full_h5=cath_full_h5,
+                work_dir=work_dir, force=force).flatten().compute())
+        bag = db.from_sequence(partitions, npartitions=max(len(partitions), 1))
+        results = bag.map(run_partition, cath_full_h5, work_dir, stages=stages,
+            feature_kwds=feature_kwds).flatten().compute()
+        return chain_results+list(results)
+
+    from dask.distributed import as_completed
+
+    if max_in_flight is None:
+        max_in_flight = 2*max(len(client.scheduler_info()["workers"]), 1)
+
+    partitions = iter(enumerate(partitions))
+    chain_futures = {}
+
+    def submit(indexed_partition):
+        i, partition = indexed_partition
+        if len(chain_groups[i]) > 0:
+            chain_futures[i] = client.submit(run_chains, chain_groups[i], partition[0][1],
+                cath_full_h5, work_dir, force=force, pure=False)
+        #Partitions are submitted in order, so the chain tasks they need exist
+        chains = [chain_futures[j] for j in chain_depends[i]]
+        return client.submit(run_partition, partition, cath_full_h5, work_dir,
+            stages=stages, feature_kwds=feature_kwds, chains=chains, pure=False)
+
+    #Keep a bounded number of partitions submitted and add one as each finishes
+    futures = as_completed([submit(p) for p in islice(partitions, max_in_flight)])
+
+    results = []
+    for future in futures:
+        partition_results = future.result()
+        future.release()
+        results += partition_results
+
+        for cath_domain, superfamily, stage_name, runtime, error in partition_results:
+            if error is not None:
+                RealtimeLogger.info("{} failed for {}: {}".format(stage_name, cath_domain, error))
+
+        next_partition = next(partitions, None)
+        if next_partition is not None:
+            futures.add(submit(next_partition))
+
+    for chain_future in chain_futures.values():
+        chain_results = chain_future.result()
+        chain_future.release()
+        results += chain_results
+        for chain_key, superfamily, stage_name, runtime, error in chain_results:
+            if error is not None:
+                RealtimeLogger.info("{} failed for {}: {}".format(stage_name, chain_key, error))
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run Prop3D with Dask")
+    parser.add_argument("-c", "--cathcode", nargs="+", required=True)
+    parser.add_argument("--hsds_file", required=True)
+    parser.add_argument("--work_dir", default=os.getcwd())
+    parser.add_argument("--scheduler", default=None, help="Address of running dask scheduler")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory_limit", default="auto", help="Memory limit per worker")
+    parser.add_argument("--target_time", type=float, default=600)
+    parser.add_argument("--max_in_flight", type=int, default=None)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--features", nargs="+", default=None)
+    parser.add_argument("--chain_features", action="store_true", default=False)
+    parser.add_argument("--force", action="store_true", default=False)
+    args = parser.parse_args()
+
+    client = setup_dask_cluster(address=args.scheduler) if args.scheduler is not None else None
+
+    results = run_dask(args.hsds_file, args.cathcode, work_dir=args.work_dir, client=client,
+        stages=args.stages, target_time=args.target_time, max_in_flight=args.max_in_flight,
+        update_features=args.features, use_chain_features=args.chain_features,
+        force=args.force, n_workers=args.workers, memory_limit=args.memory_limit)
+
+    failed = [r for r in results if r[4] is not None]
+    print("Finished {} tasks, {} failed".format(len(results), len(failed)))
@@ -0,0 +1,377 @@
+"""Run the generate_data pipeline on a single machine without Toil.
+
+Domains are sent through two process pools, one per stage (process_domain ->
+calculate_features), each with its own core and memory limits. A domain is
+queued for feature calculation as soon as its structure is prepared. Only a
+few tasks per worker are submitted at a time; the rest wait in queues in the
+main process.
+
+With chain features, the chain of each domain is processed once
+(chain_features stage, in the features pool) before any of its domains are
+featurized, like precompute_chains in the Toil pipeline.
+
+Progress is saved in a SQLite ledger in the main process (chain_features
+tasks are recorded under their chain key, e.g. 1abc/A). A restarted run
+skips domains that the ledger marks as done and domains that the HSDS
+completion index marks as having all of their features.
+
+The stage functions still expect a Toil job as the first argument, so they
+get a LocalJob. Child and follow-on jobs run inline in the same worker.
+
+Example:
+
+    python -m Prop3D.generate_data.run_local --hsds_file /home/user/cath.h5 \\
+        -c 1.10.8.10 --process_domain_cores 16 --features_cores 48 \\
+        --features_memory 4G --ledger cath-run.sqlite
+"""
+import os
+import time
+import shutil
+import socket
+import sqlite3
+import tempfile
+import traceback
+from types import SimpleNamespace
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import h5pyd
+from toil.realtimeLogger import RealtimeLogger
+
+from Prop3D.util.toil import memory_to_bytes
+from Prop3D.util.stages import stage, stage_context
+from Prop3D.generate_data.prepare_protein import process_domain
+from Prop3D.generate_data.calculate_features_hsds import calculate_features
+from Prop3D.generate_data.set_cath_h5_toil import create_h5_hierarchy
+from Prop3D.generate_data.completion import get_domain_status, check_completed, ALL_FEATURES
+from Prop3D.generate_data.calculate_chain_features import get_chain_key, \
+    chain_features_exist, safe_calculate_chain_features
+
+TOIL_RESOURCE_KWDS = ("cores", "memory", "disk", "preemptable", "accelerators")
+
+STAGES = ("process_domain", "calculate_features")
+
+#Tasks submitted to a pool per worker, the rest are queued in the main process
+TASKS_PER_WORKER = 2
+
+class LocalFileStore(object):
+    """Subset of the Toil file store used by the stage functions. Global files
+    are plain local paths."""
+    def __init__(self, work_dir, job_store_name="local"):
+        self.work_dir = work_dir
+        self.jobStore = SimpleNamespace(config=SimpleNamespace(jobStore="file:"+job_store_name))
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.work_dir)
+
+    def getLocalTempFile(self):
+        fd, path = tempfile.mkstemp(dir=self.work_dir)
+        os.close(fd)
+        return path
+
+    def readGlobalFile(self, file_id, *args, **kwds):
+        return file_id
+
+    def writeGlobalFile(self, path, *args, **kwds):
+        return path
+
+    def deleteGlobalFile(self, file_id):
+        pass
+
+class LocalJob(object):
+    """Stands in for a Toil job. Child jobs are run right away and follow-ons
+    are run after the function that added them returns, so they still run
+    after all of the children."""
+    def __init__(self, work_dir, job_store_name="local"):
+        self.work_dir = work_dir
+        self.job_store_name = job_store_name
+        self.fileStore = LocalFileStore(work_dir, job_store_name)
+        self._follow_ons = []
+        self._rv = None
+
+    def rv(self):
+        return self._rv
+
+    def log(self, message):
+        RealtimeLogger.info(message)
+
+    def run(self, func, *args, **kwds):
+        for kwd in TOIL_RESOURCE_KWDS:
+            kwds.pop(kwd, None)
+        self._rv = func(self, *args, **kwds)
+        while len(self._follow_ons) > 0:
+            follow_on, follow_on_func, follow_on_args, follow_on_kwds = self._follow_ons.pop(0)
+            follow_on.run(follow_on_func, *follow_on_args, **follow_on_kwds)
+        return self._rv
+
+    def addChildJobFn(self, func, *args, **kwds):
+        child = LocalJob(self.work_dir, self.job_store_name)
+        child.run(func, *args, **kwds)
+        return child
+
+    def addFollowOnJobFn(self, func, *args, **kwds):
+        follow_on = LocalJob(self.work_dir, self.job_store_name)
+        self._follow_ons.append((follow_on, func, args, kwds))
+        return follow_on
+
+class Ledger(object):
+    """SQLite record of every task. Only the main process writes to it."""
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            stage TEXT, cath_domain TEXT, superfamily TEXT, status TEXT,
+            started REAL, finished REAL, runtime REAL, error TEXT, host TEXT,
+            PRIMARY KEY (stage, cath_domain))""")
+        self.conn.commit()
+
+    def done(self, stage_name):
+        return set(row[0] for row in self.conn.execute(
+            "SELECT cath_domain FROM tasks WHERE stage=? AND status='done'", (stage_name,)))
+
+    def start(self, stage_name, cath_domain, superfamily):
+        self.conn.execute("INSERT OR REPLACE INTO tasks VALUES (?,?,?,?,?,?,?,?,?)",
+            (stage_name, cath_domain, superfamily, "running", time.time(), None, None,
+             None, socket.gethostname()))
+        self.conn.commit()
+
+    def finish(self, stage_name, cath_domain, runtime, error=None):
+        self.conn.execute("UPDATE tasks SET status=?, finished=?, runtime=?, error=? " + \
+            "WHERE stage=? AND cath_domain=?", ("failed" if error is not None else "done",
+            time.time(), runtime, error, stage_name, cath_domain))
+        self.conn.commit()
+
+    def summary(self):
+        return list(self.conn.execute(
+            "SELECT stage, status, COUNT(*), SUM(runtime) FROM tasks GROUP BY stage, status"))
+
+    def close(self):
+        self.conn.close()
+
+def features_completed(cath_full_h5, cath_domain, superfamily):
+    """Check the completion index, or the domain group if the index does not
+    know (e.g. it was just created for a store that already had features)"""
+    with h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+        return check_completed(store, superfamily, cath_domain)
+
+def run_stage(stage_name, cath_domain, superfamily, cath_full_h5, work_dir, kwds):
+    """Run one stage for one domain in a worker process. Never raises, returns
+    (runtime, traceback or None)"""
+    start = time.time()
+    domain_work_dir = tempfile.mkdtemp(dir=work_dir, prefix="{}-".format(cath_domain))
+    job = LocalJob(domain_work_dir)
+    try:
+        with stage_context(cath_domain=cath_domain, superfamily=superfamily), stage(stage_name):
+            if stage_name == "process_domain":
+                job.run(process_domain, cath_domain, superfamily, cathFileStoreID=cath_full_h5,
+                    work_dir=domain_work_dir)
+            elif stage_name == "calculate_features":
+                kwds = dict(kwds)
+                if not kwds.pop("skip_completed", False) or \
+                  not features_completed(cath_full_h5, cath_domain, superfamily):
+                    job.run(calculate_features, cath_full_h5, cath_domain, superfamily,
+                        work_dir=domain_work_dir, **kwds)
+            elif stage_name == "chain_features":
+                #cath_domain is a chain key
+                if kwds.get("force", False) or not chain_features_exist(cath_domain):
+                    job.run(safe_calculate_chain_features, cath_domain, **kwds)
+            else:
+                raise ValueError("Unknown stage {}".format(stage_name))
+        error = None
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        error = traceback.format_exc()
+    finally:
+        shutil.rmtree(domain_work_dir, ignore_errors=True)
+    return time.time()-start, error
+
+def get_stage_workers(cores, memory=None):
+    """Number of workers for a stage so cores and memory per worker both fit"""
+    cores = cores if cores is not None else os.cpu_count()
+    if memory is None:
+        return max(int(cores), 1)
+    total_memory = os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    return max(min(int(cores), int(total_memory//memory_to_bytes(memory))), 1)
+
+def get_domains_to_run(cath_full_h5, superfamilies, force=False, update_features=None):
+    """List domains in each superfamily and remove completed domains using the
+    completion index
+
+    Returns
+    -------
+    List of (cath_domain, superfamily)
+    """
+    domains = []
+    with h5pyd.File(cath_full_h5, mode="a", use_cache=False, retries=100) as store:
+        for superfamily in superfamilies:
+            #Also adds domains that are missing from the index
+            status = get_domain_status(store, superfamily)
+            if not force and update_features is None:
+                status = status[(status["status"].astype(int) & ALL_FEATURES) != ALL_FEATURES]
+            domains += [(d, superfamily) for d in status["cath_domain"]]
+    return domains
+
+def run_local(cath_full_h5, cathcode, work_dir=None, ledger=None, stages=STAGES,
+  process_domain_cores=None, process_domain_memory=None, features_cores=None,
+  features_memory=None, update_features=None, use_chain_features=False, force=False,
+  create_hierarchy=False):
+    """Run the pipeline for superfamilies with local process pools
+
+    Parameters
+    ----------
+    cath_full_h5 : str
+        Path to CATH HSDS file
+    cathcode : str or list
+        Superfamilies to run, e.g. 1.10.8.10
+    ledger : str
+        Path to SQLite ledger. Default is prop3d-ledger.sqlite in work_dir
+    stages : list
+        Stages to run: process_domain and/or calculate_features
+    process_domain_cores, features_cores : int
+        Maximum number of workers for each stage. Default is all cores
+    process_domain_memory, features_memory : str or int
+        Memory needed by one worker of each stage (e.g. '4G'). Limits the
+        number of workers to fit in the memory of this machine
+    use_chain_features : bool
+        Calculate DSSP, APBS and EPPIC once per chain before featurizing its
+        domains
+    create_hierarchy : bool
+        Create the CATH hierarchy, domain list and splits in the HSDS file first
+
+    Returns
+    -------
+    Ledger summary as (stage, status, count, total runtime)
+    """
+    if work_dir is None:
+        work_dir = os.getcwd()
+
+    if not isinstance(cathcode, (list, tuple)):
+        cathcode = [cathcode]
+    superfamilies = ["/".join(map(str, c)) if isinstance(c, (list, tuple)) else \
+        c.replace(".", "/") for c in cathcode]
+
+    if create_hierarchy:
+        LocalJob(work_dir).run(create_h5_hierarchy, cath_full_h5,
+            cathcode=superfamilies, work_dir=work_dir, force=force)
+
+    ledger = Ledger(ledger if ledger is not None else os.path.join(work_dir, "prop3d-ledger.sqlite"))
+
+    domains = get_domains_to_run(cath_full_h5, superfamilies, force=force,
+        update_features=update_features)
+
+    feature_kwds = {"update_features": update_features,
+        "skip_completed": not force and update_features is None}
+    if use_chain_features:
+        feature_kwds["use_chain_features"] = True
+    stage_kwds = {"process_domain": {}, "calculate_features": feature_kwds,
+        "chain_features": {"force": force}}
+
+    run_prepare = "process_domain" in stages
+    run_features = "calculate_features" in stages
+
+    prepared = ledger.done("process_domain") if not force else set()
+    featurized = ledger.done("calculate_features") if not force and update_features is None else set()
+    chains_done = ledger.done("chain_features") if not force else set()
+
+    RealtimeLogger.info("Running {} domains from {} superfamilies".format(len(domains), len(superfamilies)))
+
+    workers = {
+        "prepare": get_stage_workers(process_domain_cores, process_domain_memory),
+        "features": get_stage_workers(features_cores, features_memory)
+    }
+    pools = {name: ProcessPoolExecutor(n) for name, n in workers.items()}
+    stage_pool = {"process_domain": "prepare", "calculate_features": "features",
+        "chain_features": "features"}
+    in_flight = {name: 0 for name in pools}
+
+    #Chain features go first so the domains waiting on them can start
+    pending = {"chain_features": deque(), "calculate_features": deque(), "process_domain": deque()}
+    waiting = defaultdict(list)
+    futures = {}
+
+    def queue_features(cath_domain, superfamily):
+        if use_chain_features:
+            chain_key = get_chain_key(cath_domain)
+            if chain_key not in chains_done:
+                if chain_key not in waiting:
+                    pending["chain_features"].append((chain_key, superfamily))
+                waiting[chain_key].append((cath_domain, superfamily))
+                return
+        pending["calculate_features"].append((cath_domain, superfamily))
+
+    def submit_pending():
+        for stage_name, queue in pending.items():
+            pool = stage_pool[stage_name]
+            while len(queue) > 0 and in_flight[pool] < workers[pool]*TASKS_PER_WORKER:
+                cath_domain, superfamily = queue.popleft()
+                ledger.start(stage_name, cath_domain, superfamily)
+                future = pools[pool].submit(run_stage, stage_name, cath_domain, superfamily,
+                    cath_full_h5, work_dir, stage_kwds[stage_name])
+                futures[future] = (stage_name, cath_domain, superfamily)
+                in_flight[pool] += 1
+
+    try:
+        for cath_domain, superfamily in domains:
+            if run_prepare and cath_domain not in prepared:
+                pending["process_domain"].append((cath_domain, superfamily))
+            elif run_features and cath_domain not in featurized:
+                queue_features(cath_domain, superfamily)
+
+        submit_pending()
+        while len(futures) > 0:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage_name, cath_domain, superfamily = futures.pop(future)
+                in_flight[stage_pool[stage_name]] -= 1
+                runtime, error = future.result()
+                ledger.finish(stage_name, cath_domain, runtime, error)
+
+                if error is not None:
+                    RealtimeLogger.info("{} failed for {}: {}".format(stage_name, cath_domain, error))
+
+                if stage_name == "chain_features":
+                    #Domains run the tools themselves if the chain failed
+                    chains_done.add(cath_domain)
+                    pending["calculate_features"].extend(waiting.pop(cath_domain, []))
+                elif error is None and stage_name == "process_domain" and run_features and \
+                  cath_domain not in featurized:
+                    queue_features(cath_domain, superfamily)
+            submit_pending()
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+
+    summary = ledger.summary()
+    ledger.close()
+
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run Prop3D on one machine without Toil")
+    parser.add_argument("-c", "--cathcode", nargs="+", required=True)
+    parser.add_argument("--hsds_file", required=True)
+    parser.add_argument("--work_dir", default=os.getcwd())
+    parser.add_argument("--ledger", default=None)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--process_domain_cores", type=int, default=None)
+    parser.add_argument("--process_domain_memory", default=None)
+    parser.add_argument("--features_cores", type=int, default=None)
+    parser.add_argument("--features_memory", default=None)
+    parser.add_argument("--features", nargs="+", default=None)
+    parser.add_argument("--chain_features", action="store_true", default=False)
+    parser.add_argument("--create_hierarchy", action="store_true", default=False)
+    parser.add_argument("--force", action="store_true", default=False)
+    args = parser.parse_args()
+
+    summary = run_local(args.hsds_file, args.cathcode, work_dir=args.work_dir,
+        ledger=args.ledger, stages=args.stages,
+        process_domain_cores=args.process_domain_cores,
+        process_domain_memory=args.process_domain_memory,
+        features_cores=args.features_cores, features_memory=args.features_memory,
+        update_features=args.features, use_chain_features=args.chain_features,
+        force=args.force, create_hierarchy=args.create_hierarchy)
+
+    for stage_name, status, n, runtime in summary:
+        print("{}\t{}\t{}\t{:.1f}s".format(stage_name, status, n, runtime or 0))
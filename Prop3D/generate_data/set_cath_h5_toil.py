@@ -11,6 +11,7 @@ from joblib import Parallel, delayed
 from toil.realtimeLogger import RealtimeLogger
 
 from Prop3D.util.toil import map_job
+from Prop3D.generate_data.completion import update_completion_index
 
 try:
     import h5pyd as h5py
@@ -148,8 +149,15 @@ def process_cath_domain_list_for_group(job, group, cath_full_h5):
     with h5py.File(cath_full_h5, mode="a", use_cache=False) as store:
         for _, row in group_df.iterrows():
             group = store.require_group(f"{row.h5_key}/domains/{row.cath_domain}")
-            group.domain_length = row.domain_length
-            group.resolution = row.resolution
+            group.attrs["domain_length"] = row.domain_length
+            group.attrs["resolution"] = row.resolution
+
+def update_completion_index_for_superfamily(job, superfamily, cath_full_h5):
+    """Add the domains of a superfamily to its completion index once all
+    groups are written. Groups can share a superfamily, so they do not write
+    the index themselves. Rerunning keeps the bits of indexed domains"""
+    with h5py.File(cath_full_h5, mode="a", use_cache=False) as store:
+        update_completion_index(store, superfamily)
 
 def process_cath_domain_list(job, cath_full_h5, cathcode=None, skip_cathcode=None, force=False, work_dir=None):
     if work_dir is None:
@@ -211,6 +219,9 @@ def process_cath_domain_list(job, cath_full_h5, cathcode=None, skip_cathcode=Non
         groups = [g for g in names.groupby("group")]
         map_job(job, process_cath_domain_list_for_group, groups, cath_full_h5)
 
+        job.addFollowOnJobFn(map_job, update_completion_index_for_superfamily,
+            sorted(names["h5_key"].drop_duplicates()), cath_full_h5)
+
         job.addFollowOnJobFn(finish_section, cath_full_h5, "completed_domain_list")
 
     #Create splits
@@ -1,3 +1,7 @@
+import os
+
+import numpy as np
+
 #import os, sys
 
 #import shutil
@@ -12,12 +16,14 @@ from Prop3D.parsers.container import Container
 from Prop3D.parsers.apbs import APBS
 from Prop3D.parsers.pdb2pqr import Pdb2pqr, MissingAtomsError
 from Prop3D.parsers.multivalue import Multivalue
+from Prop3D.parsers.dx import DXGrid
 
 class Electrostatics(object):
     def __init__(self, *args, **kwds):
         self.pdb2pqr = Pdb2pqr(*args, **kwds)
         self.apbs = APBS(*args, **kwds)
         self.multivalue = Multivalue(*args, **kwds)
+        self._dx_grids = {}
 
     def __call__(self, *args, **kwds):
         raise RuntimeError("Electostatics cannot be called. It is a pseudo-container for: Pdb2Pqr, APBS, and Mutivalue")
@@ -51,25 +57,41 @@ class Electrostatics(object):
         dx_file = self.apbs.atom_potentials_from_pdb(pdb_file, force_field=force_field, with_charge=with_charge, **kwds)
         return self.compute_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file)
 
-    def get_electrostatics_at_coordinates_from_pdb(self, coordinates, pdb_file, out_file=None, force_field="amber", with_charge=True, **kwds):
+    def get_electrostatics_at_coordinates_from_pdb(self, coordinates, pdb_file, out_file=None, force_field="amber", with_charge=True,
+      use_container=False, **kwds):
         dx_file = self.apbs.atom_potentials_from_pdb(pdb_file, force_field=force_field, with_charge=with_charge, **kwds)
-        return self.get_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file)
+        return self.get_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file,
+            use_container=use_container)
 
     ##Multivalue from pqr
     def compute_electrostatics_at_coordinates_from_pqr(self, coordinates, pqr_file, out_file=None):
         dx_file = self.apbs.atom_potentials_from_pqr(pqr_file)
         return self.compute_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file)
 
-    def get_electrostatics_at_coordinates_from_pqr(self, coordinates, pqr_file, out_file=None):
+    def get_electrostatics_at_coordinates_from_pqr(self, coordinates, pqr_file, out_file=None, use_container=False):
         dx_file = self.apbs.atom_potentials_from_pqr(pqr_file)
-        return self.get_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file)
+        return self.get_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file,
+            use_container=use_container)
 
     ##Multivalue from dx
     def compute_electrostatics_at_coordinates_from_dx(self, coordinates, dx_file, out_file=None):
         return self.multivalue.compute_electrostatics_at_coordinates_from_dx(coordinates, dx_file, out_file=out_file)
 
-    def get_electrostatics_at_coordinates_from_dx(self, coordinates, dx_file, out_file=None):
-        return self.multivalue.get_electrostatics_at_coordinates(coordinates, dx_file, out_file=out_file)
+    def get_electrostatics_at_coordinates_from_dx(self, coordinates, dx_file, out_file=None, use_container=False):
+        """Potentials at each coordinate. Interpolated in process from the dx
+        grid unless use_container is set, which runs multivalue instead"""
+        if not use_container:
+            if isinstance(coordinates, str) and os.path.isfile(coordinates):
+                coordinates = np.loadtxt(coordinates, delimiter=",", usecols=(0,1,2), ndmin=2)
+            return self.get_dx_grid(dx_file).interpolate(coordinates)
+        return self.multivalue.get_electrostatics_at_coordinates(coordinates, dx_file, out_file=out_file,
+            use_container=True)
+
+    def get_dx_grid(self, dx_file):
+        """Parsed potential grid, reused for every call with the same dx_file"""
+        if dx_file not in self._dx_grids:
+            self._dx_grids[dx_file] = DXGrid.from_file(dx_file)
+        return self._dx_grids[dx_file]
 
 class _APBS(Container):
     IMAGE = 'docker://edraizen/apbs:latest'
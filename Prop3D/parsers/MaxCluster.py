@@ -7,6 +7,7 @@ import multiprocessing
 from io import StringIO
 
 from joblib import Parallel, delayed
+import numpy as np
 import pandas as pd
 
 from Prop3D.parsers.container import Container
@@ -15,6 +16,7 @@ from Prop3D.util import safe_remove
 from Prop3D.util.toil import partitions, map_job, map_job_rv, map_job_rv_list, loop_job_rv
 from Prop3D.util.iostore import IOStore
 from Prop3D.util.hdf import get_file
+from Prop3D.util.distance_matrix import CondensedDistanceMatrix, structure_name
 
 from toil.fileStores import FileID
 from toil.realtimeLogger import RealtimeLogger
@@ -185,33 +187,43 @@ def _one_vs_all(job, exp_pdb, file_list, *args, distance="auto", num_partition=N
     #
     #     del store, key, errfile
 
-def cluster_from_distances(job, pdbs, C=1, P=10, work_dir=None, intermediate_file_store=None, cores=20, memory="72G", **kwds):
+def cluster_from_distances(job, pdbs, C=1, P=10, work_dir=None, intermediate_file_store=None, cores=20, memory="72G", distance_column="RMSD", **kwds):
     if work_dir is None:
         work_dir = job.fileStore.getLocalTempDir()
 
-    distances = None
-    for pdb in pdbs[:-1]:
-        distance_file = os.path.join(work_dir, f"{os.path.splitext(os.path.basename(pdb))[0]}.dist")
-        df = pd.read_csv(distance_file)
-        if distances is None:
-            distances = df
-        else:
-            distances = pd.concat((distances,df), axis=0)
+    if not isinstance(pdbs, (list, tuple)):
+        pdbs_file = get_file(job, "file_list", pdbs, work_dir=work_dir, cache=True)
+        with open(pdbs_file) as fh:
+            pdbs = [pdb.rstrip() for pdb in fh]
 
-    all_dist = os.path.join(work_dir, "all_distances.csv")
-    distances.to_csv(all_dist)
+    #Stream the one vs all tables into a condensed matrix instead of
+    #concatenating them
+    matrix_path = os.path.join(work_dir, "all_distances")
+    matrix = CondensedDistanceMatrix.open_or_create(matrix_path, [structure_name(pdb) for pdb in pdbs])
+    distance_files = [os.path.join(work_dir, f"{structure_name(pdb)}.dist") for pdb in pdbs[:-1]]
+    matrix.fill_from_tables([f for f in distance_files if os.path.isfile(f)],
+        "PDB1", "PDB2", distance_column)
+    matrix.flush()
 
     if C==0:
-        return all_dist
+        return matrix_path
+
+    all_dist = os.path.join(work_dir, "all_distances.dist")
+    with open(all_dist, "w") as fh:
+        make_distance_file_from_matrix(matrix, pdbs, fh)
 
     mc = MaxCluster(job=job, work_dir=work_dir, intermediate_file_store=intermediate_file_store)
-    return mc.cluster_from_distances(file_list, distances, C=C, P=P, **kwds)
+    return mc.cluster_from_distances(pdbs, all_dist, C=C, P=P, **kwds)
 
 class MaxCluster(Container):
     IMAGE = 'docker://edraizen/maxcluster:latest'
     RULES = {"make_file_list": "make_file_list"}
     ARG_START = "-"
     ENTRYPOINT = "/opt/maxcluster/maxcluster"
+
+    #Column of the log used as the distance by compare_block
+    DISTANCE = "TM"
+
     PARAMETERS = [
         #Structure Comparison
         (":l", "make_file_list"),
@@ -631,6 +643,33 @@ class MaxCluster(Container):
     def one_vs_one(self, exp_pdb, ref_pdb, **kwds):
         pass
 
+    def compare_block(self, moving_pdbs, fixed_pdbs, distance=None, **kwds):
+        """Yield (moving, fixed, value of distance) for every pair in a tile
+        (see superpose.tiles), comparing each moving structure to the list of
+        fixed structures in one run. distance is a column of the log, e.g.
+        TM, MaxSub or RMSD (default DISTANCE)"""
+        distance = distance if distance is not None else self.DISTANCE
+        use_rmsd = kwds.get("rmsd", False)
+        same = list(moving_pdbs) == list(fixed_pdbs)
+        for i, moving_pdb in enumerate(moving_pdbs):
+            fixed = list(fixed_pdbs[i+1:] if same else fixed_pdbs)
+            if len(fixed) == 0:
+                continue
+            self(e=moving_pdb, l=fixed, log=True, **kwds)
+            for groups in self._iter_distances(self.log_file, use_rmsd=use_rmsd):
+                yield groups["PDB1"], groups["PDB2"], float(groups[distance])
+            safe_remove(self.log_file)
+
+    def update_clusters(self, file_list, prefix, threshold=None, distance=None, store=None, **kwds):
+        """Assign new structures in file_list to the clusters saved under
+        prefix in store (default intermediate_file_store), or cluster
+        everything if there are no saved clusters. See
+        superpose.incremental.update_clusters"""
+        from Prop3D.parsers.superpose.incremental import update_clusters
+        store = store if store is not None else self.intermediate_file_store
+        return update_clusters(self, file_list, store, prefix, threshold=threshold,
+            distance=distance, work_dir=self.work_dir, **kwds)
+
     def cluster_from_distances(self, file_list, distance_file, C=1, P=10, distributed=False, **kwds):
         # if isinstance(distance_file, (list, tuple)):
         #     #Flatten promised return values
@@ -681,30 +720,36 @@ class MaxCluster(Container):
         return self(**kwds)
 
     @staticmethod
-    def get_distances(log_file, file_list, use_rmsd=False):
+    def _iter_distances(log_file, use_rmsd=False):
+        """Yield the fields of each comparison in a MaxCluster log as a dict"""
         if use_rmsd:
             pdbs_file_and_dist_re = re.compile("^INFO  : \d+\. (?P<PDB1>.+) vs. (?P<PDB2>.+)  RMSD=(?P<RMSD>[ \d\.]+) (Pairs=(?P<Pairs>.+), rRMSD=(?P<rRMSD>[\d\.]+) ((?P<rRMSD_Zscore>[ \d\.]+))), URMSD=(?P<URMSD>[ \d\.]+) (rURMSD=(?P<rURMSD>[ \d\.]+))")
-            dist_cols = ["PDB1", "PDB2", "RMSD", "Pairs", "rRMSD", "rRMSD_Zscore", "URMSD", "rURMSD"]
         else:
             pdbs_file_and_dist_re = re.compile("^INFO  : \d+\. (?P<PDB1>.+) vs. (?P<PDB2>.+)  Pairs=(?P<Pairs>.+), RMSD=(?P<RMSD>[ \d\.]+), MaxSub=(?P<MaxSub>[ \d\.]+), TM=(?P<TM>[ \d\.]+), MSI=(?P<MSI>[ \d\.]+)")
-            dist_cols = ["PDB1", "PDB2", "Pairs", "RMSD", "MaxSub", "TM", "MSI"]
 
-        results = []
         with open(log_file) as log:
-            for i, line in enumerate(log):
+            for line in log:
                 m = pdbs_file_and_dist_re.match(line)
                 if m:
                     groups = m.groupdict()
-                    groups["PDB1"] = os.path.splitext(os.path.basename(groups["PDB1"].rstrip()))[0]
-                    groups["PDB2"] = os.path.splitext(os.path.basename(groups["PDB2"].rstrip()))[0]
-                    results.append([groups[k].strip() if isinstance(groups[k], str) \
-                        else groups[k] for k in dist_cols])
+                    groups["PDB1"] = structure_name(groups["PDB1"])
+                    groups["PDB2"] = structure_name(groups["PDB2"])
+                    yield {k: v.strip() if isinstance(v, str) else v for k, v in groups.items()}
+
+    @staticmethod
+    def get_distances(log_file, file_list, use_rmsd=False):
+        if use_rmsd:
+            dist_cols = ["PDB1", "PDB2", "RMSD", "Pairs", "rRMSD", "rRMSD_Zscore", "URMSD", "rURMSD"]
+        else:
+            dist_cols = ["PDB1", "PDB2", "Pairs", "RMSD", "MaxSub", "TM", "MSI"]
+
+        results = [[groups[k] for k in dist_cols] for groups in \
+            MaxCluster._iter_distances(log_file, use_rmsd=use_rmsd)]
 
         distances = pd.DataFrame(results, columns=dist_cols)
 
         return distances
 
-
     @classmethod
     def get_centroid(cls, log_file=None):
         if hasattr(cls.log_file):
@@ -777,32 +822,80 @@ class MaxCluster(Container):
         return clusters
 
     @classmethod
-    def get_distances_from_dist_file(cls, distance_file=None):
+    def _distance_file(cls, distance_file=None):
         if hasattr(cls, "return_files") and isinstance(cls.return_files, dict) and cls.return_files.get("R"):
             distance_file = cls.return_files["R"]
         if distance_file is None:
-            raise RuntimeError("Invalid log file")
+            raise RuntimeError("Invalid distance file")
+        return distance_file
 
-        distances = []
-        parse_distances = False
+    @staticmethod
+    def _iter_dist_records(distance_file):
+        """Yield (item1, item2, distance) for each DIST record of a MaxCluster
+        distance file (-R)"""
         with open(distance_file) as dist:
             for line in dist:
-                if not parse_distances and "# Distance records" in line:
-                    parse_distances = True
-                    next(dist)
-                    next(dist)
-                elif parse_distances:
+                if line.startswith("DIST"):
                     #DIST :     79     82  1000.0000
-                    fields = line.rstrip().split()
-                    item1, item2, distance = fields[-3:]
-                    distances.append((int(item1), int(item2), float(distance)))
-                    distances.append((int(item2), int(item1), float(distance)))
+                    item1, item2, distance = line.rstrip().split()[-3:]
+                    yield int(item1), int(item2), float(distance)
 
-            distances = pd.DataFrame(distances, columns=["item1", "item2", "distances"])
-            distances = distances.set_index(["item1", "item2"])
+    @classmethod
+    def get_distances_from_dist_file(cls, distance_file=None):
+        """Distances in a MaxCluster distance file (-R) in both directions,
+        indexed by (item1, item2). Use get_distance_matrix for large files"""
+        distance_file = cls._distance_file(distance_file)
 
-            return distances
+        distances = [pair for item1, item2, distance in cls._iter_dist_records(distance_file) \
+            for pair in ((item1, item2, distance), (item2, item1, distance))]
+        distances = pd.DataFrame(distances, columns=["item1", "item2", "distances"])
+        distances = distances.set_index(["item1", "item2"])
 
+        return distances
+
+    @classmethod
+    def get_distance_matrix(cls, matrix_path, distance_file=None, file_list=None, first_item=1):
+        """Read a MaxCluster distance file (-R) into a CondensedDistanceMatrix
+        one line at a time
+
+        Parameters
+        ----------
+        matrix_path : str
+            Directory of the new matrix
+        file_list : list of str
+            Structures in the order MaxCluster numbered them, only needed if
+            the file has no PDB records
+        first_item : int
+            Number of the first structure if file_list is used
+
+        Returns
+        -------
+        CondensedDistanceMatrix
+        """
+        distance_file = cls._distance_file(distance_file)
+
+        #PDB records come before the distance records
+        items = {}
+        with open(distance_file) as dist:
+            for line in dist:
+                if line.startswith("PDB"):
+                    _, _, item, pdb = line.rstrip().split(None, 3)
+                    items[int(item)] = structure_name(pdb)
+                elif line.startswith("DIST"):
+                    break
+
+        if len(items) == 0:
+            if file_list is None:
+                raise RuntimeError("{} has no PDB records, file_list is required".format(distance_file))
+            items = {first_item+i: structure_name(pdb) for i, pdb in enumerate(file_list)}
+
+        matrix = CondensedDistanceMatrix.create(matrix_path, list(items.values()))
+
+        matrix.fill_from_pairs(((items[item1], items[item2], distance) for item1, item2, distance \
+            in cls._iter_dist_records(distance_file)), normalize=False)
+        matrix.flush()
+
+        return matrix
 
     @classmethod
     def get_hierarchical_tree(cls, log_file=None):
@@ -987,6 +1080,18 @@ def make_distance_file(distances, file_list, fh, header=True, entries=True):
             print("DIST : {0: >6} {1: >6} {2}".format(row.PDB1,
                 row.PDB2, row.RMSD), file=fh)
 
+def make_distance_file_from_matrix(matrix, file_list, fh):
+    """Write a CondensedDistanceMatrix as a MaxCluster distance file (-M), one
+    row at a time. Missing pairs are skipped"""
+    make_distance_file(None, file_list, fh, header=True, entries=False)
+    for i in range(len(matrix)-1):
+        start = matrix.condensed_index(i, i+1)
+        row = np.asarray(matrix.distances[start:start+len(matrix)-i-1])
+        lines = ["DIST : {0: >6} {1: >6} {2}".format(i, i+1+j, row[j]) \
+            for j in np.flatnonzero(~np.isnan(row))]
+        if len(lines) > 0:
+            print("\n".join(lines), file=fh)
+
 def parallel_cluster():
     kwds["M"] = make_distance_file()
     run_maxcluster(*args, **kwds)
@@ -0,0 +1,167 @@
+import os
+import json
+
+import numpy as np
+
+class DXGrid(object):
+    """Potential grid from an OpenDX file (e.g. APBS 'write pot dx') that can be
+    evaluated at many coordinates at once with trilinear interpolation. This
+    replaces writing a coordinate file and running the multivalue container.
+
+    The parsed grid can be saved next to the dx file (see save/load) so the
+    text file only has to be parsed once per domain. Saved grids are
+    memory-mapped when loaded.
+
+    Parameters
+    ----------
+    origin : 3-vector
+        Cartesian coordinates of the first grid point
+    delta : 3-vector
+        Grid spacing along x, y, and z
+    data : array (nx, ny, nz)
+        Values at each grid point
+    """
+    def __init__(self, origin, delta, data):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.delta = np.asarray(delta, dtype=np.float64)
+        self.data = data
+        self.shape = np.array(data.shape)
+
+    @classmethod
+    def from_file(cls, dx_file, cache=True):
+        """Read a dx file, or the saved grid if it has been parsed before.
+
+        Parameters
+        ----------
+        dx_file : str
+            Path to OpenDX file
+        cache : bool
+            Save the parsed grid next to dx_file and use it in later calls.
+            Default True.
+        """
+        if cache and os.path.isfile(cls.cache_files(dx_file)[1]) and \
+          os.path.getmtime(cls.cache_files(dx_file)[1]) >= os.path.getmtime(dx_file):
+            return cls.load(dx_file)
+
+        grid = cls.parse(dx_file)
+
+        if cache:
+            try:
+                grid.save(dx_file)
+            except OSError:
+                pass
+
+        return grid
+
+    @classmethod
+    def parse(cls, dx_file):
+        counts = None
+        origin = None
+        deltas = []
+        values = []
+        n_items = None
+
+        with open(dx_file) as f:
+            for line in f:
+                if line.startswith("#") or line.strip() == "":
+                    continue
+                fields = line.split()
+                if line.startswith("object") and "gridpositions" in line:
+                    counts = tuple(map(int, fields[-3:]))
+                elif fields[0] == "origin":
+                    origin = list(map(float, fields[1:4]))
+                elif fields[0] == "delta":
+                    deltas.append(list(map(float, fields[1:4])))
+                elif line.startswith("object") and "data follows" in line:
+                    n_items = int(fields[fields.index("items")+1])
+                    break
+
+            #Values are written in rows of 3, read them all at once
+            for line in f:
+                if line.startswith("attribute") or line.startswith("object"):
+                    break
+                values.append(line)
+
+        if counts is None or origin is None or len(deltas) != 3 or n_items is None:
+            raise RuntimeError("Invalid OpenDX file: {}".format(dx_file))
+
+        deltas = np.array(deltas)
+        if not np.allclose(deltas, np.diag(np.diag(deltas))):
+            raise RuntimeError("Only axis-aligned OpenDX grids are supported: {}".format(dx_file))
+
+        data = np.array(" ".join(values).split(), dtype=np.float64)
+        if data.size != n_items or n_items != np.prod(counts):
+            raise RuntimeError("Invalid OpenDX file, expected {} values but found {}: {}".format(
+                n_items, data.size, dx_file))
+
+        #z changes fastest, x slowest
+        return cls(origin, np.diag(deltas), data.reshape(counts))
+
+    @staticmethod
+    def cache_files(dx_file):
+        base = os.path.splitext(dx_file)[0]
+        return base+".grid.json", base+".grid.npy"
+
+    def save(self, dx_file):
+        header_file, data_file = self.cache_files(dx_file)
+        np.save(data_file, np.ascontiguousarray(self.data))
+        with open(header_file, "w") as f:
+            json.dump({"origin":self.origin.tolist(), "delta":self.delta.tolist()}, f)
+        return header_file, data_file
+
+    @classmethod
+    def load(cls, dx_file, mmap_mode="r"):
+        header_file, data_file = cls.cache_files(dx_file)
+        with open(header_file) as f:
+            header = json.load(f)
+        data = np.load(data_file, mmap_mode=mmap_mode)
+        return cls(header["origin"], header["delta"], data)
+
+    def interpolate(self, coordinates, fill_value=np.nan):
+        """Trilinear interpolation of the grid at N points in one call.
+
+        Parameters
+        ----------
+        coordinates : array-like (N, 3)
+            Cartesian coordinates
+        fill_value : float
+            Value for points outside of the grid. Default NaN.
+
+        Returns
+        -------
+        An array of N values
+        """
+        coordinates = np.atleast_2d(np.asarray(coordinates, dtype=np.float64))
+        idx = (coordinates-self.origin)/self.delta
+
+        outside = np.any((idx < 0) | (idx > self.shape-1), axis=1)
+
+        #Clip so points on the upper edges use the last cell
+        i0 = np.clip(np.floor(idx).astype(np.int64), 0, np.maximum(self.shape-2, 0))
+        t = np.clip(idx-i0, 0., 1.)
+        i1 = np.minimum(i0+1, self.shape-1)
+
+        x0, y0, z0 = i0.T
+        x1, y1, z1 = i1.T
+        tx, ty, tz = t.T
+
+        data = self.data
+        c00 = data[x0, y0, z0]*(1-tx) + data[x1, y0, z0]*tx
+        c10 = data[x0, y1, z0]*(1-tx) + data[x1, y1, z0]*tx
+        c01 = data[x0, y0, z1]*(1-tx) + data[x1, y0, z1]*tx
+        c11 = data[x0, y1, z1]*(1-tx) + data[x1, y1, z1]*tx
+
+        c0 = c00*(1-ty) + c10*ty
+        c1 = c01*(1-ty) + c11*ty
+
+        values = c0*(1-tz) + c1*tz
+        values[outside] = fill_value
+
+        return values
+
+    def __call__(self, coordinates, fill_value=np.nan):
+        return self.interpolate(coordinates, fill_value=fill_value)
+
+def get_electrostatics_at_coordinates(coordinates, dx_file, cache=True, fill_value=np.nan):
+    """Evaluate the potential in dx_file at each coordinate, in process"""
+    return DXGrid.from_file(dx_file, cache=cache).interpolate(coordinates, fill_value=fill_value)
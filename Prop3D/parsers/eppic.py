@@ -34,6 +34,27 @@ def stringify(df):
         df[col] = df[col].astype(str)
     return df
 
+def encode_nested(df):
+    """JSON encode object columns that are not plain strings (e.g. lists and
+    dicts from the EPPIC api) so the table can be stored in HDF table format
+
+    Returns
+    -------
+    df : pd.DataFrame
+    nested : list of encoded column names
+    """
+    nested = []
+    for col in df.columns[df.dtypes==object]:
+        if infer_dtype(df[col], skipna=True) not in ("string", "empty"):
+            df[col] = df[col].apply(lambda v: json.dumps(v, default=str))
+            nested.append(col)
+    return df, nested
+
+def decode_nested(df, nested):
+    for col in nested:
+        df[col] = df[col].apply(json.loads)
+    return df
+
 def resnum_to_biopdb(resnum):
     try:
         resseq_parts = natural_keys(resseq, use_int=True)
@@ -43,8 +64,17 @@ def resnum_to_biopdb(resnum):
         return np.nan
 
 class EPPICApi(JSONApi):
+    """EPPIC REST api for one PDB entry.
+
+    Parsed sequences, residue info, interfaces, interface residues and contacts
+    are saved as HDF tables in eppic_store under parsed/ (if table_cache is
+    True), so other jobs for the same PDB read the tables instead of parsing
+    the JSON again.
+    """
+    TABLE_VERSION = 1
+
     def __init__(self, pdb, eppic_store, pdbe_store, use_representative_chains=True,
-      work_dir=None, download=True, clean=True, max_attempts=2):
+      work_dir=None, download=True, clean=True, max_attempts=2, table_cache=True):
         self.pdbe_api = PDBEApi(pdbe_store, work_dir=work_dir, download=download,
             max_attempts=max_attempts)
         super(EPPICApi, self).__init__("http://www.eppic-web.org/rest/api/v3/job/",
@@ -52,6 +82,8 @@ class EPPICApi(JSONApi):
             max_attempts=max_attempts)
 
         self.pdb = pdb.lower()
+        self.table_cache = table_cache
+        self._tables = {}
         self.sequences = self.get_sequences()
 
         RealtimeLogger.info("Running sequences {}".format(self.sequences))
@@ -121,19 +153,89 @@ class EPPICApi(JSONApi):
 
         return rerun
 
-    def get_interfaces(self, bio=False):
-        result = self.get(("interfaces", self.pdb))
+    def _table_key(self, name):
+        return "parsed/v{}/{}/{}.h5".format(self.TABLE_VERSION, self.pdb, name)
 
-        interfaces = pd.DataFrame(result)
+    def _read_table(self, name):
+        local_file = os.path.join(self.work_dir, "{}-{}.h5".format(self.pdb, name))
+        try:
+            self.store.read_input_file(self._table_key(name), local_file)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            return None
 
-        if interfaces.empty:
+        try:
+            with pd.HDFStore(local_file, "r") as store:
+                df = store["table"]
+                nested = list(getattr(store.get_storer("table").attrs, "nested", []))
+            return decode_nested(df, nested)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            RealtimeLogger.info("Unable to read EPPIC table {}: {}".format(name, e))
             return None
+        finally:
+            try:
+                os.remove(local_file)
+            except OSError:
+                pass
+
+    def _write_table(self, name, df):
+        local_file = os.path.join(self.work_dir, "{}-{}.h5".format(self.pdb, name))
+        try:
+            df, nested = encode_nested(df.copy())
+            with pd.HDFStore(local_file, "w", complevel=9, complib="bzip2") as store:
+                store.put("table", df, format="table")
+                store.get_storer("table").attrs.nested = nested
+            self.store.write_output_file(local_file, self._table_key(name))
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            RealtimeLogger.info("Unable to save EPPIC table {}: {}".format(name, e))
+        finally:
+            try:
+                os.remove(local_file)
+            except OSError:
+                pass
+
+    def get_table(self, name, build):
+        """Parsed table from memory, the table cache in the store, or by calling
+        build() and saving the result. Empty tables are not saved. Callers
+        get a copy, so changing it does not change the cached table"""
+        if name in self._tables:
+            df = self._tables[name]
+            return df.copy() if df is not None else None
+
+        df = self._read_table(name) if self.table_cache else None
+
+        if df is None:
+            df = build()
+            if self.table_cache and df is not None and not df.empty:
+                self._write_table(name, df)
+
+        self._tables[name] = df
+        return df.copy() if df is not None else None
+
+    def _build_interfaces(self):
+        interfaces = pd.DataFrame(self.get(("interfaces", self.pdb)))
+
+        if interfaces.empty:
+            return interfaces
 
         interfaces = interfaces.assign(interfaceType=
             interfaces["interfaceScores"].apply(lambda x:
                 [score["callName"] for score in x["interfaceScore"] \
                     if score["method"] == "eppic"][0]))
 
+        return stringify(interfaces)
+
+    def get_interfaces(self, bio=False):
+        interfaces = self.get_table("interfaces", self._build_interfaces)
+
+        if interfaces is None or interfaces.empty:
+            return None
+
         if bio:
             interfaces = interfaces[interfaces["interfaceType"]=="bio"]
 
@@ -150,8 +252,8 @@ class EPPICApi(JSONApi):
         return self._interface_chains[interfaceId]
 
     def get_interface_residues(self, interfaceId):
-        result = self.get(("interfaceResidues", self.pdb, interfaceId))
-        result = stringify(pd.DataFrame(result))
+        result = self.get_table("interfaceResidues-{}".format(interfaceId),
+            lambda: stringify(pd.DataFrame(self.get(("interfaceResidues", self.pdb, interfaceId)))))
 
         if not self.use_representative_chains:
             result = self.expand_chains_from_interface(result, interfaceId)
@@ -167,18 +269,52 @@ class EPPICApi(JSONApi):
         return result
 
     def get_contacts(self, interfaceId):
-        result = self.get(("contacts", self.pdb, interfaceId))
-
         #No pdb residue information so no need to trasnform pdbResNums
 
-        return stringify(pd.DataFrame(result))
+        return self.get_table("contacts-{}".format(interfaceId),
+            lambda: stringify(pd.DataFrame(self.get(("contacts", self.pdb, interfaceId)))))
+
+    def _build_sequences(self):
+        """Sequences with residueInfos moved into a separate flat table of
+        representative chain residues (one concat for all sequences)"""
+        sequences = pd.DataFrame(self.get(("sequences", self.pdb)))
+        self._tables["residue_info"] = pd.DataFrame()
+
+        if "residueInfos" in sequences.columns:
+            residues = [pd.DataFrame(seq.residueInfos).assign(_seq=i) for i, seq in \
+                enumerate(sequences[["memberChains", "residueInfos"]].itertuples()) \
+                if isinstance(seq.residueInfos, list) and len(seq.residueInfos) > 0]
+            if len(residues) > 0:
+                residues = pd.concat(residues, axis=0, ignore_index=True)
+                residues = residues.dropna(subset=["pdbResidueNumber"])
+                residues = residues.assign(memberChains=
+                    sequences["memberChains"].values[residues["_seq"].values])
+                self._tables["residue_info"] = stringify(residues)
+
+            sequences = sequences.drop(columns=["residueInfos"])
+
+        return stringify(sequences)
 
     def get_sequences(self):
         if hasattr(self, "sequences") and self.sequences is not None:
             return self.sequences
 
-        result = self.get(("sequences", self.pdb))
-        return stringify(pd.DataFrame(result))
+        sequences = self.get_table("sequences", self._build_sequences)
+
+        if self.table_cache and "residue_info" in self._tables and \
+          not self._tables["residue_info"].empty:
+            #Built from JSON, save the residue table built along with it
+            self._write_table("residue_info", self._tables["residue_info"])
+
+        return sequences
+
+    def get_clustered_residue_info(self):
+        """Residues of the representative chain of each sequence with the
+        memberChains they represent"""
+        def build():
+            self._build_sequences()
+            return self._tables["residue_info"]
+        return self.get_table("residue_info", build)
 
     def expand_chain(self, df, chain_lett):
         chain = pd.merge(df, self._get_chain_residues(chain_lett), how="left",
@@ -210,34 +346,28 @@ class EPPICApi(JSONApi):
             return self.expand_chain(df, chainLett)
 
     def get_residue_info(self, chain=None):
-        seq = self.get_sequences()
-        seq = seq.drop(seq.columns.difference(['memberChains','residueInfos']), 1)
+        residues = self.get_clustered_residue_info()
 
-        if seq.empty:
+        if residues is None or residues.empty:
             return None
 
         if chain is not None:
-            seq = seq[seq["memberChains"].str.contains(chain)]
-            seq["memberChains"] = chain
-
-        result = None
-        for seq_chains in seq.itertuples():
-            repChain = seq_chains.memberChains.split(",")[0]
-            seq_chain_clustered = pd.DataFrame(seq_chains.residueInfos)
-            seq_chain_clustered = seq_chain_clustered.dropna(subset=["pdbResidueNumber"])
-
-            for memberChain in seq_chains.memberChains.split(","):
-                if self.use_representative_chains:
-                    seq_chain = seq_chain_clustered.assign(chain=memberChain)
-                else:
-                    #Do not use representative and get from PDBE
-                    seq_chain = self.expand_chains_from_residues(seq_chain_clustered, memberChain)
-                    seq_chain = seq_chain.assign(chain=memberChain)
-
-                if result is None:
-                    result = seq_chain
-                else:
-                    result = pd.concat((result, seq_chain), axis=0)
+            residues = residues[residues["memberChains"].str.contains(chain)]
+            residues = residues.assign(memberChains=chain)
+
+        #Copy the residues of each representative chain to all of its members
+        result = residues.assign(chain=residues["memberChains"].str.split(","),
+            _res=np.arange(len(residues))).explode("chain")
+        result = result.assign(_member=result.groupby(level=0).cumcount())
+        result = result.sort_values(["_seq", "_member", "_res"], kind="stable")
+
+        if not self.use_representative_chains:
+            #Do not use representative and get from PDBE
+            result = pd.concat([self.expand_chains_from_residues(
+                member.drop(columns=["chain"]), memberChain).assign(chain=memberChain) \
+                for memberChain, member in result.groupby("chain", sort=False)], axis=0)
+
+        result = result.drop(columns=["memberChains", "_seq", "_member", "_res"])
 
         return stringify(result)
 
@@ -1,9 +1,16 @@
 import os
+import copy
 import json
+import time
+import threading
 from shutil import copyfileobj
 from functools import partial
+from collections import OrderedDict
+from urllib.parse import urlparse
 import urllib.request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from contextlib import closing
 
 #from toil.realtimeLogger import RealtimeLogger
@@ -13,8 +20,46 @@ class RealtimeLogger:
     def info(*args, **kwds):
         print(args, kwds)
 
+MAX_PER_HOST = int(os.environ.get("PROP3D_WEB_MAX_PER_HOST", 8))
+
+_sessions = {}
+_host_semaphores = {}
+_session_lock = threading.Lock()
+
+def get_session():
+    """requests.Session shared by all web services in this process, with
+    keep-alive connections and retries on connection errors and 429/5xx"""
+    pid = os.getpid()
+    with _session_lock:
+        if pid not in _sessions:
+            retries = Retry(total=5, backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET", "HEAD"))
+            adapter = HTTPAdapter(max_retries=retries, pool_connections=16,
+                pool_maxsize=MAX_PER_HOST)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[pid] = session
+        return _sessions[pid]
+
+def host_semaphore(url):
+    """Limit the number of concurrent downloads from one host"""
+    host = urlparse(url).netloc
+    with _session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _host_semaphores[host]
+
 class WebService(object):
-    def __init__(self, base_url, store, work_dir=None, download=True, clean=True, max_attempts=2):
+    """Get files from a web service, keeping a copy of each in an IOStore.
+
+    Files are looked for in the work_dir, then in a local disk cache (if
+    cache_dir or PROP3D_WEB_CACHE is set, entries expire after cache_ttl
+    seconds), then in the store, and are downloaded if not found. The last
+    memory_cache_size parsed results are kept in memory.
+    """
+    def __init__(self, base_url, store, work_dir=None, download=True, clean=True, max_attempts=2,
+      memory_cache_size=128, cache_dir=None, cache_ttl=7*24*3600):
         self.work_dir = os.getcwd() if work_dir is None else work_dir
         self.base_url = base_url
         self.store = store
@@ -24,6 +69,20 @@ class WebService(object):
         #self.get = memory.cache(self.get)
         self.files = {}
 
+        self.memory_cache_size = memory_cache_size
+        self._parsed = OrderedDict()
+        self._parsed_lock = threading.Lock()
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("PROP3D_WEB_CACHE")
+        if cache_dir is not None:
+            from Prop3D.util.cache import LRUFileCache
+            self.disk_cache = LRUFileCache(cache_dir,
+                max_bytes=os.environ.get("PROP3D_WEB_CACHE_SIZE"))
+        else:
+            self.disk_cache = None
+        self.cache_ttl = cache_ttl
+
     def __get__(self, key):
         return self.get(key)
 
@@ -31,7 +90,7 @@ class WebService(object):
         self.clean()
 
     def clean(self):
-        for key, (fname, should_delete) in self.files.items():
+        for key, (fname, should_delete) in list(self.files.items()):
             if should_delete:
                 try:
                     os.remove(fname)
@@ -56,16 +115,121 @@ class WebService(object):
     def __get__(self, key):
         return self.get(key)
 
-    def get(self, key, attempts=None, last_source=None):
-        if attempts is None:
-            attempts = self.max_attempts
+    def _read_from_store(self, key, fname):
+        """Read key from the store in a single request instead of checking that
+        it exists first. Returns False if it could not be read"""
+        try:
+            self.store.read_input_file(key, fname)
+            return True
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            try:
+                os.remove(fname)
+            except (OSError, FileNotFoundError):
+                pass
+            return False
 
+    def _normalize_key(self, key):
         if isinstance(key, (list, tuple)):
-            key = "/".join(self.fix_key(str(k)) for k in key)
+            return "/".join(self.fix_key(str(k)) for k in key)
         elif isinstance(key, str):
-            key = self.fix_key(key)
-        else:
-            raise KeyError(key)
+            return self.fix_key(key)
+        raise KeyError(key)
+
+    @staticmethod
+    def _copy_parsed(result):
+        """Copy of a parsed result so callers cannot modify the memory cache"""
+        if isinstance(result, (dict, list)):
+            return copy.deepcopy(result)
+        elif hasattr(result, "copy"):
+            #DataFrame or Series
+            return result.copy()
+        return result
+
+    def _get_parsed(self, key):
+        with self._parsed_lock:
+            if key in self._parsed:
+                self._parsed.move_to_end(key)
+                return True, self._copy_parsed(self._parsed[key])
+        return False, None
+
+    def _add_parsed(self, key, result):
+        if self.memory_cache_size <= 0:
+            return
+        result = self._copy_parsed(result)
+        with self._parsed_lock:
+            self._parsed[key] = result
+            self._parsed.move_to_end(key)
+            while len(self._parsed) > self.memory_cache_size:
+                self._parsed.popitem(last=False)
+
+    def _disk_cache_key(self, key):
+        return "{}{}{}".format(self.base_url, key, self.extension(key))
+
+    def _read_from_disk_cache(self, key, fname):
+        """Copy a cached response that is younger than cache_ttl to fname"""
+        if self.disk_cache is None:
+            return False
+        cache_key = self._disk_cache_key(key)
+        meta = self.disk_cache.get_meta(cache_key)
+        if meta is None:
+            return False
+        if self.cache_ttl is not None and time.time()-meta.get("created", 0) > self.cache_ttl:
+            self.disk_cache.remove(cache_key)
+            return False
+        return self.disk_cache.get(cache_key, fname) is not None
+
+    def _add_to_disk_cache(self, key, fname):
+        if self.disk_cache is not None:
+            self.disk_cache.put(self._disk_cache_key(key), fname,
+                meta={"created": time.time()})
+
+    def get_many(self, keys, max_workers=None, ignore_errors=True):
+        """Get many keys concurrently. Downloads from one host are limited to
+        PROP3D_WEB_MAX_PER_HOST (default 8) at a time.
+
+        Returns
+        -------
+        A dict of key to parsed result. Keys that fail are left out if
+        ignore_errors is True, otherwise the first KeyError is raised
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        keys = list(OrderedDict.fromkeys(keys))
+
+        def get(key):
+            try:
+                return key, self.get(key, clean=False), None
+            except KeyError as e:
+                return key, None, e
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or 2*MAX_PER_HOST) as pool:
+                results = list(pool.map(get, keys))
+        finally:
+            if self._clean:
+                self.clean()
+
+        parsed = {}
+        for key, result, error in results:
+            if error is not None:
+                if not ignore_errors:
+                    raise error
+                continue
+            parsed[key] = result
+        return parsed
+
+    def get(self, key, attempts=None, last_source=None, clean=True):
+        if attempts is None:
+            attempts = self.max_attempts
+
+        key = self._normalize_key(key)
+
+        if last_source is None:
+            cached, result = self._get_parsed(key)
+            if cached:
+                return result
 
         store_key = "{}{}".format(key, self.extension(key))
         fname = os.path.join(self.work_dir, "{}-{}{}".format(
@@ -78,11 +242,15 @@ class WebService(object):
             RealtimeLogger.info("API read from file")
             source = "local"
             should_remove = False #If previosly downloaded in this session, it will not remove
-        elif self.store.exists(key) and not last_source=="IOStore":
+        elif last_source is None and self._read_from_disk_cache(key, fname):
+            RealtimeLogger.info("API read from disk cache")
+            source = "cache"
+            should_remove = True
+        elif not last_source=="IOStore" and self._read_from_store(key, fname):
             RealtimeLogger.info("API get from store")
-            self.store.read_input_file(key, fname)
             source = "IOStore"
             should_remove = True
+            self._add_to_disk_cache(key, fname)
         else:
             should_remove = True
             if self._download:
@@ -110,7 +278,7 @@ class WebService(object):
             RealtimeLogger.info("Failed reading, {} bc {}".format(fname, e))
 
             if attempts > 0:
-                return self.get(key, attempts=attempts-1, last_source=source)
+                return self.get(key, attempts=attempts-1, last_source=source, clean=clean)
             else:
                 raise KeyError("Key '{}' is an invalid file".format(key))
         RealtimeLogger.info("Donwlaod step 5")
@@ -134,8 +302,11 @@ class WebService(object):
 
             RealtimeLogger.info("Donwlaod step 6 {}".format(rerun))
 
+            if self.disk_cache is not None:
+                self.disk_cache.remove(self._disk_cache_key(key))
+
             if rerun and attempts > 0:
-                return self.get(key, attempts=attempts-1, last_source=source)
+                return self.get(key, attempts=attempts-1, last_source=source, clean=clean)
             else:
                 RealtimeLogger.info("Not restarting")
                 raise KeyError("Key '{}' is an invalid file".format(key))
@@ -146,7 +317,9 @@ class WebService(object):
         if key not in self.files:
             self.files[key] = (fname, should_remove)
 
-        if should_remove and self._clean:
+        self._add_parsed(key, result)
+
+        if should_remove and self._clean and clean:
             self.clean()
 
         return result
@@ -160,7 +333,8 @@ class WebService(object):
 
         try:
             if url.startswith("http"):
-                with requests.get(url, stream=True) as r, open(fname, 'wb') as f:
+                with host_semaphore(url), get_session().get(url, stream=True, timeout=(10, 300)) as r, \
+                  open(fname, 'wb') as f:
                     RealtimeLogger.info("Donwlaod step 1")
                     r.raw.read = partial(r.raw.read, decode_content=True)
                     copyfileobj(r.raw, f)
@@ -181,6 +355,8 @@ class WebService(object):
             #Save to store
             self.store.write_output_file(fname, key)
 
+        self._add_to_disk_cache(key, fname)
+
         RealtimeLogger.info("Donwlaod step 4")
 
         return True
@@ -1,14 +1,16 @@
 import os, sys
-import re
+import json
 import uuid
+import shutil
+import hashlib
 import subprocess
 
 import pandas as pd
-from joblib import Parallel, delayed
 
 from toil.realtimeLogger import RealtimeLogger
 
 from Prop3D.parsers.container import Container
+from Prop3D.util import safe_remove
 
 class MMSeqs(Container):
     IMAGE = 'docker://edraizen/mmseqs:latest'
@@ -21,8 +23,7 @@ class MMSeqs(Container):
         output = os.path.join(self.work_dir, os.path.splitext(os.path.basename(fasta_file))[0])
 
         if db is None:
-            db = f"{output}.mmseqs_db"
-            CreateDB(work_dir=self.work_dir)(fasta_file, db)
+            db = MMSeqsWorkspace(fasta_file, work_dir=self.work_dir, job=self.job).create_db()
 
 
         allvsallpref = self.fake_pref(db, db, output+".all_vs_all_pref")
@@ -89,6 +90,285 @@ class CreateTSV(MMSeqs):
         (":threads", "str")
     ]
 
+def fasta_hash(fasta_file, chunk_size=1<<20):
+    """sha1 of the contents of a FASTA file"""
+    h = hashlib.sha1()
+    with open(fasta_file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+#Used by easy-cluster and the workspace instead of the mmseqs default of 300
+MAX_SEQS = 2147483647
+
+def _params_key(**params):
+    params = {k: v for k, v in params.items() if v is not None}
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+
+class MMSeqsWorkspace(object):
+    """Sequence database, k-mer index and prefilter results of one FASTA file,
+    kept in work_dir/mmseqs_workspaces/<hash of the FASTA contents> and reused
+    by every clustering and search of the same sequences.
+
+    Each step writes a .done marker when it finishes, so an interrupted step
+    is rerun and a finished one is skipped. Prefilter results are computed
+    without sequence identity or coverage cutoffs and keyed by the k-mer
+    parameters only, so a sweep of --min-seq-id / -c values shares them and
+    only reruns align and clust.
+
+    Parameters
+    ----------
+    fasta_file : str
+    work_dir : str
+        Directory mounted in the container. Workspaces are created inside it
+    threads : int
+    """
+    PREFILTER_PARAMS = ["sensitivity", "max_seqs", "kmer_per_seq", "min_ungapped_score"]
+    ALIGN_PARAMS = ["min_seq_id", "min_covered", "cov_mode", "max_evalue", "seq_id_mode",
+        "alignment_mode"]
+    CLUST_PARAMS = ["cluster_mode"]
+
+    def __init__(self, fasta_file, work_dir=None, job=None, threads=None):
+        self.fasta_file = fasta_file
+        self.work_dir = work_dir if work_dir is not None else os.getcwd()
+        self.job = job
+        self.threads = threads
+        self.hash = fasta_hash(fasta_file)
+        self.path = os.path.join(self.work_dir, "mmseqs_workspaces", self.hash[:16])
+        self.tmp_dir = os.path.join(self.path, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _done(self, name):
+        return os.path.isfile(self._file(name)+".done")
+
+    def _run(self, name, parameters, **kwds):
+        """Run an mmseqs command once. Every database argument uses path:in so
+        it is resolved relative to work_dir in the container"""
+        if self._done(name):
+            return self._file(name)
+
+        kwds = {k: v for k, v in kwds.items() if v is not None}
+        if self.threads is not None:
+            kwds["threads"] = self.threads
+
+        RealtimeLogger.info("mmseqs {} for {}".format(parameters[0], name))
+        mmseqs = MMSeqs(job=self.job, work_dir=self.work_dir)
+        with mmseqs.custom_parameters(parameters):
+            out = mmseqs(**kwds)
+            if out is not None:
+                #Detached containers stream their output
+                for _ in out:
+                    pass
+
+        with open(self._file(name)+".done", "w"):
+            pass
+
+        return self._file(name)
+
+    @property
+    def db(self):
+        return self.create_db()
+
+    def create_db(self):
+        return self._run("seqs", ["createdb",
+            ("sequence_file", "path:in", ["{}"]),
+            ("output_db", "path:in", ["{}"])],
+            sequence_file=self.fasta_file, output_db=self._file("seqs"))
+
+    def create_index(self, sensitivity=None):
+        """Precomputed k-mer index of the database, used by prefilter and
+        search when their k-mer settings match. There is only one index per
+        database, so it is rebuilt when the sensitivity changes"""
+        db = self.create_db()
+        marker = self._file("seqs.idx")+".done"
+        key = _params_key(sensitivity=sensitivity)
+        if os.path.isfile(marker):
+            with open(marker) as f:
+                if f.read() != key:
+                    safe_remove(marker)
+        self._run("seqs.idx", ["createindex",
+            ("sequenceDB", "path:in", ["{}"]),
+            ("tmp", "path:in", ["{}"]),
+            (":sensitivity", "str", ["-s", "{}"]),
+            (":threads", "str")],
+            sequenceDB=db, tmp=self.tmp_dir, sensitivity=sensitivity)
+        with open(marker, "w") as f:
+            f.write(key)
+        return db
+
+    def prefilter(self, sensitivity=None, max_seqs=MAX_SEQS, kmer_per_seq=None, min_ungapped_score=None):
+        """All vs all prefilter result, shared by every threshold of a sweep"""
+        db = self.create_index(sensitivity=sensitivity)
+        name = "pref_{}".format(_params_key(sensitivity=sensitivity, max_seqs=max_seqs,
+            kmer_per_seq=kmer_per_seq, min_ungapped_score=min_ungapped_score))
+        return self._run(name, ["prefilter",
+            ("queryDB", "path:in", ["{}"]),
+            ("targetDB", "path:in", ["{}"]),
+            ("prefilterDB", "path:in", ["{}"]),
+            (":sensitivity", "str", ["-s", "{}"]),
+            (":max_seqs", "str", "max-seqs"),
+            (":kmer_per_seq", "str", ["--kmer-per-seq", "{}"]),
+            (":min_ungapped_score", "str", "min-ungapped-score"),
+            (":threads", "str")],
+            queryDB=db, targetDB=db, prefilterDB=self._file(name), sensitivity=sensitivity,
+            max_seqs=max_seqs, kmer_per_seq=kmer_per_seq, min_ungapped_score=min_ungapped_score)
+
+    def align(self, prefilter_db, **kwds):
+        params = {k: kwds.get(k) for k in self.ALIGN_PARAMS}
+        name = "{}.aln_{}".format(os.path.basename(prefilter_db), _params_key(**params))
+        return self._run(name, ["align",
+            ("queryDB", "path:in", ["{}"]),
+            ("targetDB", "path:in", ["{}"]),
+            ("prefilterDB", "path:in", ["{}"]),
+            ("alignmentDB", "path:in", ["{}"]),
+            (":min_seq_id", "str", "min-seq-id"),
+            (":min_covered", "str", ["-c", "{}"]),
+            (":cov_mode", "str", "cov-mode"),
+            (":max_evalue", "str", ["-e", "{}"]),
+            (":seq_id_mode", "str", "seq-id-mode"),
+            (":alignment_mode", "str", "alignment-mode"),
+            (":threads", "str")],
+            queryDB=self.db, targetDB=self.db, prefilterDB=prefilter_db,
+            alignmentDB=self._file(name), **params)
+
+    def clust(self, alignment_db, cluster_mode=None):
+        name = "{}.clu_{}".format(os.path.basename(alignment_db), _params_key(cluster_mode=cluster_mode))
+        self._run(name, ["clust",
+            ("sequenceDB", "path:in", ["{}"]),
+            ("resultDB", "path:in", ["{}"]),
+            ("clusterDB", "path:in", ["{}"]),
+            (":cluster_mode", "str", "cluster-mode"),
+            (":threads", "str")],
+            sequenceDB=self.db, resultDB=alignment_db, clusterDB=self._file(name),
+            cluster_mode=cluster_mode)
+        return self.create_tsv(self._file(name))
+
+    def create_tsv(self, result_db, query_db=None, target_db=None):
+        query_db = query_db if query_db is not None else self.db
+        target_db = target_db if target_db is not None else self.db
+        name = os.path.basename(result_db)+".tsv"
+        return self._run(name, ["createtsv",
+            ("queryDB", "path:in", ["{}"]),
+            ("targetDB", "path:in", ["{}"]),
+            ("resultDB", "path:in", ["{}"]),
+            ("tsvFile", "path:in", ["{}"]),
+            (":threads", "str")],
+            queryDB=query_db, targetDB=target_db, resultDB=result_db, tsvFile=self._file(name))
+
+    def cluster(self, **kwds):
+        """Cascaded clustering (the mmseqs cluster workflow, as in easy-cluster)
+        of the cached database. Returns a tsv of representative, member"""
+        params = {k: v for k, v in kwds.items() if k in self.PREFILTER_PARAMS+\
+            self.ALIGN_PARAMS+self.CLUST_PARAMS+["cluster_reassign"]}
+        params.setdefault("max_seqs", MAX_SEQS)
+        name = "cluster_{}".format(_params_key(**params))
+        self._run(name, ["cluster",
+            ("sequenceDB", "path:in", ["{}"]),
+            ("clusterDB", "path:in", ["{}"]),
+            ("tmp", "path:in", ["{}"]),
+            (":sensitivity", "str", ["-s", "{}"]),
+            (":max_seqs", "str", "max-seqs"),
+            (":kmer_per_seq", "str", ["--kmer-per-seq", "{}"]),
+            (":min_ungapped_score", "str", "min-ungapped-score"),
+            (":min_seq_id", "str", "min-seq-id"),
+            (":min_covered", "str", ["-c", "{}"]),
+            (":cov_mode", "str", "cov-mode"),
+            (":max_evalue", "str", ["-e", "{}"]),
+            (":seq_id_mode", "str", "seq-id-mode"),
+            (":alignment_mode", "str", "alignment-mode"),
+            (":cluster_mode", "str", "cluster-mode"),
+            (":cluster_reassign", "store_true", ["--cluster-reassign"]),
+            (":threads", "str")],
+            sequenceDB=self.create_index(sensitivity=params.get("sensitivity")),
+            clusterDB=self._file(name), tmp=self.tmp_dir, **params)
+        return self.create_tsv(self._file(name))
+
+    def search(self, target=None, **kwds):
+        """Search these sequences against another workspace (or itself).
+        Both databases and the target index are reused. Returns a tsv of
+        query, target, ... (mmseqs convertalis format)"""
+        target = target if target is not None else self
+        params = {k: v for k, v in kwds.items() if k in self.PREFILTER_PARAMS+self.ALIGN_PARAMS}
+        name = "search_{}_{}".format(target.hash[:16], _params_key(**params))
+        target_db = target.create_index(sensitivity=params.get("sensitivity"))
+        self._run(name, ["search",
+            ("queryDB", "path:in", ["{}"]),
+            ("targetDB", "path:in", ["{}"]),
+            ("alignmentDB", "path:in", ["{}"]),
+            ("tmp", "path:in", ["{}"]),
+            (":sensitivity", "str", ["-s", "{}"]),
+            (":max_seqs", "str", "max-seqs"),
+            (":kmer_per_seq", "str", ["--kmer-per-seq", "{}"]),
+            (":min_ungapped_score", "str", "min-ungapped-score"),
+            (":min_seq_id", "str", "min-seq-id"),
+            (":min_covered", "str", ["-c", "{}"]),
+            (":cov_mode", "str", "cov-mode"),
+            (":max_evalue", "str", ["-e", "{}"]),
+            (":seq_id_mode", "str", "seq-id-mode"),
+            (":alignment_mode", "str", "alignment-mode"),
+            (":threads", "str")],
+            queryDB=self.create_db(), targetDB=target_db, alignmentDB=self._file(name),
+            tmp=self.tmp_dir, **params)
+        return self._run(name+".m8", ["convertalis",
+            ("queryDB", "path:in", ["{}"]),
+            ("targetDB", "path:in", ["{}"]),
+            ("alignmentDB", "path:in", ["{}"]),
+            ("alignmentFile", "path:in", ["{}"]),
+            (":threads", "str")],
+            queryDB=self.db, targetDB=target_db, alignmentDB=self._file(name),
+            alignmentFile=self._file(name+".m8"))
+
+    def cluster_sweep(self, min_seq_id=(0.0,), min_covered=(0.8,), max_evalue=(1e-3,),
+      cluster_mode=(0,), cov_mode=None, seq_id_mode=None, alignment_mode=None,
+      sensitivity=None, max_seqs=MAX_SEQS, kmer_per_seq=None, min_ungapped_score=None):
+        """Cluster with every combination of the alignment and clustering
+        thresholds. The database, index and prefilter are computed once and
+        each alignment is shared by every cluster_mode
+
+        Parameters
+        ----------
+        min_seq_id, min_covered, max_evalue, cluster_mode : list
+            Values to try
+        sensitivity, max_seqs, kmer_per_seq, min_ungapped_score :
+            Prefilter parameters, shared by the whole sweep
+
+        Returns
+        -------
+        pd.DataFrame with columns min_seq_id, min_covered, max_evalue,
+        cluster_mode, representative and member, one row per sequence per
+        clustering
+        """
+        import itertools
+
+        as_list = lambda v: list(v) if isinstance(v, (list, tuple, range)) else [v]
+        prefilter_db = self.prefilter(sensitivity=sensitivity, max_seqs=max_seqs,
+            kmer_per_seq=kmer_per_seq, min_ungapped_score=min_ungapped_score)
+
+        combos = list(itertools.product(as_list(min_seq_id), as_list(min_covered),
+            as_list(max_evalue)))
+        RealtimeLogger.info("Sweeping {} alignment settings x {} cluster modes".format(
+            len(combos), len(as_list(cluster_mode))))
+
+        clusterings = []
+        for seq_id, covered, evalue in combos:
+            alignment_db = self.align(prefilter_db, min_seq_id=seq_id, min_covered=covered,
+                max_evalue=evalue, cov_mode=cov_mode, seq_id_mode=seq_id_mode,
+                alignment_mode=alignment_mode)
+            for mode in as_list(cluster_mode):
+                clusters = pd.read_csv(self.clust(alignment_db, cluster_mode=mode), sep="\t",
+                    header=None, names=["representative", "member"])
+                clusters = clusters.assign(min_seq_id=seq_id, min_covered=covered,
+                    max_evalue=evalue, cluster_mode=mode)
+                clusterings.append(clusters)
+
+        columns = ["min_seq_id", "min_covered", "max_evalue", "cluster_mode", "representative", "member"]
+        if len(clusterings) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(clusterings, ignore_index=True)[columns]
+
 class EasyCluster(MMSeqs):
     PARAMETERS = ["easy-cluster",
         ("fastaFile", "path:in", ["{}"]),
@@ -116,20 +396,21 @@ class EasyCluster(MMSeqs):
         (":kmer_per_seq", "str", ["--kmer-per-seq", "{}"])
     ]
 
-    def cluster(self, fastaFile, tmp_dir=None, aggressive=False, prefix="", **kwds):
+    def cluster(self, fastaFile, tmp_dir=None, aggressive=False, prefix="", workspace=None, **kwds):
+        """Cluster with the mmseqs cluster workflow (what easy-cluster runs),
+        reusing the database and index of the FASTA file from earlier runs.
+        tmp_dir is ignored, the workspace has its own
+
+        Returns
+        -------
+        {prefix}_cluster.tsv with the representative and member of each sequence
+        """
         for k in ["fastaFile", "tmp", "clusterPrefix"]:
             try:
                 del kwds[k]
             except KeyError:
                 pass
 
-
-        if tmp_dir is None or not isinstance(tmp_dir, str) or \
-          not (os.path.isdir(tmp_dir) and str(os.path.abspath(tmp_dir)).startswith(
-          str(os.path.abspath(self.work_dir)))):
-            tmp_dir = os.path.join(self.work_dir, "tmp4", f"tmp-{uuid.uuid4()}")
-            os.makedirs(tmp_dir)
-
         if prefix is None:
             prefix = os.path.join(self.work_dir, os.path.splitext(os.path.basename(fastaFile))[0])
 
@@ -140,63 +421,77 @@ class EasyCluster(MMSeqs):
         if aggressive:
             kwds.update(aggressive_values)
 
-        print("run", kwds, tmp_dir, self.work_dir)
-        self(fastaFile=fastaFile, clusterPrefix=prefix, tmp=tmp_dir, **kwds)
+        #Same default as easy-cluster above
+        kwds.setdefault("max_seqs", MAX_SEQS)
+
+        if workspace is None:
+            workspace = MMSeqsWorkspace(fastaFile, work_dir=self.work_dir, job=self.job,
+                threads=kwds.get("threads"))
 
-        return f"{prefix}_cluster.tsv"
+        cluster_file = f"{prefix}_cluster.tsv"
+        shutil.copyfile(workspace.cluster(**kwds), cluster_file)
 
+        return cluster_file
 
     def try_all(self, fastaFile, representative_domains, **kwds):
-        aggressive_values = dict(
+        """Count clusters and superfamilies for every combination of
+        hyperparameters. Each prefilter setting (sensitivity,
+        min_ungapped_score) is run once and shared by the sweep of alignment
+        and clustering thresholds
+
+        Returns
+        -------
+        pd.DataFrame of n_clusters and n_sfams for each combination, also
+        saved to {prefix}.hyperparameter_combos
+        """
+        prefilter_values = dict(
             sensitivity=[6, 7.5, 8, 9.5, 9, 9.5, 10],
-            min_ungapped_score=range(31),
+            min_ungapped_score=range(31))
+        sweep_values = dict(
             min_covered=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
             max_evalue=[10, 100, 1000, float("inf")],
             min_seq_id=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
             cluster_mode=[0,1,2,3])
 
         import itertools
-        keys, values = zip(*aggressive_values.items())
-        permutations_dicts = [dict(zip(keys, v)) for v in itertools.product(*values)]
-        print("Trying", len(permutations_dicts), "hyperparameter combinations")
-
-
+        prefilters = list(itertools.product(*prefilter_values.values()))
+        n_sweep = len(list(itertools.product(*sweep_values.values())))
+        print("Trying", len(prefilters)*n_sweep, "hyperparameter combinations with",
+            len(prefilters), "prefilters")
 
         prefix = os.path.join(self.work_dir, os.path.splitext(os.path.basename(fastaFile))[0])
-        with open(f"{prefix}.hyperparameter_combos", "w") as f:
-            print("#n_clusters\tn_sfams\thyperparameters", file=f)
-
-        os.makedirs(prefix, exist_ok=True)
-
-        tmp_dir = os.path.join(self.work_dir, "tmp4")
-        os.makedirs(tmp_dir, exist_ok=True)
-
-        hp_dir = os.path.join(self.work_dir, "hyper_params")
-        os.makedirs(hp_dir, exist_ok=True)
 
-        def run(i, fasta, hparams, other):
-            if i%500==0:
-                print(f"Running hyperparameter set: {i}/{len(permutations_dicts)}")
-            id_parser = re.compile(r"cath\|4_3_0\|([a-zA-Z0-9]+)\/")
-            hparams.update(other)
-            os.makedirs(os.path.join(self.work_dir, f"hyper_params", str(i)), exist_ok=True)
-            hparams["prefix"] = os.path.join(f"hyper_params", str(i), os.path.splitext(os.path.basename(fastaFile))[0])
-            hparams["tmp_dir"] = os.path.join(f"hyper_params", str(i), f"tmp-{uuid.uuid4()}")
-            os.makedirs(hparams["tmp_dir"], exist_ok=True)
-            results_file = EasyCluster(work_dir=prefix).cluster(fasta, **hparams)
-            results = pd.read_csv(results_file, sep="\t", header=None, names="source target targetID alnScore seqIdentity eVal qStart qEnd qLen tStart tEnd tLen cigar".split())
-            results["source"] = results["source"].apply(lambda x: id_parser.search(x).groups()[0] if id_parser.search(x) else None)
-            results["target"] = results["source"].apply(lambda x: id_parser.search(x).groups()[0] if id_parser.search(x) else None)
-            results = pd.merge(results, representative_domains, left_on="source", right_on="cathDomain")
-
-            n_clusters = len(results[["source", "superfamily"]].drop_duplicates())
-            n_sfams = len(results["superfamily"].drop_duplicates())
-
-            with open(f"{prefix}.hyperparameter_combos_{i}.tsv", "w") as f:
-                print(f"{n_clusters}\t{n_sfams}\t{hparams}", file=f)
-                print(f"{n_clusters}\t{n_sfams}\t{hparams}")
-
-        Parallel(n_jobs=20)(delayed(run)(i, fastaFile, hyperparameters, kwds) for i, hyperparameters in enumerate(permutations_dicts))
+        workspace = MMSeqsWorkspace(fastaFile, work_dir=self.work_dir, job=self.job,
+            threads=kwds.get("threads"))
+        other = {k: v for k, v in kwds.items() if k in ["cov_mode", "seq_id_mode",
+            "alignment_mode", "max_seqs", "kmer_per_seq"]}
+
+        hparams = ["sensitivity", "min_ungapped_score", "min_seq_id", "min_covered",
+            "max_evalue", "cluster_mode"]
+        summaries = []
+
+        #Prefilters run one at a time since they share the database index,
+        #mmseqs itself uses all threads
+        for i, (sensitivity, min_ungapped_score) in enumerate(prefilters):
+            print(f"Running prefilter: {i}/{len(prefilters)}")
+            clusterings = workspace.cluster_sweep(sensitivity=sensitivity,
+                min_ungapped_score=min_ungapped_score, **sweep_values, **other)
+            clusterings = clusterings.assign(sensitivity=sensitivity,
+                min_ungapped_score=min_ungapped_score,
+                cathDomain=clusterings["representative"].str.extract(
+                    r"cath\|4_3_0\|([a-zA-Z0-9]+)\/", expand=False))
+            clusterings = pd.merge(clusterings, representative_domains, on="cathDomain")
+
+            summary = clusterings.groupby(hparams)["superfamily"].nunique().to_frame("n_sfams")
+            summary["n_clusters"] = clusterings.drop_duplicates(
+                hparams+["representative", "superfamily"]).groupby(hparams).size()
+            summaries.append(summary.reset_index())
+
+        summary = pd.concat(summaries, ignore_index=True)
+        summary[["n_clusters", "n_sfams"]+hparams].to_csv(f"{prefix}.hyperparameter_combos",
+            sep="\t", index=False)
+
+        return summary
 
 class Cluster(MMSeqs):
     RETURN_FILES = False
@@ -239,8 +534,7 @@ class Cluster(MMSeqs):
             os.makedirs(tmp_dir)
 
         prefix = os.path.join(self.work_dir, os.path.splitext(os.path.basename(fasta_file))[0])
-        db_file = f"{prefix}.mmseqs_db"
-        CreateDB(work_dir=self.work_dir)(fasta_file, db_file)
+        db_file = MMSeqsWorkspace(fasta_file, work_dir=self.work_dir, job=self.job).create_db()
 
         result_file = f"{prefix}.mmseqs_results"
         #kwds["alignment_output_mode"] = 5
@@ -260,8 +554,11 @@ class Cluster(MMSeqs):
         #
         # return result_tsv_file
 
-    def all_clust(self, db, output):
-        aln_result_file, _ = self.all_vs_all(db, output)
+    def all_clust(self, fasta_file, output, db=None):
+        if db is None:
+            db = MMSeqsWorkspace(fasta_file, work_dir=self.work_dir, job=self.job).create_db()
+
+        aln_result_file, _ = self.all_vs_all(fasta_file, output, db=db)
 
         new_params = ["clust",
             ("sequenceDB", "path:in", ["{}"]),
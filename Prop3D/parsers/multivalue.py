@@ -4,6 +4,7 @@ import numpy as np
 from Bio.PDB import PDBParser
 from Prop3D.util import safe_remove
 from Prop3D.parsers.container import Container
+from Prop3D.parsers.dx import DXGrid
 
 class Multivalue(Container):
     IMAGE = 'docker://edraizen/multivalue:latest'
@@ -41,7 +42,16 @@ class Multivalue(Container):
 
         return out_file
 
-    def get_electrostatics_at_coordinates(self, coordinates, dx_file, out_file=None):
+    def get_electrostatics_at_coordinates(self, coordinates, dx_file, out_file=None,
+      use_container=False):
+        """Get electrostatic potentials at each coordinate. By default the dx
+        grid is read and interpolated in process (see parsers.dx.DXGrid);
+        set use_container to run multivalue instead."""
+        if not use_container:
+            if isinstance(coordinates, str) and os.path.isfile(coordinates):
+                coordinates = np.loadtxt(coordinates, delimiter=",", usecols=(0,1,2), ndmin=2)
+            return DXGrid.from_file(dx_file).interpolate(coordinates)
+
         charge_file = self.compute_electrostatics_at_coordinates(coordinates,
             dx_file, out_file=out_file)
 
@@ -1,12 +1,11 @@
-import os
-import sys
 import shutil
 
-from Prop3D.util import safe_remove, SubprocessChain
+from Prop3D.util import safe_remove
 from Prop3D.parsers.container import Container
+from Prop3D.pdb_tools.pipeline import pipeline
 from Prop3D.util.pdb import remove_ter_lines as _remove_ter_lines
 from Prop3D.util.pdb import get_all_chains, extract_chains, \
-    replace_occ_b, PDB_TOOLS
+    replace_occ_b
 
 class MissingAtomsError(ValueError):
     pass
@@ -112,10 +111,8 @@ class Pdb2pqr(Container):
 
         new_pdb = extract_chains(pqr_file, save_chains)
 
-        cmds = [[sys.executable, os.path.join(PDB_TOOLS, "pdb_tidy.py"), new_pdb]]
         tidy_file = new_pdb+".tidy"
-        with open(tidy_file, "w") as f:
-            SubprocessChain(cmds, f)
+        pipeline(new_pdb).tidy().write(tidy_file)
 
         safe_remove([new_pdb, pqr_file])
         shutil.move(tidy_file, new_pdb)
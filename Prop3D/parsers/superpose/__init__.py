@@ -1,14 +1,17 @@
 import os
 import re
 
+import numpy as np
 import pandas as pd
 
 from Prop3D.parsers.container import Container
 from Prop3D.util.toil import map_job
+from Prop3D.util import safe_remove
+from Prop3D.util.distance_matrix import CondensedDistanceMatrix, structure_name
 
 from toil.realtimeLogger import RealtimeLogger
 
-def start_one_vs_all_jobs(job, superposer, file_list, table_out_file=None, work_dir=None, cores=1, mem="72G", memory="72G", **kwds):
+def start_one_vs_all_jobs(job, superposer, file_list, table_out_file=None, matrix_file=None, work_dir=None, cores=1, mem="72G", memory="72G", **kwds):
     RealtimeLogger.info("start")
 
     if job is None:
@@ -34,7 +37,7 @@ def start_one_vs_all_jobs(job, superposer, file_list, table_out_file=None, work_
         cores=cores, memory=mem, **kwds)
 
     return job.addFollowOnJobFn(combine_all_vs_all, superposer, file_list, table_out_file=table_out_file,
-        work_dir=work_dir).rv()
+        matrix_file=matrix_file, work_dir=work_dir).rv()
 
 def one_vs_all(job, exp_pdb, file_list, superposer, *args, work_dir=None, **kwds):
     if job is None:
@@ -110,7 +113,10 @@ def one_vs_one(job, exp_pdb, target_pdb, superposer, *args, memory="72G", work_d
     except ImportError:
         raise NotImplementedError("Superposer must have a one_vs_one method")
 
-def combine_all_vs_all(job, superposer, pdbs, table_out_file=None, work_dir=None):
+def combine_all_vs_all(job, superposer, pdbs, table_out_file=None, matrix_file=None, distance="moving_tm_score", work_dir=None):
+    """Combine the one vs all tables. If matrix_file is set, the tables are
+    streamed into a CondensedDistanceMatrix at that path (TM-scores become
+    1-TM-score) and its path is returned instead of a DataFrame"""
     if job is None:
         from toil.job import Job
         job = Job()
@@ -118,8 +124,17 @@ def combine_all_vs_all(job, superposer, pdbs, table_out_file=None, work_dir=None
     if work_dir is None:
         work_dir = job.fileStore.getLocalTempDir()
 
-    distances = None
     results_file = lambda pdb: os.path.join(work_dir, f"{os.path.basename(pdb)}_one_vs_all_{superposer}.dist")
+
+    if matrix_file is not None:
+        matrix = CondensedDistanceMatrix.open_or_create(matrix_file, [structure_name(pdb) for pdb in pdbs])
+        transform = (lambda tm: 1.-tm) if "tm_score" in distance else None
+        matrix.fill_from_tables([results_file(pdb) for pdb in pdbs[:-1]], "chain1", "chain2",
+            distance, transform=transform)
+        matrix.flush()
+        return matrix_file
+
+    distances = None
     for pdb in pdbs[:-1]:
         distance_file = results_file(pdb)
         df = pd.read_csv(distance_file, index_col=False)
@@ -137,6 +152,9 @@ SUPERPOSERS = {}
 class Superpose(Container):
     RULES = {"make_file_list": "make_file_list"}
 
+    #Column of the output table used as the distance by compare_block
+    DISTANCE = "moving_tm_score"
+
     @classmethod
     def __init_subclass__(cls, *args, **kwds):
         global SUPERPOSERS
@@ -170,7 +188,15 @@ class Superpose(Container):
 
         return updated_file_list
 
-    def _distribute_all_vs_all(self, file_list, table_out_file=None, n_jobs=None, **kwds):
+    def _distribute_all_vs_all(self, file_list, table_out_file=None, matrix_file=None, n_jobs=None,
+      tiled=False, sizes=None, **kwds):
+        """Run all vs all as Toil jobs, one per structure, or one per tile of
+        the matrix if tiled is True (see superpose.tiles). Tiles are kept in
+        work_dir, so rerunning resumes from the finished tiles.
+
+        Returns the path to matrix_file if it is set or tiled is True (and
+        writes table_out_file as a csv if set), otherwise the DataFrame of
+        all distances"""
         from toil.common import Toil
         from toil.job import Job
         options = Job.Runner.getDefaultOptions("./toilWorkflowRun")
@@ -186,9 +212,22 @@ class Superpose(Container):
             options.maxNodes = str(n_jobs) if n_jobs is not None else "8" #"96" #str(cores) if cores > 1 else str(multiprocessing.cpu_count())
 
         with Toil(options) as workflow:
-            job = Job.wrapJobFn(start_one_vs_all_jobs, fullname(self), file_list, table_out_file=table_out_file, work_dir=self.work_dir, **kwds)
+            if tiled:
+                from Prop3D.parsers.superpose.tiles import start_tiled_all_vs_all
+                if matrix_file is None:
+                    matrix_file = os.path.join(self.work_dir, "all_vs_all_distances")
+                job = Job.wrapJobFn(start_tiled_all_vs_all, fullname(self), list(file_list),
+                    "file:"+os.path.join(os.path.abspath(self.work_dir), "all_vs_all_tiles"),
+                    matrix_file, sizes=sizes, work_dir=self.work_dir, **kwds)
+            else:
+                job = Job.wrapJobFn(start_one_vs_all_jobs, fullname(self), file_list, table_out_file=table_out_file,
+                    matrix_file=matrix_file, work_dir=self.work_dir, **kwds)
             distance_file = workflow.start(job)
 
+        if tiled and table_out_file is not None:
+            from Prop3D.parsers.superpose.tiles import matrix_to_table
+            matrix_to_table(distance_file, table_out_file, kwds.get("distance", self.DISTANCE))
+
         return distance_file
 
     def all_vs_all(self, pdb_list, table_out_file=None, distributed=False, **kwds):
@@ -200,6 +239,22 @@ class Superpose(Container):
     def one_vs_one(self, moving_pdb_file, fixed_pdb_file, table_out_file=None, **kwds):
         raise NotImplementedError
 
+    def compare_block(self, moving_pdbs, fixed_pdbs, distance=None, **kwds):
+        """Yield (moving, fixed, value of distance) for every pair in a tile
+        (see superpose.tiles). Runs one_vs_all for each moving structure;
+        superposers that can compare two lists at once should override it"""
+        distance = distance if distance is not None else self.DISTANCE
+        table_out_file = self.tempfile()
+        same = list(moving_pdbs) == list(fixed_pdbs)
+        for i, moving_pdb in enumerate(moving_pdbs):
+            fixed = fixed_pdbs[i+1:] if same else fixed_pdbs
+            if len(fixed) == 0:
+                continue
+            self.one_vs_all(moving_pdb, fixed, table_out_file=table_out_file, **kwds)
+            for row in pd.read_csv(table_out_file, usecols=["chain1", "chain2", distance]).itertuples(index=False):
+                yield row
+        safe_remove(table_out_file)
+
     def cluster(self, pdb_list, linkage="ward", centroids=True, **kwds):
         distances = self.all_vs_all(pdb_list, **kwds)
         clusters = self.cluster_from_distances(pdb_list, distances, linkage=linkage, centroids=centroids)
@@ -207,7 +262,14 @@ class Superpose(Container):
             return distances, clusters[0], clusters[1]
         return distances
 
-    def cluster_from_distances(self, pdb_list, distances, linkage="ward", centroids=True):
+    def cluster_from_distances(self, pdb_list, distances, linkage="ward", centroids=True, n_clusters=2, threshold=None):
+        if isinstance(distances, str) and CondensedDistanceMatrix.exists(distances):
+            distances = CondensedDistanceMatrix(distances)
+
+        if isinstance(distances, CondensedDistanceMatrix):
+            return cluster_matrix(distances, linkage=linkage, centroids=centroids,
+                n_clusters=n_clusters, threshold=threshold)
+
         from sklearn.cluster import AgglomerativeClustering
         from sklearn.neighbors import NearestCentroid
         cluster_assignments = AgglomerativeClustering(linkage=linkage).fit_predict(distances)
@@ -223,7 +285,35 @@ class Superpose(Container):
             return df, centroids
         return df
 
+def cluster_matrix(matrix, linkage="ward", centroids=True, n_clusters=2, threshold=None):
+    """Hierarchical clustering of a CondensedDistanceMatrix with scipy.
+    The centroid of each cluster is the member with the smallest mean
+    distance to the other members"""
+    from scipy.cluster.hierarchy import linkage as hierarchical_linkage, fcluster
+
+    n_missing = matrix.missing()
+    if n_missing > 0:
+        raise ValueError("Distance matrix is missing {} pairs".format(n_missing))
+
+    Z = hierarchical_linkage(matrix.distances, method=linkage)
+    if threshold is not None:
+        cluster_assignments = fcluster(Z, threshold, criterion="distance")
+    else:
+        cluster_assignments = fcluster(Z, n_clusters, criterion="maxclust")
+
+    df = pd.DataFrame({"structure":matrix.ids, "cluster":cluster_assignments})
+    if not centroids:
+        return df
+
+    df = df.assign(centroid=None, centroid_dist=np.nan)
+    for cluster, members in df.groupby("cluster").indices.items():
+        submatrix = matrix.submatrix(members)
+        centroid = members[submatrix.mean(axis=1).argmin()]
+        df.loc[df.index[members], "centroid"] = matrix.ids[centroid]
+        df.loc[df.index[members], "centroid_dist"] = matrix.get(members, centroid)
 
+    centroids = df.groupby("centroid")["centroid_dist"].agg(['mean', 'max', 'std'])
+    return df, centroids
 
 def fullname(o):
     klass = o.__class__
@@ -0,0 +1,317 @@
+"""Incremental structure clustering.
+
+A full clustering (tiled all-vs-all and hierarchical clustering, see
+superpose.tiles and superpose.cluster_matrix) is saved as a ClusterState: the
+cluster of every structure, the centroid of every cluster and the distance
+threshold used to cut the tree. When new structures arrive, they are only
+compared against the centroids with the superposer's compare_block. A new
+structure joins the cluster of the closest centroid within that cluster's
+threshold: the distance of its farthest member to the centroid. The cut
+height of the tree is a linkage distance between clusters, not a distance to
+a centroid, so it is only used for singletons, which merge with anything
+closer than the cut height.
+Structures that are not close to any centroid are clustered among
+themselves (leader clustering) and seed new clusters. An update costs
+O(new x clusters) comparisons instead of O(N^2).
+
+Assignments drift from what a full clustering would give, so a full
+recluster can be requested explicitly (recluster=True) or when the number of
+structures has grown by a given fraction since the last full run
+(recluster_growth).
+
+The state is saved in an IOStore under prefix:
+
+    {prefix}/state.json        threshold, distance, linkage and update counts
+    {prefix}/clusters.h5       'assignments' and 'centroids' tables
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from Prop3D.util.iostore import IOStore
+from Prop3D.util.distance_matrix import CondensedDistanceMatrix, structure_name
+from Prop3D.util import safe_remove
+from Prop3D.parsers.superpose.tiles import run_tiled_all_vs_all, to_distance, _load_superposer, \
+    store_string, default_distance
+
+from toil.realtimeLogger import RealtimeLogger
+
+class ClusterState(object):
+    """Clusters and centroids from the last run
+
+    Parameters
+    ----------
+    assignments : pd.DataFrame
+        Columns structure, cluster and centroid_dist
+    centroids : pd.DataFrame
+        Columns cluster, centroid (structure name), centroid_file, threshold
+        (maximum distance of a new member to the centroid) and size
+    threshold : float
+        Height the tree was cut at, also the threshold of singletons and of
+        the clusters seeded by new structures
+    distance : str
+        Column of the superposer output used as the distance
+    """
+    VERSION = 1
+
+    def __init__(self, assignments, centroids, threshold, distance="moving_tm_score",
+      linkage="average", n_updates=0, reclustered_size=None, updated=None):
+        self.assignments = assignments
+        self.centroids = centroids
+        self.threshold = threshold
+        self.distance = distance
+        self.linkage = linkage
+        self.n_updates = n_updates
+        self.reclustered_size = reclustered_size if reclustered_size is not None else len(assignments)
+        self.updated = updated
+
+    @classmethod
+    def from_clusters(cls, clusters, pdbs, threshold, distance="moving_tm_score", linkage="average"):
+        """State from the output of superpose.cluster_matrix"""
+        files = {structure_name(pdb): pdb for pdb in pdbs}
+        assignments = clusters[["structure", "cluster", "centroid_dist"]].reset_index(drop=True)
+        centroids = clusters.groupby("cluster").agg(centroid=("centroid", "first"),
+            size=("structure", "size"), radius=("centroid_dist", "max")).reset_index()
+        radius = centroids.pop("radius")
+        centroids = centroids.assign(
+            centroid_file=centroids["centroid"].map(files),
+            threshold=radius.where(radius > 0, float(threshold)).astype(float))
+        return cls(assignments, centroids, threshold, distance=distance, linkage=linkage)
+
+    @classmethod
+    def load(cls, store, prefix):
+        """Saved state or None if there is none"""
+        store = IOStore.get(store)
+        state_key = "{}/state.json".format(prefix)
+        clusters_key = "{}/clusters.h5".format(prefix)
+        if not store.exists(state_key) or not store.exists(clusters_key):
+            return None
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            store.read_input_file(state_key, os.path.join(work_dir, "state.json"))
+            store.read_input_file(clusters_key, os.path.join(work_dir, "clusters.h5"))
+            with open(os.path.join(work_dir, "state.json")) as f:
+                meta = json.load(f)
+            if meta.get("version") != cls.VERSION:
+                return None
+            assignments = pd.read_hdf(os.path.join(work_dir, "clusters.h5"), "assignments")
+            centroids = pd.read_hdf(os.path.join(work_dir, "clusters.h5"), "centroids")
+        finally:
+            safe_remove([os.path.join(work_dir, "state.json"), os.path.join(work_dir, "clusters.h5")])
+            os.rmdir(work_dir)
+
+        return cls(assignments, centroids, meta["threshold"], distance=meta["distance"],
+            linkage=meta["linkage"], n_updates=meta["n_updates"],
+            reclustered_size=meta["reclustered_size"], updated=meta.get("updated"))
+
+    def save(self, store, prefix, work_dir=None):
+        store = IOStore.get(store)
+        work_dir = tempfile.mkdtemp(dir=work_dir)
+        state_file = os.path.join(work_dir, "state.json")
+        clusters_file = os.path.join(work_dir, "clusters.h5")
+
+        self.updated = time.time()
+        with open(state_file, "w") as f:
+            json.dump({"version": self.VERSION, "threshold": self.threshold,
+                "distance": self.distance, "linkage": self.linkage,
+                "n_updates": self.n_updates, "reclustered_size": self.reclustered_size,
+                "updated": self.updated}, f)
+
+        self.assignments.to_hdf(clusters_file, key="assignments", format="table",
+            complevel=9, complib="bzip2", min_itemsize=1024)
+        self.centroids.to_hdf(clusters_file, key="centroids", format="table",
+            complevel=9, complib="bzip2", min_itemsize=1024)
+
+        #Write the tables first so a reader never sees new state with old tables
+        store.write_output_file(clusters_file, "{}/clusters.h5".format(prefix))
+        store.write_output_file(state_file, "{}/state.json".format(prefix))
+
+        safe_remove([state_file, clusters_file])
+        os.rmdir(work_dir)
+
+    def new_structures(self, pdbs):
+        """pdbs that have not been assigned to a cluster yet"""
+        assigned = set(self.assignments["structure"])
+        return [pdb for pdb in pdbs if structure_name(pdb) not in assigned]
+
+    def _distances(self, superposer, moving_pdbs, fixed_pdbs):
+        """Distances from moving_pdbs (rows) to fixed_pdbs (columns)"""
+        rows = {structure_name(pdb): i for i, pdb in enumerate(moving_pdbs)}
+        cols = {structure_name(pdb): j for j, pdb in enumerate(fixed_pdbs)}
+        same = list(moving_pdbs) == list(fixed_pdbs)
+
+        distances = np.full((len(rows), len(cols)), np.nan)
+        for moving, fixed, value in superposer.compare_block(moving_pdbs, fixed_pdbs,
+          distance=self.distance):
+            moving, fixed = structure_name(moving), structure_name(fixed)
+            if moving in rows and fixed in cols:
+                distances[rows[moving], cols[fixed]] = value
+                if same:
+                    distances[cols[fixed], rows[moving]] = value
+            elif same and fixed in rows and moving in cols:
+                distances[rows[fixed], cols[moving]] = distances[cols[moving], rows[fixed]] = value
+
+        distances = to_distance(distances, self.distance)
+        if same:
+            np.fill_diagonal(distances, 0.)
+        return distances
+
+    def assign(self, superposer, new_pdbs, pdbs=None):
+        """Assign new structures to the closest centroid within its threshold,
+        or seed new clusters
+
+        Parameters
+        ----------
+        superposer : Superpose or MaxCluster instance
+        new_pdbs : list of str
+            Structures that are not in the state yet
+        pdbs : list of str
+            All current structure files, used to find centroid files that
+            have moved since the last run
+
+        Returns
+        -------
+        DataFrame of the new assignments
+        """
+        if len(new_pdbs) == 0:
+            return self.assignments.iloc[:0]
+
+        files = {structure_name(pdb): pdb for pdb in pdbs or []}
+        centroid_files = [files.get(c, f) for c, f in zip(self.centroids["centroid"],
+            self.centroids["centroid_file"])]
+
+        #One vs centroids
+        to_centroids = self._distances(superposer, new_pdbs, centroid_files) if \
+            len(centroid_files) > 0 else np.zeros((len(new_pdbs), 0))
+        within = np.where(np.isnan(to_centroids), False,
+            to_centroids <= self.centroids["threshold"].values[None, :])
+        closest = np.where(within, to_centroids, np.inf).argmin(axis=1) if \
+            len(centroid_files) > 0 else np.zeros(len(new_pdbs), dtype=int)
+        assigned = within.any(axis=1) if len(centroid_files) > 0 else np.zeros(len(new_pdbs), dtype=bool)
+
+        clusters = np.zeros(len(new_pdbs), dtype=int)
+        centroid_dist = np.full(len(new_pdbs), np.nan)
+        clusters[assigned] = self.centroids["cluster"].values[closest[assigned]]
+        centroid_dist[assigned] = to_centroids[assigned, closest[assigned]]
+
+        #Leader clustering of the rest, only against each other
+        rest = np.flatnonzero(~assigned)
+        new_centroids = []
+        if len(rest) > 0:
+            rest_pdbs = [new_pdbs[i] for i in rest]
+            pairwise = self._distances(superposer, rest_pdbs, rest_pdbs) if len(rest) > 1 \
+                else np.zeros((1, 1))
+            next_cluster = int(self.centroids["cluster"].max())+1 if len(self.centroids) > 0 else 1
+            leaders = []
+            for k, i in enumerate(rest):
+                if len(leaders) > 0:
+                    d = pairwise[k, leaders]
+                    best = np.nanargmin(np.where(np.isnan(d), np.inf, d))
+                    if d[best] <= self.threshold:
+                        clusters[i] = clusters[rest[leaders[best]]]
+                        centroid_dist[i] = d[best]
+                        continue
+                leaders.append(k)
+                clusters[i] = next_cluster
+                centroid_dist[i] = 0.
+                new_centroids.append({"cluster": next_cluster, "centroid": structure_name(new_pdbs[i]),
+                    "size": 0, "centroid_file": new_pdbs[i], "threshold": float(self.threshold)})
+                next_cluster += 1
+
+        new_assignments = pd.DataFrame({"structure": [structure_name(pdb) for pdb in new_pdbs],
+            "cluster": clusters, "centroid_dist": centroid_dist})
+
+        self.assignments = pd.concat((self.assignments, new_assignments), ignore_index=True)
+        if len(new_centroids) > 0:
+            self.centroids = pd.concat((self.centroids, pd.DataFrame(new_centroids)), ignore_index=True)
+        sizes = self.assignments["cluster"].value_counts()
+        self.centroids["size"] = self.centroids["cluster"].map(sizes).fillna(0).astype(int)
+        self.n_updates += 1
+
+        RealtimeLogger.info("Assigned {} new structures: {} to existing clusters, {} new clusters".format(
+            len(new_pdbs), int(assigned.sum()), len(new_centroids)))
+
+        return new_assignments
+
+def update_clusters(superposer, pdbs, store, prefix, threshold=None, distance=None,
+  linkage="average", recluster=False, recluster_growth=None, sizes=None, n_jobs=None,
+  work_dir=None, **kwds):
+    """Cluster structures, reusing the clusters from the last run if there
+    are any
+
+    Parameters
+    ----------
+    superposer : str, class or instance
+        Superposer with compare_block, e.g. Prop3D.parsers.MaxCluster.MaxCluster.
+        Instances are only used to assign new structures, a full clustering
+        makes a new instance of the same class for each tile
+    pdbs : list of str
+        All structures, old and new
+    store : str or IOStore
+        Where the cluster state (and the tiles of a full clustering) are kept
+    prefix : str
+        Key prefix of the state in the store, e.g. one per superfamily
+    threshold : float
+        Distance used to cut the tree in a full clustering and to assign new
+        structures. Default is the threshold of the last run
+    distance : str
+        Column of the superposer's output, default is its DISTANCE
+    recluster : bool
+        Run a full all-vs-all clustering even if there is a saved state
+    recluster_growth : float
+        Recluster when the number of structures has grown by this fraction
+        since the last full clustering, e.g. 0.25
+
+    Returns
+    -------
+    ClusterState
+    """
+    if work_dir is None:
+        work_dir = os.getcwd()
+
+    if distance is None:
+        distance = default_distance(superposer)
+
+    state = ClusterState.load(store, prefix)
+
+    if threshold is None:
+        if state is None:
+            raise ValueError("threshold is required for the first clustering")
+        threshold = state.threshold
+
+    full = recluster or state is None or state.distance != distance or \
+        (recluster_growth is not None and len(pdbs) > (1+recluster_growth)*state.reclustered_size)
+
+    if full:
+        from Prop3D.parsers.superpose import cluster_matrix, fullname
+
+        if not isinstance(superposer, (str, type)):
+            #Tiles run in other processes and make their own superposer
+            superposer = fullname(superposer)
+
+        #Tiles are keyed by the structures, so a restart resumes but a new set starts over
+        names_hash = hashlib.sha1("\n".join(structure_name(pdb) for pdb in pdbs).encode("utf-8")).hexdigest()[:16]
+        matrix_file = run_tiled_all_vs_all(superposer, pdbs, store_string(store),
+            os.path.join(work_dir, "all_vs_all_{}".format(names_hash)), sizes=sizes,
+            distance=distance, prefix="{}/tiles/{}".format(prefix, names_hash),
+            n_jobs=n_jobs, work_dir=work_dir, **kwds)
+        clusters, _ = cluster_matrix(CondensedDistanceMatrix(matrix_file), linkage=linkage,
+            threshold=threshold)
+        state = ClusterState.from_clusters(clusters, pdbs, threshold, distance=distance,
+            linkage=linkage)
+        RealtimeLogger.info("Clustered {} structures into {} clusters".format(
+            len(pdbs), len(state.centroids)))
+    else:
+        new_pdbs = state.new_structures(pdbs)
+        if len(new_pdbs) > 0:
+            state.assign(_load_superposer(superposer, work_dir=work_dir), new_pdbs, pdbs)
+
+    state.save(store, prefix, work_dir=work_dir)
+
+    return state
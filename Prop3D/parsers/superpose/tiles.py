@@ -0,0 +1,303 @@
+"""Block-tiled all-vs-all structure comparison.
+
+Structures are split into contiguous blocks so that comparing two blocks is
+expected to take about target_time seconds (a pair of structures of lengths
+L1 and L2 costs about base_time+time_per_unit*L1*L2). Each tile of the upper
+triangle compares one block against another (or against itself) and writes
+a dense float32 block of distances to an IOStore under tiles/<tile id>.npz.
+Tiles that are already in the store are skipped, so a preempted or failed
+run can be restarted with the same arguments. merge_tiles writes every block
+into a CondensedDistanceMatrix.
+
+Superposers must implement compare_block(moving_pdbs, fixed_pdbs, distance)
+and yield (moving, fixed, value) for each pair. distance is a column of the
+superposer's own output (e.g. moving_tm_score for TMAlign, TM for
+MaxCluster); its DISTANCE attribute is used if no distance is given.
+TM-scores (any distance with 'tm' in its name) are stored as 1-TM-score.
+
+Tiles can run as Toil jobs (start_tiled_all_vs_all) or with a local joblib
+pool (run_tiled_all_vs_all).
+"""
+import os
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from Prop3D.util.toil import BatchCostEstimator
+from Prop3D.util.iostore import IOStore
+from Prop3D.util.distance_matrix import CondensedDistanceMatrix, structure_name
+from Prop3D.util import safe_remove
+
+from toil.realtimeLogger import RealtimeLogger
+
+TILE_PREFIX = "tiles"
+
+def pair_cost_estimator():
+    """Cost of comparing one pair of structures, sized by the product of
+    their lengths"""
+    return BatchCostEstimator(time_per_unit=2e-6, base_time=0.05, memory_per_unit=4e3,
+        base_memory=5e8, default_size=200**2)
+
+def to_distance(values, distance):
+    """TM-scores are similarities, use 1-TM-score as the distance"""
+    values = np.asarray(values, dtype=float)
+    return 1.-values if "tm" in distance.lower() else values
+
+def plan_blocks(sizes, target_time=3600, estimator=None):
+    """Split structures into contiguous blocks whose square tile is expected
+    to take about target_time seconds
+
+    Parameters
+    ----------
+    sizes : list of float
+        Length of each structure. None uses the estimator's default
+
+    Returns
+    -------
+    List of (start, stop) rows
+    """
+    if estimator is None:
+        estimator = pair_cost_estimator()
+
+    #The estimator's unit is a pair, i.e. the product of two lengths
+    lengths = [np.sqrt(estimator.size(None if s is None else float(s)**2)) for s in sizes]
+
+    blocks = []
+    start, total_length = 0, 0.
+    for i, length in enumerate(lengths):
+        n = i-start+1
+        tile_time = n*n*estimator.base_time+estimator.time_per_unit*(total_length+length)**2
+        if i > start and tile_time > target_time:
+            blocks.append((start, i))
+            start, total_length = i, 0.
+        total_length += length
+    if len(lengths) > 0:
+        blocks.append((start, len(lengths)))
+
+    return blocks
+
+def plan_tiles(blocks):
+    """Every pair of blocks in the upper triangle as (rows, cols)"""
+    return [(blocks[a], blocks[b]) for a in range(len(blocks)) for b in range(a, len(blocks))]
+
+def tile_id(tile):
+    (r0, r1), (c0, c1) = tile
+    return "{}-{}_{}-{}".format(r0, r1, c0, c1)
+
+def tile_key(tile, prefix=TILE_PREFIX):
+    return "{}/{}.npz".format(prefix, tile_id(tile))
+
+def pending_tiles(store, tiles, prefix=TILE_PREFIX):
+    """Tiles that are not in the store yet"""
+    store = IOStore.get(store)
+    keys = {tile_key(tile, prefix): tile for tile in tiles}
+    exists = store.exists_many(list(keys.keys()))
+    return [tile for key, tile in keys.items() if not exists.get(key, False)]
+
+def default_distance(superposer):
+    """Column of the superposer's output used when no distance is given"""
+    from Prop3D.parsers.superpose import load_class
+    if isinstance(superposer, str):
+        superposer = load_class(superposer)
+    return getattr(superposer, "DISTANCE", "moving_tm_score")
+
+def _load_superposer(superposer, job=None, work_dir=None):
+    """Superposer instance from a class, its full name or an instance"""
+    from Prop3D.parsers.superpose import load_class
+    if isinstance(superposer, str):
+        superposer = load_class(superposer)
+    if not isinstance(superposer, type):
+        return superposer
+    return superposer(job=job, work_dir=work_dir)
+
+def run_tile(job, tile, pdbs, superposer, store, distance=None, prefix=TILE_PREFIX,
+  work_dir=None, **kwds):
+    """Compare the structures of one tile and save the block of distances"""
+    if distance is None:
+        distance = default_distance(superposer)
+
+    if work_dir is None:
+        work_dir = job.fileStore.getLocalTempDir() if job is not None else os.getcwd()
+
+    store = IOStore.get(store)
+    key = tile_key(tile, prefix)
+    if store.exists(key):
+        return key
+
+    (r0, r1), (c0, c1) = tile
+    rows = {structure_name(pdb): i for i, pdb in enumerate(pdbs[r0:r1])}
+    cols = {structure_name(pdb): j for j, pdb in enumerate(pdbs[c0:c1])}
+
+    block = np.full((r1-r0, c1-c0), np.nan, dtype=np.float32)
+    superposer = _load_superposer(superposer, job=job, work_dir=work_dir)
+    for moving, fixed, value in superposer.compare_block(pdbs[r0:r1], pdbs[c0:c1],
+      distance=distance, **kwds):
+        moving, fixed = structure_name(moving), structure_name(fixed)
+        if moving in rows and fixed in cols:
+            block[rows[moving], cols[fixed]] = value
+        elif fixed in rows and moving in cols:
+            block[rows[fixed], cols[moving]] = value
+
+    block = to_distance(block, distance).astype(np.float32)
+
+    fd, block_file = tempfile.mkstemp(suffix=".npz", dir=work_dir)
+    os.close(fd)
+    np.savez_compressed(block_file, distances=block, rows=np.array([r0, r1]),
+        cols=np.array([c0, c1]))
+    store.write_output_file(block_file, key)
+    safe_remove(block_file)
+
+    RealtimeLogger.info("Finished tile {} ({} pairs)".format(tile_id(tile), block.size))
+
+    return key
+
+def merge_tiles(job, pdbs, store, matrix_file, prefix=TILE_PREFIX, work_dir=None):
+    """Write every tile in the store into a CondensedDistanceMatrix at
+    matrix_file. Returns matrix_file"""
+    if work_dir is None:
+        work_dir = job.fileStore.getLocalTempDir() if job is not None else os.getcwd()
+
+    store = IOStore.get(store)
+    matrix = CondensedDistanceMatrix.open_or_create(matrix_file, [structure_name(pdb) for pdb in pdbs])
+
+    n_tiles = 0
+    for name in store.list_input_directory(prefix):
+        if not name.endswith(".npz"):
+            continue
+        #Some stores list names relative to prefix, others full keys
+        key = "{}/{}".format(prefix, os.path.basename(name))
+        block_file = os.path.join(work_dir, os.path.basename(key))
+        store.read_input_file(key, block_file)
+        with np.load(block_file) as tile:
+            (r0, r1), (c0, c1) = tile["rows"], tile["cols"]
+            rows, cols = np.meshgrid(np.arange(r0, r1), np.arange(c0, c1), indexing="ij")
+            distances = tile["distances"]
+            #Tiles on the diagonal only have one of (i, j) and (j, i)
+            found = ~np.isnan(distances)
+            matrix.set(rows[found], cols[found], distances[found])
+        safe_remove(block_file)
+        n_tiles += 1
+
+    matrix.flush()
+    RealtimeLogger.info("Merged {} tiles into {} ({} pairs missing)".format(
+        n_tiles, matrix_file, matrix.missing()))
+
+    return matrix_file
+
+def matrix_to_table(matrix_file, table_out_file, distance):
+    """Write every pair of a merged matrix to a csv like the one vs all tables
+    (chain1, chain2, distance). TM-scores are converted back from 1-TM-score"""
+    matrix = CondensedDistanceMatrix(matrix_file)
+    i, j = np.triu_indices(matrix.n, k=1)
+    ids = np.array(matrix.ids, dtype=object)
+    pd.DataFrame({"chain1": ids[i], "chain2": ids[j],
+        distance: to_distance(matrix.distances[:], distance)}).to_csv(table_out_file, index=False)
+    return table_out_file
+
+def _plan(store, pdbs, sizes, target_time, estimator, prefix):
+    """Tiles still to run. The structure list is saved with the tiles so a
+    restart with different structures is caught"""
+    store = IOStore.get(store)
+    names = [structure_name(pdb) for pdb in pdbs]
+    ids_key = "{}/ids.json".format(prefix)
+    if store.exists(ids_key):
+        fd, ids_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        store.read_input_file(ids_key, ids_file)
+        with open(ids_file) as f:
+            saved_names = json.load(f)
+        safe_remove(ids_file)
+        if saved_names != names:
+            raise ValueError("Tiles in {} were computed for different structures".format(prefix))
+    else:
+        fd, ids_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(names, f)
+        store.write_output_file(ids_file, ids_key)
+        safe_remove(ids_file)
+
+    blocks = plan_blocks(sizes if sizes is not None else [None]*len(pdbs),
+        target_time=target_time, estimator=estimator)
+    tiles = plan_tiles(blocks)
+    to_run = pending_tiles(store, tiles, prefix)
+
+    RealtimeLogger.info("All vs all of {} structures: {} blocks, {} tiles, {} to run".format(
+        len(pdbs), len(blocks), len(tiles), len(to_run)))
+
+    return to_run
+
+def _tile_memory(tile, sizes, estimator):
+    (r0, r1), (c0, c1) = tile
+    if sizes is None:
+        largest = None
+    else:
+        largest = max((s for s in list(sizes[r0:r1])+list(sizes[c0:c1]) if s is not None), default=None)
+    return int(estimator.estimate_memory(None if largest is None else float(largest)**2))
+
+def store_string(store):
+    """Tiles run in other processes, so stores are passed by their string.
+    Store instances hold locks and boto clients that cannot be pickled"""
+    return store if isinstance(store, str) else store.store_string
+
+def start_tiled_all_vs_all(job, superposer, pdbs, store, matrix_file, sizes=None,
+  distance=None, target_time=3600, estimator=None, prefix=TILE_PREFIX,
+  work_dir=None, **kwds):
+    """Run every missing tile as a Toil job, then merge all tiles into
+    matrix_file
+
+    Parameters
+    ----------
+    superposer : str
+        Full name of the superposer class, e.g.
+        Prop3D.parsers.superpose.tmalign.TMAlign
+    pdbs : list of str
+    store : str or IOStore
+        IOStore to save tiles in, e.g. file:/scratch/tiles or aws:us-east-1:bucket
+    sizes : list of float
+        Length of each structure, used to size tiles
+    distance : str
+        Column of the superposer's output, default is its DISTANCE
+    """
+    if distance is None:
+        distance = default_distance(superposer)
+
+    if estimator is None:
+        estimator = pair_cost_estimator()
+
+    store = store_string(store)
+    to_run = _plan(store, pdbs, sizes, target_time, estimator, prefix)
+
+    for tile in to_run:
+        #Toil requirements come from the tile size instead of a fixed amount
+        job.addChildJobFn(run_tile, tile, pdbs, superposer, store, distance=distance,
+            prefix=prefix, work_dir=work_dir, memory=_tile_memory(tile, sizes, estimator),
+            **kwds)
+
+    return job.addFollowOnJobFn(merge_tiles, pdbs, store, matrix_file, prefix=prefix).rv()
+
+def run_tiled_all_vs_all(superposer, pdbs, store, matrix_file, sizes=None,
+  distance=None, target_time=3600, estimator=None, prefix=TILE_PREFIX,
+  n_jobs=None, work_dir=None, **kwds):
+    """Run every missing tile with a local joblib pool, then merge all tiles
+    into matrix_file. Parameters are the same as start_tiled_all_vs_all"""
+    from joblib import Parallel, delayed
+
+    if distance is None:
+        distance = default_distance(superposer)
+
+    if estimator is None:
+        estimator = pair_cost_estimator()
+
+    if work_dir is None:
+        work_dir = os.getcwd()
+
+    store = store_string(store)
+    to_run = _plan(store, pdbs, sizes, target_time, estimator, prefix)
+
+    Parallel(n_jobs=n_jobs or os.cpu_count() or 1)(delayed(run_tile)(None, tile, pdbs,
+        superposer, store, distance=distance, prefix=prefix, work_dir=work_dir, **kwds) \
+        for tile in to_run)
+
+    return merge_tiles(None, pdbs, store, matrix_file, prefix=prefix, work_dir=work_dir)
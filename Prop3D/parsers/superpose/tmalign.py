@@ -1,6 +1,10 @@
 import os
 import re
+
+import pandas as pd
+
 from Prop3D.parsers.superpose import Superpose
+from Prop3D.util import safe_remove
 
 from toil.realtimeLogger import RealtimeLogger
 
@@ -61,6 +65,20 @@ class TMAlign(Superpose):
     def one_vs_one(self, moving_pdb_file, fixed_pdb_file, table_out_file=None, **kwds):
         return self(table_out_file=table_out_file, moving_pdb_file=moving_pdb_file, fixed_pdb_file=fixed_pdb_file, **kwds)
 
+    def compare_block(self, moving_pdbs, fixed_pdbs, distance=None, **kwds):
+        """Compare two lists in one TM-align run (-dir1/-dir2), or all pairs
+        of one list (-dir) for tiles on the diagonal"""
+        distance = distance if distance is not None else self.DISTANCE
+        table_out_file = self.tempfile()
+        if list(moving_pdbs) == list(fixed_pdbs):
+            self(table_out_file=table_out_file, total=len(moving_pdbs)**2, dir=moving_pdbs, **kwds)
+        else:
+            self(table_out_file=table_out_file, total=len(moving_pdbs)*len(fixed_pdbs),
+                dir1=moving_pdbs, dir2=fixed_pdbs, **kwds)
+        for row in pd.read_csv(table_out_file, usecols=["chain1", "chain2", distance]).itertuples(index=False):
+            yield row
+        safe_remove(table_out_file)
+
     def __call__(self, table_out_file=None, total=None, include_fixed=True, **kwds):
         output = super().__call__(**kwds)
         if table_out_file is None:
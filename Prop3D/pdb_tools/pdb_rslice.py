@@ -57,7 +57,18 @@ def check_input(args):
         sys.stderr.write(USAGE)
         sys.exit(1)
 
-    # Parse st and end of slices
+    try:
+        _rslices = parse_rslices(rslice)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    return (_rslices, pdbfh)
+
+
+def parse_rslices(rslice):
+    """Parse st and end of slices"""
     _rslices = []
     for _rslice in rslice:
         match = re.match('([\-0-9A-Z]*):([\-0-9A-Z]*)', _rslice)
@@ -73,12 +84,10 @@ def check_input(args):
                 st_slice = match.group()
                 en_slice = None
             else:
-                sys.stderr.write('Invalid slice: ' + _rslice + '\n')
-                sys.stderr.write(USAGE)
-                sys.exit(1)
+                raise ValueError('Invalid slice: ' + _rslice)
         _rslices.append((st_slice, en_slice))
 
-    return (_rslices, pdbfh)
+    return _rslices
 
 
 def _slice_pdb(fhandle, rslice):
@@ -0,0 +1,123 @@
+"""
+In-process version of piping several pdb_tools scripts together, e.g.
+
+    pdb_selmodel.py -1 1abc.pdb | pdb_selchain.py -A | pdb_delocc.py | pdb_tidy.py
+
+is the same as
+
+    pipeline("1abc.pdb").selmodel(1).selchain("A").delocc().tidy().write("out.pdb")
+
+Each step reuses the generator from the matching pdb_*.py script and the file
+is streamed through all of the steps in a single pass, without starting a new
+interpreter for each step. Lines are re-split between steps exactly like a
+pipe would, so the output is the same as the scripts.
+"""
+
+import gzip
+
+from Prop3D.pdb_tools.pdb_selmodel import _select_model
+from Prop3D.pdb_tools.pdb_selchain import _select_chain
+from Prop3D.pdb_tools.pdb_delocc import _remove_double_occupancies
+from Prop3D.pdb_tools.pdb_striphet import _remove_hetatm
+from Prop3D.pdb_tools.pdb_stripheader import _remove_header
+from Prop3D.pdb_tools.pdb_rslice import _slice_pdb, parse_rslices
+from Prop3D.pdb_tools.pdb_tidy import _tidy_structure
+from Prop3D.pdb_tools.pdb_chain import _alter_chain
+
+def _relines(lines):
+    """Join and re-split the output of a step into lines, the same as reading
+    it back through a pipe. Some steps yield lines without a newline (e.g.
+    'END' from pdb_selmodel) or strip and re-add them"""
+    pending = ""
+    for line in lines:
+        pending += line
+        if "\n" not in line:
+            continue
+        *complete, pending = pending.split("\n")
+        for complete_line in complete:
+            yield complete_line+"\n"
+    if pending != "":
+        yield pending
+
+class PDBPipeline(object):
+    """Chain of pdb_tools steps over one PDB file.
+
+    Parameters
+    ----------
+    source : str or iterable
+        Path to PDB file (can be gzipped) or an iterable of lines
+    """
+    def __init__(self, source):
+        self.source = source
+        self.steps = []
+        self.prep_steps = []
+
+    def _add(self, func, args, description):
+        self.steps.append((func, args))
+        self.prep_steps.append(description)
+        return self
+
+    def selmodel(self, model=1):
+        """Select model (pdb_selmodel.py -<model>)"""
+        return self._add(_select_model, (str(model),), "pdb_selmodel.py -{}".format(model))
+
+    def selchain(self, chain):
+        """Select one or more chains (pdb_selchain.py -<chain>)"""
+        return self._add(_select_chain, (chain,), "pdb_selchain.py -{}".format(chain))
+
+    def delocc(self):
+        """Remove alternate locations (pdb_delocc.py)"""
+        return self._add(_remove_double_occupancies, (), "pdb_delocc.py")
+
+    def striphet(self):
+        """Remove HETATMs (pdb_striphet.py)"""
+        return self._add(_remove_hetatm, (), "pdb_striphet.py")
+
+    def stripheader(self):
+        """Remove header records (pdb_stripheader.py)"""
+        return self._add(_remove_header, (), "pdb_stripheader.py")
+
+    def rslice(self, *rslices):
+        """Select residue ranges given as strings such as '10:50' (pdb_rslice.py)"""
+        return self._add(_slice_pdb, (parse_rslices(rslices),),
+            "pdb_rslice.py {}".format(" ".join(rslices)))
+
+    def tidy(self):
+        """Add TER records between gaps and END (pdb_tidy.py)"""
+        return self._add(_tidy_structure, (), "pdb_tidy.py")
+
+    def chain(self, chain_id):
+        """Rename chain (pdb_chain.py -<chain_id>)"""
+        return self._add(_alter_chain, (chain_id,), "pdb_chain.py -{}".format(chain_id))
+
+    def _open(self):
+        if isinstance(self.source, str):
+            if self.source.endswith(".gz"):
+                return gzip.open(self.source, "rt")
+            return open(self.source)
+        return None
+
+    def __iter__(self):
+        fh = self._open()
+        try:
+            lines = fh if fh is not None else iter(self.source)
+            for func, args in self.steps:
+                lines = _relines(func(iter(lines), *args))
+            for line in lines:
+                yield line
+        finally:
+            if fh is not None:
+                fh.close()
+
+    def write(self, output):
+        """Run the pipeline and write it to a file path or open file handle"""
+        if isinstance(output, str):
+            with open(output, "w") as fh:
+                fh.writelines(self)
+        else:
+            output.writelines(self)
+        return output
+
+def pipeline(source):
+    """Start a PDBPipeline from a path or iterable of lines"""
+    return PDBPipeline(source)
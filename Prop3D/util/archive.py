@@ -0,0 +1,207 @@
+"""Seekable directory archives with independently compressed blocks.
+
+Files are split into blocks that are compressed in parallel with zstd (if the
+zstandard package is installed) or gzip. An index of every member and the
+offsets of its blocks is written at the end of the archive, so a reader can
+extract one file, or files matching a glob, without decompressing the rest.
+Archives can be written to non-seekable streams (e.g. Toil's
+writeGlobalFileStream). Each gzip block is a complete gzip member.
+
+Layout:
+
+    MAGIC | block | block | ... | index (zlib JSON) | index offset, index length, MAGIC
+"""
+import os
+import json
+import zlib
+import struct
+import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+    have_zstd = True
+except ImportError:
+    have_zstd = False
+
+MAGIC = b"P3DARC01"
+FOOTER = struct.Struct("<QQ8s")
+BLOCK_SIZE = 4*1024*1024
+
+def default_codec():
+    return "zstd" if have_zstd else "gzip"
+
+def _compress(data, codec, level=None):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    elif codec == "gzip":
+        compressor = zlib.compressobj(level or 6, zlib.DEFLATED, 31)
+        return compressor.compress(data)+compressor.flush()
+    elif codec == "none":
+        return data
+    raise ValueError("Unknown codec {}".format(codec))
+
+def _decompress(data, codec):
+    if codec == "zstd":
+        if not have_zstd:
+            raise RuntimeError("zstandard must be installed to read this archive")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "gzip":
+        return zlib.decompress(data, 31)
+    elif codec == "none":
+        return data
+    raise ValueError("Unknown codec {}".format(codec))
+
+def _walk(path):
+    """Yield (arcname, full path, is_dir) for everything under path"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        rel_root = os.path.relpath(root, path)
+        for d in dirs:
+            yield os.path.normpath(os.path.join(rel_root, d)), os.path.join(root, d), True
+        for f in sorted(files):
+            yield os.path.normpath(os.path.join(rel_root, f)), os.path.join(root, f), False
+
+def _read_block(file_path, offset, size):
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+def write_archive(path, file_handle, codec=None, threads=None, level=None,
+  block_size=BLOCK_SIZE):
+    """Write the contents of directory path to an open binary file handle
+
+    Parameters
+    ----------
+    path : str
+        Directory to archive. Its own name is not stored
+    file_handle : file-like
+        Binary handle to write to. Does not need to be seekable
+    codec : 'zstd', 'gzip' or 'none'
+        Compression of each block. Default is zstd if installed, else gzip
+    threads : int
+        Number of blocks compressed at once. Default is all cores
+
+    Returns
+    -------
+    The index of the archive
+    """
+    codec = codec or default_codec()
+    threads = threads or os.cpu_count() or 1
+
+    members = []
+    blocks = []
+    for arcname, full_path, is_dir in _walk(path):
+        st = os.stat(full_path)
+        member = {"name": arcname, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime,
+            "type": "dir" if is_dir else "file", "size": 0 if is_dir else st.st_size,
+            "blocks": []}
+        members.append(member)
+        if not is_dir:
+            for offset in range(0, st.st_size, block_size):
+                blocks.append((member, full_path, offset, min(block_size, st.st_size-offset)))
+
+    def compress(block):
+        _, file_path, offset, size = block
+        return _compress(_read_block(file_path, offset, size), codec, level)
+
+    file_handle.write(MAGIC)
+    position = len(MAGIC)
+
+    #Compress blocks in parallel, but keep a bounded number in memory and
+    #write them in order
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        blocks = iter(blocks)
+        for block in blocks:
+            pending.append((block[0], pool.submit(compress, block)))
+            if len(pending) >= 2*threads:
+                position = _write_block(file_handle, position, *pending.popleft())
+        while len(pending) > 0:
+            position = _write_block(file_handle, position, *pending.popleft())
+
+    index = {"version": 1, "codec": codec, "members": members}
+    index_data = zlib.compress(json.dumps(index).encode("utf-8"))
+    file_handle.write(index_data)
+    file_handle.write(FOOTER.pack(position, len(index_data), MAGIC))
+
+    return index
+
+def _write_block(file_handle, position, member, future):
+    data = future.result()
+    file_handle.write(data)
+    member["blocks"].append((position, len(data)))
+    return position+len(data)
+
+def is_archive(file_path):
+    """True if file_path is an indexed archive (as opposed to a tar file)"""
+    with open(file_path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_index(file_path):
+    with open(file_path, "rb") as f:
+        f.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, index_length, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not an indexed archive".format(file_path))
+        f.seek(index_offset)
+        return json.loads(zlib.decompress(f.read(index_length)).decode("utf-8"))
+
+def list_members(file_path):
+    return [m["name"] for m in read_index(file_path)["members"]]
+
+def select_members(names, members=None):
+    """Names matching any of members (names or glob patterns). All if None"""
+    if members is None:
+        return list(names)
+    if isinstance(members, str):
+        members = [members]
+    return [n for n in names if any(n == m or fnmatch.fnmatch(n, m) for m in members)]
+
+def _is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+def extract_archive(file_path, path, members=None, threads=None):
+    """Extract an indexed archive into directory path
+
+    Parameters
+    ----------
+    members : str or list of str
+        Names or glob patterns of members to extract. Only the blocks of the
+        matching members are read. Default is everything
+
+    Returns
+    -------
+    List of extracted member names
+    """
+    index = read_index(file_path)
+    codec = index["codec"]
+    by_name = {m["name"]: m for m in index["members"]}
+    selected = select_members(by_name.keys(), members)
+
+    for name in selected:
+        if not _is_within_directory(path, os.path.join(path, name)):
+            raise Exception("Attempted Path Traversal in Archive")
+
+    def extract(name):
+        member = by_name[name]
+        out_path = os.path.join(path, name)
+        if member["type"] == "dir":
+            os.makedirs(out_path, exist_ok=True)
+            return name
+
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        with open(file_path, "rb") as f, open(out_path, "wb") as out:
+            for offset, length in member["blocks"]:
+                f.seek(offset)
+                out.write(_decompress(f.read(length), codec))
+        os.chmod(out_path, member["mode"])
+        os.utime(out_path, (member["mtime"], member["mtime"]))
+        return name
+
+    os.makedirs(path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+        return list(pool.map(extract, selected))
@@ -0,0 +1,391 @@
+"""Size-bounded local file caches that can be shared by processes on one node.
+
+LRUFileCache keeps files in a directory, keyed by any string. Access updates
+the file mtime. When the total size goes over the byte budget, the least
+recently used entries are removed. Entries are written to a temporary file
+and moved into place, so readers never see partial files. Eviction and
+stats updates hold an exclusive file lock on the cache directory.
+
+ArtifactCache is built on LRUFileCache. It stores outputs of a pipeline
+stage keyed by the hash of the stage's input file and its parameters, so a
+rerun can skip every stage that has already finished for the same input.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from Prop3D.util import safe_remove
+
+def file_hash(path, block_size=1<<20):
+    """sha256 of the contents of a file"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def parse_size(size):
+    """
+    >>> parse_size("10G")
+    10737418240
+    """
+    if size is None or isinstance(size, (int, float)):
+        return size
+    units = {"K":1024, "M":1024**2, "G":1024**3, "T":1024**4}
+    size = size.strip().upper().rstrip("IB")
+    if size[-1] in units:
+        return int(float(size[:-1])*units[size[-1]])
+    return int(float(size))
+
+class LRUFileCache(object):
+    """Local file cache with a byte budget and LRU eviction
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to store files in. Can be shared by processes on one node
+    max_bytes : int or str
+        Byte budget (e.g. '20G'). None for no limit
+    """
+    STATS_FILE = "stats.json"
+    LOCK_FILE = ".lock"
+    LOCK_STRIPES = 256
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = parse_size(max_bytes)
+        self.data_dir = os.path.join(cache_dir, "data")
+        self.lock_dir = os.path.join(cache_dir, "locks")
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._stats = {"hits":0, "misses":0, "bytes_saved":0, "seconds_saved":0.,
+            "evictions":0}
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        h = self.hash_key(key)
+        return os.path.join(self.data_dir, h[:2], h)
+
+    def meta_path(self, key):
+        return self.path(key)+".json"
+
+    @contextmanager
+    def lock(self):
+        with open(os.path.join(self.cache_dir, self.LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def key_lock(self, key):
+        """Exclusive lock on one key so only one process fills a missing entry.
+        Keys share a fixed pool of LOCK_STRIPES lock files, so lock files do
+        not pile up for entries that were evicted"""
+        stripe = int(self.hash_key(key)[:8], 16)%self.LOCK_STRIPES
+        lock_path = os.path.join(self.lock_dir, "{}.lock".format(stripe))
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update_meta(self, key, **meta):
+        """Update the metadata of an existing entry"""
+        current = self.get_meta(key)
+        if current is None:
+            return
+        current.update(meta)
+        meta_tmp = "{}.{}.tmp".format(self.meta_path(key), os.getpid())
+        with open(meta_tmp, "w") as f:
+            json.dump(current, f)
+        os.replace(meta_tmp, self.meta_path(key))
+
+    def get_meta(self, key):
+        try:
+            with open(self.meta_path(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key, output_file=None, record=True):
+        """Copy a cached file to output_file (or return the cached path if
+        output_file is None). Returns None on a miss"""
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+            if output_file is not None:
+                shutil.copyfile(path, output_file)
+            else:
+                output_file = path
+        except (IOError, OSError):
+            if record:
+                self._stats["misses"] += 1
+            return None
+
+        if record:
+            meta = self.get_meta(key) or {}
+            self._stats["hits"] += 1
+            self._stats["bytes_saved"] += os.path.getsize(output_file)
+            self._stats["seconds_saved"] += meta.get("runtime", 0.)
+
+        return output_file
+
+    def record_miss(self, n=1):
+        """Count misses for entries filled outside of get"""
+        self._stats["misses"] += n
+
+    def put(self, key, input_file, meta=None, move=False):
+        """Add a file to the cache, replacing any older entry. Returns the
+        cached path"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        os.close(fd)
+        if move:
+            shutil.move(input_file, tmp_path)
+        else:
+            shutil.copyfile(input_file, tmp_path)
+
+        if meta is not None:
+            meta_tmp = tmp_path+".json"
+            with open(meta_tmp, "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_tmp, self.meta_path(key))
+
+        os.replace(tmp_path, path)
+
+        if self.max_bytes is not None:
+            self.evict()
+
+        return path
+
+    def remove(self, key):
+        safe_remove([self.path(key), self.meta_path(key)])
+
+    def entries(self):
+        """(path, size, last access) of every cached file. Metadata without a
+        file (e.g. recorded failures) is an entry of its own"""
+        entries = []
+        for root, _, files in os.walk(self.data_dir):
+            names = set(files)
+            for f in files:
+                if f.endswith(".lock") or f.startswith(".tmp"):
+                    continue
+                if f.endswith(".json") and f[:-5] in names:
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used files until the cache fits in max_bytes"""
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        if max_bytes is None:
+            return 0
+
+        removed = 0
+        with self.lock():
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                if total <= max_bytes:
+                    break
+                safe_remove([path, path+".json"])
+                total -= size
+                removed += 1
+
+        self._stats["evictions"] += removed
+        return removed
+
+    def stats(self, save=True):
+        """Hits, misses, hit rate, bytes and seconds saved by this process and
+        in total for all processes using this cache. Counts from this process
+        are added to the shared totals when save is True"""
+        stats_file = os.path.join(self.cache_dir, self.STATS_FILE)
+        with self.lock():
+            try:
+                with open(stats_file) as f:
+                    total = json.load(f)
+            except (IOError, OSError, ValueError):
+                total = {}
+
+            for k, v in self._stats.items():
+                total[k] = total.get(k, 0)+v
+
+            if save:
+                with open(stats_file+".tmp", "w") as f:
+                    json.dump(total, f)
+                os.replace(stats_file+".tmp", stats_file)
+                current = dict(self._stats)
+                self._stats = {k:0 for k in self._stats}
+            else:
+                current = dict(self._stats)
+
+        for stats in (current, total):
+            requests = stats.get("hits", 0)+stats.get("misses", 0)
+            stats["hit_rate"] = stats.get("hits", 0)/requests if requests > 0 else 0.
+
+        return {"process":current, "total":total}
+
+class ArtifactCache(LRUFileCache):
+    """Content-addressed cache for the outputs of pipeline stages. An entry is
+    keyed by the stage name, the hash of its input file and its parameters.
+    Failed stages can also be recorded so a rerun goes straight to the next
+    fallback. Recorded failures expire after failure_ttl, so stages that
+    failed from a transient error are retried.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local cache directory
+    max_bytes : int or str
+        Byte budget of the local cache
+    store : IOStore
+        Optional shared store. Entries missing locally are read from it, and
+        new entries are written to both
+    failure_ttl : float
+        Seconds a recorded failure is used before the stage is run again.
+        Default is one day
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir, max_bytes=None, store=None, failure_ttl=86400):
+        super().__init__(cache_dir, max_bytes=max_bytes)
+        self.store = store
+        self.failure_ttl = float(failure_ttl) if failure_ttl is not None else None
+
+    @classmethod
+    def from_env(cls, store=None):
+        """Cache from PROP3D_PREP_CACHE (directory), PROP3D_PREP_CACHE_SIZE and
+        PROP3D_PREP_CACHE_FAILURE_TTL, or None if PROP3D_PREP_CACHE is not set"""
+        cache_dir = os.environ.get("PROP3D_PREP_CACHE")
+        if cache_dir is None:
+            return None
+        return cls(cache_dir, max_bytes=os.environ.get("PROP3D_PREP_CACHE_SIZE"), store=store,
+            failure_ttl=os.environ.get("PROP3D_PREP_CACHE_FAILURE_TTL", 86400))
+
+    def stage_key(self, stage_name, input_file, params=None):
+        params = json.dumps(params or {}, sort_keys=True, default=str)
+        return "{}/{}/{}/{}".format(self.VERSION, stage_name, file_hash(input_file),
+            hashlib.sha256(params.encode("utf-8")).hexdigest()[:16])
+
+    def _store_key(self, key):
+        return "{}.pdb".format(key)
+
+    def get_stage(self, stage_name, input_file, output_file, params=None):
+        """Copy the cached output of stage for input_file to output_file.
+
+        Returns
+        -------
+        output_file on a hit, None on a miss. Raises StageFailed if the stage
+        is known to fail for this input
+        """
+        key = self.stage_key(stage_name, input_file, params)
+        meta = self.get_meta(key)
+        if meta is not None and meta.get("failed", False) and self.failure_ttl is not None and \
+          time.time()-meta.get("created", 0.) > self.failure_ttl:
+            #Failure has expired, run the stage again
+            safe_remove(self.meta_path(key))
+            meta = None
+        if meta is not None and meta.get("failed", False):
+            self._stats["hits"] += 1
+            self._stats["seconds_saved"] += meta.get("runtime", 0.)
+            raise StageFailed(stage_name, meta.get("error", ""))
+
+        if self.get(key, output_file, record=self.store is None) is not None:
+            if self.store is not None:
+                self._stats["hits"] += 1
+                self._stats["bytes_saved"] += os.path.getsize(output_file)
+                self._stats["seconds_saved"] += (meta or {}).get("runtime", 0.)
+            return output_file
+
+        if self.store is not None:
+            try:
+                if self.store.exists(self._store_key(key)):
+                    self.store.read_input_file(self._store_key(key), output_file)
+                    self.put(key, output_file, meta={"stage":stage_name})
+                    self._stats["hits"] += 1
+                    self._stats["bytes_saved"] += os.path.getsize(output_file)
+                    return output_file
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                pass
+            self._stats["misses"] += 1
+
+        return None
+
+    def put_stage(self, stage_name, input_file, output_file, params=None, runtime=0.):
+        key = self.stage_key(stage_name, input_file, params)
+        self.put(key, output_file, meta={"stage":stage_name, "runtime":runtime,
+            "created":time.time()})
+        if self.store is not None:
+            try:
+                self.store.write_output_file(output_file, self._store_key(key))
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                pass
+
+    def put_failure(self, stage_name, input_file, error, params=None, runtime=0.):
+        key = self.stage_key(stage_name, input_file, params)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(self.meta_path(key), "w") as f:
+            json.dump({"stage":stage_name, "failed":True, "error":error,
+                "runtime":runtime, "created":time.time()}, f)
+
+    def run_stage(self, stage_name, func, input_file, output_file=None, params=None,
+      cache_failures=False):
+        """Run func(input_file) unless its output is cached. The output is
+        copied to output_file, or to the path func returned the first time.
+        If cache_failures is True, an exception is recorded so reruns raise
+        StageFailed without running func until the failure expires"""
+        if output_file is None:
+            output_file = "{}.{}.pdb".format(os.path.splitext(input_file)[0], stage_name)
+
+        if self.get_stage(stage_name, input_file, output_file, params=params) is not None:
+            return output_file
+
+        start = time.time()
+        try:
+            result = func(input_file)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            if cache_failures:
+                import traceback
+                self.put_failure(stage_name, input_file, traceback.format_exc(),
+                    params=params, runtime=time.time()-start)
+            raise
+
+        self.put_stage(stage_name, input_file, result, params=params, runtime=time.time()-start)
+        return result
+
+class StageFailed(RuntimeError):
+    def __init__(self, stage_name, error):
+        super().__init__("{} previously failed for this input:\n{}".format(stage_name, error))
+        self.stage_name = stage_name
+        self.error = error
@@ -4,7 +4,7 @@ import pandas as pd
 
 from Prop3D.util.iostore import IOStore
 from Prop3D.parsers.cath import CATHApi
-from Prop3D.util.hdf import get_file, filter_hdf, filter_hdf_chunks
+from Prop3D.util.hdf import get_file, filter_hdf, read_hdf_table, to_hdf_table
 from Prop3D.util.toil import map_job
 from Prop3D.util import safe_remove
 from Prop3D.generate_data import data_stores
@@ -90,15 +90,16 @@ def run_cath_hierarchy(job, cathcode, func, cathFileStoreID, *args, **kwds):
 
         remove_store = False
         if "cathCodeStoreID" not in kwds:
-            cathcodes = filter_hdf_chunks(
+            cathcodes = read_hdf_table(
                 cath_file,
                 "table",
                 columns=cath_names,
                 drop_duplicates=True)
             safe_remove(cath_file, warn=True)
             cath_file = os.path.join(work_dir, "cathCodeStore.h5")
-            cathcodes.to_hdf(cath_file, "table", format="table",
-                complevel=9, complib="bzip2", min_itemsize=1024)
+            #Every level is a data column so each step down the hierarchy is a
+            #where, except class, which read_hdf_table has to mask
+            to_hdf_table(cathcodes, cath_file, "table", data_columns=cath_names)
             kwds["cathCodeStoreID"] = job.fileStore.writeGlobalFile(cath_file)
             remove_store = True
             del cathcodes
@@ -109,7 +110,7 @@ def run_cath_hierarchy(job, cathcode, func, cathFileStoreID, *args, **kwds):
         RealtimeLogger.info("Using logger {}".format(RealtimeLogger.getLogger()))
 
         cath_names = cath_names[:len(cathcode)+1]
-        cathcodes = filter_hdf_chunks(
+        cathcodes = read_hdf_table(
             cath_file,
             "table",
             columns=cath_names,
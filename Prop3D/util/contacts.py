@@ -0,0 +1,189 @@
+"""Residue contact maps of interfaces between two chains.
+
+Residue pairs (one residue from each chain) with any two atoms within cutoff
+are found with a KD-tree over the atoms of each chain. A ContactMap keeps
+them as an (n_contacts, 2) array of residue positions, which can be viewed as
+a boolean residue x residue COO matrix.
+
+Residues are matched between complexes by their Biopython residue id, not by
+chain, so decoys with renamed chains can be compared to a reference.
+compare_contacts scores many decoys against one reference with a single
+sparse matrix product: the contacts of every decoy are rows of a sparse
+matrix over the contacts of the reference, so the shared contacts of all
+decoys come from one multiplication instead of intersecting sets of
+neighbors per residue.
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+def _keys(keys):
+    #Residue ids are tuples, keep them as one level
+    return pd.Index(keys, dtype=object, tupleize_cols=False)
+
+def chain_atoms(chain, hydrogens=True, hetero=True):
+    """Residue ids, atom coordinates and the residue of each atom in a chain
+
+    Returns
+    -------
+    keys : list of residue ids
+    coords : np.array (n_atoms, 3)
+    owners : np.array (n_atoms,)
+        Position in keys of the residue of each atom
+    """
+    keys, coords, owners = [], [], []
+    for residue in chain:
+        if not hetero and residue.id[0] != " ":
+            continue
+        atoms = [atom.coord for atom in residue if hydrogens or atom.element != "H"]
+        if len(atoms) == 0:
+            continue
+        owners += [len(keys)]*len(atoms)
+        keys.append(residue.id)
+        coords += atoms
+    return keys, np.array(coords, dtype=float).reshape(-1, 3), np.array(owners, dtype=np.int64)
+
+class ContactMap(object):
+    """Contacts between the residues of two chains
+
+    Parameters
+    ----------
+    rows, cols : list of residue ids
+        Residues of the first and second chain
+    pairs : np.array (n_contacts, 2)
+        Positions in rows and cols of each contact
+    """
+    def __init__(self, rows, cols, pairs):
+        self.rows = _keys(rows)
+        self.cols = _keys(cols)
+        self.pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+
+    @classmethod
+    def from_chains(cls, chain1, chain2, cutoff=5.5, hydrogens=True, hetero=True):
+        """Contacts between two Biopython chains. All atoms are used by
+        default, like prodigy's calculate_ic"""
+        keys1, coords1, owners1 = chain_atoms(chain1, hydrogens=hydrogens, hetero=hetero)
+        keys2, coords2, owners2 = chain_atoms(chain2, hydrogens=hydrogens, hetero=hetero)
+
+        if len(coords1) == 0 or len(coords2) == 0:
+            return cls(keys1, keys2, np.zeros((0, 2), dtype=np.int64))
+
+        atom_pairs = cKDTree(coords1).sparse_distance_matrix(cKDTree(coords2), cutoff,
+            output_type="ndarray")
+        codes = np.unique(owners1[atom_pairs["i"]]*len(keys2)+owners2[atom_pairs["j"]])
+
+        return cls(keys1, keys2, np.column_stack((codes//len(keys2), codes%len(keys2))))
+
+    @classmethod
+    def from_structure(cls, structure, chain1, chain2, cutoff=5.5, model=0, **kwds):
+        return cls.from_chains(structure[model][chain1], structure[model][chain2],
+            cutoff=cutoff, **kwds)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.cols))
+
+    def to_coo(self):
+        """Boolean residue x residue matrix"""
+        return sparse.coo_matrix((np.ones(len(self), dtype=bool), (self.pairs[:, 0],
+            self.pairs[:, 1])), shape=self.shape)
+
+    def to_dense(self):
+        return self.to_coo().toarray()
+
+    def interface(self):
+        """Residue ids of each chain in contact with the other chain"""
+        return list(self.rows[np.unique(self.pairs[:, 0])]), list(self.cols[np.unique(self.pairs[:, 1])])
+
+    def neighbors(self):
+        """Residue ids of the second chain in contact with each residue of the
+        first chain"""
+        neighbors = {}
+        for i, j in self.pairs:
+            neighbors.setdefault(self.rows[i], []).append(self.cols[j])
+        return neighbors
+
+    def codes(self, reference=None):
+        """Contacts as positions in the flattened matrix of reference (itself
+        by default), -1 for contacts with residues not in reference"""
+        reference = reference if reference is not None else self
+        if reference is self:
+            return self.pairs[:, 0]*len(self.cols)+self.pairs[:, 1]
+        rows = reference.rows.get_indexer(self.rows)[self.pairs[:, 0]]
+        cols = reference.cols.get_indexer(self.cols)[self.pairs[:, 1]]
+        return np.where((rows >= 0) & (cols >= 0), rows*len(reference.cols)+cols, -1)
+
+def _overlap(reference_items, decoy_items, size):
+    """Number of items of each decoy that are in the reference. Items are
+    positions in [0, size) or -1 if they cannot be in the reference"""
+    n_decoys = len(decoy_items)
+    counts = np.array([len(items) for items in decoy_items], dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros(n_decoys, dtype=np.int64)
+
+    #Unmatched items go to an extra column that is never in the reference
+    items = np.concatenate(decoy_items)
+    items = np.where(items < 0, size, items)
+    decoys = sparse.csr_matrix((np.ones(len(items)), (np.repeat(np.arange(n_decoys), counts),
+        items)), shape=(n_decoys, size+1))
+
+    reference = np.zeros(size+1)
+    reference[np.asarray(reference_items, dtype=np.int64)] = 1.
+
+    return np.rint(decoys.dot(reference)).astype(np.int64)
+
+def _ratio(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+def compare_contacts(reference, decoys, index=None):
+    """Score the contacts of many decoys against one reference
+
+    Parameters
+    ----------
+    reference : ContactMap
+    decoys : list of ContactMap
+    index : list
+        Names of the decoys
+
+    Returns
+    -------
+    pd.DataFrame with one row per decoy:
+        fcc : fraction of the reference contacts found in the decoy (recall)
+        precision : fraction of the decoy contacts found in the reference
+        recall : same as fcc
+        jaccard : shared contacts over contacts in either
+        interface_jaccard_1, interface_jaccard_2 : Jaccard index of the
+            interface residues of each chain
+    """
+    decoys = list(decoys)
+    n_reference = len(reference)
+    n_decoy = np.array([len(decoy) for decoy in decoys], dtype=np.int64)
+
+    common = _overlap(reference.codes(), [decoy.codes(reference) for decoy in decoys],
+        len(reference.rows)*len(reference.cols))
+
+    results = {
+        "fcc": _ratio(common, n_reference),
+        "precision": _ratio(common, n_decoy),
+        "recall": _ratio(common, n_reference),
+        "jaccard": _ratio(common, n_reference+n_decoy-common)
+    }
+
+    for axis, name in ((0, "interface_jaccard_1"), (1, "interface_jaccard_2")):
+        keys = reference.rows if axis == 0 else reference.cols
+        reference_face = np.unique(reference.pairs[:, axis])
+        decoy_faces = []
+        for decoy in decoys:
+            decoy_keys = decoy.rows if axis == 0 else decoy.cols
+            face = decoy_keys[np.unique(decoy.pairs[:, axis])]
+            decoy_faces.append(keys.get_indexer(face))
+        n_face = np.array([len(face) for face in decoy_faces], dtype=np.int64)
+        shared = _overlap(reference_face, decoy_faces, len(keys))
+        results[name] = _ratio(shared, len(reference_face)+n_face-shared)
+
+    return pd.DataFrame(results, index=index)
@@ -1,3 +1,34 @@
+from multiprocessing.pool import ThreadPool
+
+import dask
+
 def setup_dask(num_workers):
     dask.config.set(scheduler='multiprocessing')
     dask.config.set(pool=ThreadPool(num_workers))
+
+def setup_dask_cluster(n_workers=None, threads_per_worker=1, memory_limit="auto",
+  address=None, dashboard_address=":8787"):
+    """Start a dask.distributed LocalCluster (or connect to a running scheduler)
+    and return a Client. The dashboard shows the task stream and worker memory.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes. Default is one per core
+    threads_per_worker : int
+        The feature tools are not thread safe, so keep at 1
+    memory_limit : str
+        Memory limit of each worker, e.g. '4GB'. Workers are paused and then
+        restarted if they go over
+    address : str
+        Address of an existing scheduler, e.g. tcp://10.0.0.1:8786. If given, no
+        local cluster is started
+    """
+    from dask.distributed import Client, LocalCluster
+
+    if address is not None:
+        return Client(address)
+
+    cluster = LocalCluster(n_workers=n_workers, threads_per_worker=threads_per_worker,
+        memory_limit=memory_limit, dashboard_address=dashboard_address, processes=True)
+    return Client(cluster)
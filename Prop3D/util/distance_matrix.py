@@ -0,0 +1,197 @@
+"""Symmetric all-vs-all distance matrices stored on disk as a condensed upper
+triangle, in the same order as scipy.spatial.distance.squareform.
+
+A matrix is a directory with distances.npy (float32, n*(n-1)/2 values, opened
+as a numpy memmap) and ids.json (the structure of each row). 20k structures
+take 800MB on disk instead of 400M rows in pandas, and only the pages that are
+read or written are loaded into memory. Missing pairs are NaN.
+
+Superposition and clustering tools write pairs straight into the matrix with
+fill_from_pairs or fill_from_tables, which read their inputs in chunks.
+scipy.cluster.hierarchy.linkage can use CondensedDistanceMatrix.distances as is.
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+def structure_name(path):
+    """Name used to match a structure in tables, e.g. /data/1abcA00.pdb -> 1abcA00"""
+    return os.path.splitext(os.path.basename(str(path).strip()))[0]
+
+class CondensedDistanceMatrix(object):
+    """Condensed distance matrix memory-mapped from path
+
+    Parameters
+    ----------
+    path : str
+        Directory created by CondensedDistanceMatrix.create
+    mode : str
+        'r' to read only, 'r+' to update
+    """
+    DISTANCES_FILE = "distances.npy"
+    IDS_FILE = "ids.json"
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        with open(os.path.join(path, self.IDS_FILE)) as f:
+            self.ids = json.load(f)
+        self.n = len(self.ids)
+        self.index = pd.Index(self.ids)
+        self.distances = np.load(os.path.join(path, self.DISTANCES_FILE), mmap_mode=mode)
+        assert len(self.distances) == self.n*(self.n-1)//2, "Corrupt distance matrix"
+
+    @classmethod
+    def create(cls, path, ids, fill=np.nan, dtype=np.float32):
+        """Make an empty matrix for ids (e.g. structure names). Returns it
+        opened for writing"""
+        ids = [str(i) for i in ids]
+        if len(set(ids)) != len(ids):
+            raise ValueError("ids must be unique")
+
+        os.makedirs(path, exist_ok=True)
+        n = len(ids)
+        distances = np.lib.format.open_memmap(os.path.join(path, cls.DISTANCES_FILE),
+            mode="w+", dtype=dtype, shape=(n*(n-1)//2,))
+        distances[:] = fill
+        distances.flush()
+        del distances
+
+        with open(os.path.join(path, cls.IDS_FILE)+".tmp", "w") as f:
+            json.dump(ids, f)
+        os.replace(os.path.join(path, cls.IDS_FILE)+".tmp", os.path.join(path, cls.IDS_FILE))
+
+        return cls(path, mode="r+")
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.isfile(os.path.join(path, cls.IDS_FILE)) and \
+            os.path.isfile(os.path.join(path, cls.DISTANCES_FILE))
+
+    @classmethod
+    def open_or_create(cls, path, ids, **kwds):
+        """Open an existing matrix for writing (e.g. to resume filling it) or
+        create a new one"""
+        if cls.exists(path):
+            matrix = cls(path, mode="r+")
+            if matrix.ids != [str(i) for i in ids]:
+                raise ValueError("{} was created for different structures".format(path))
+            return matrix
+        return cls.create(path, ids, **kwds)
+
+    def __len__(self):
+        return self.n
+
+    def flush(self):
+        if hasattr(self.distances, "flush"):
+            self.distances.flush()
+
+    def condensed_index(self, i, j):
+        """Position of pairs (i, j) in distances. i and j are row numbers
+        and must differ"""
+        i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+        if np.any(i == j):
+            raise ValueError("The distance of a structure to itself is not stored")
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        return self.n*i-i*(i+1)//2+j-i-1
+
+    def positions(self, ids, normalize=True):
+        """Row numbers of ids, -1 for unknown ids"""
+        ids = pd.Index(ids)
+        if normalize:
+            ids = ids.map(structure_name)
+        return self.index.get_indexer(ids)
+
+    def set(self, i, j, values):
+        """Set the distances of pairs of rows. Pairs of a row with itself are
+        ignored"""
+        i, j = np.asarray(i), np.asarray(j)
+        values = np.broadcast_to(np.asarray(values, dtype=self.distances.dtype), i.shape)
+        keep = i != j
+        self.distances[self.condensed_index(i[keep], j[keep])] = values[keep]
+
+    def get(self, i, j):
+        i, j = np.asarray(i), np.asarray(j)
+        result = np.zeros(np.broadcast(i, j).shape, dtype=self.distances.dtype)
+        i, j = np.broadcast_to(i, result.shape), np.broadcast_to(j, result.shape)
+        keep = i != j
+        result[keep] = self.distances[self.condensed_index(i[keep], j[keep])]
+        return result
+
+    def row(self, i):
+        """Distances from row i to every row (0 for itself)"""
+        result = np.zeros(self.n, dtype=self.distances.dtype)
+        before = np.arange(i)
+        result[:i] = self.distances[self.condensed_index(before, i)] if i > 0 else []
+        start = self.n*i-i*(i+1)//2
+        result[i+1:] = self.distances[start:start+self.n-i-1]
+        return result
+
+    def submatrix(self, rows):
+        """Square matrix of the distances between rows"""
+        rows = np.asarray(rows)
+        return self.get(rows[:, None], rows[None, :])
+
+    def to_square(self):
+        from scipy.spatial.distance import squareform
+        return squareform(np.asarray(self.distances), checks=False)
+
+    def missing(self, chunk_size=1<<24):
+        """Number of pairs that have not been set"""
+        return int(sum(np.isnan(self.distances[start:start+chunk_size]).sum() \
+            for start in range(0, len(self.distances), chunk_size)))
+
+    def fill_from_pairs(self, pairs, chunk_size=1<<20, normalize=True):
+        """Set distances from an iterable of (id1, id2, distance), buffering
+        chunk_size pairs at a time
+
+        Returns
+        -------
+        Number of pairs set. Pairs with unknown ids are skipped
+        """
+        n_set = 0
+        buffer = []
+        for pair in pairs:
+            buffer.append(pair)
+            if len(buffer) >= chunk_size:
+                n_set += self._set_ids(*zip(*buffer), normalize=normalize)
+                buffer = []
+        if len(buffer) > 0:
+            n_set += self._set_ids(*zip(*buffer), normalize=normalize)
+        return n_set
+
+    def fill_from_tables(self, tables, id1, id2, distance, transform=None,
+      chunk_size=1<<20, normalize=True, **read_csv_kwds):
+        """Set distances from csv files with one pair per row, reading
+        chunk_size rows at a time
+
+        Parameters
+        ----------
+        tables : list of str
+        id1, id2, distance : str
+            Columns with the structure names (or paths) and the distance
+        transform : callable
+            Applied to each chunk of distances, e.g. lambda tm: 1-tm
+
+        Returns
+        -------
+        Number of pairs set. Pairs with unknown ids are skipped
+        """
+        n_set = 0
+        for table in tables:
+            for chunk in pd.read_csv(table, usecols=[id1, id2, distance],
+              chunksize=chunk_size, **read_csv_kwds):
+                values = pd.to_numeric(chunk[distance], errors="coerce").values
+                if transform is not None:
+                    values = transform(values)
+                n_set += self._set_ids(chunk[id1].values, chunk[id2].values, values,
+                    normalize=normalize)
+        return n_set
+
+    def _set_ids(self, ids1, ids2, values, normalize=True):
+        i, j = self.positions(ids1, normalize), self.positions(ids2, normalize)
+        values = np.asarray(values, dtype=float)
+        keep = (i >= 0) & (j >= 0) & (i != j)
+        self.set(i[keep], j[keep], values[keep])
+        return int(keep.sum())
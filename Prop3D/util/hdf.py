@@ -1,7 +1,9 @@
 import os
 import sys
+import keyword
 
 import toil
+import numpy as np
 import pandas as pd
 
 from toil.realtimeLogger import RealtimeLogger
@@ -61,55 +63,147 @@ def filter_hdf(hdf_path, dataset, column=None, value=None, columns=None,
             columns=columns, drop_duplicates=drop_duplicates, **query)
     return df
 
-def filter_hdf_chunks(hdf_path, dataset, column=None, value=None, columns=None,
-  chunksize=500, drop_duplicates=False, **query):
-    df = None
-    store = pd.HDFStore(str(hdf_path), mode="r")
-    nrows = store.get_storer(dataset).nrows
-
-    #for _df in pd.read_hdf(str(hdf_path), dataset, chunksize=chunksize):
-    for i in range(nrows//chunksize + 1):
-        _df = store.select(dataset, start=i*chunksize, stop=(i+1)*chunksize)
-
-        if len(query) > 0:
-            try:
-                filtered_df = _df.query("("+") & (".join(["{}=={}".format(c, v) for c, v in list(query.items())])+")")
-            except SyntaxError:
-                expression = None
-                for c, v in list(query.items()):
-                    _exp = _df[c]==v
-                    if expression is None:
-                        expression = _exp
-                    else:
-                        expression &= _exp
-                filtered_df = _df[expression]
-        elif column is not None and value is not None:
-            if not isinstance(column, (list, tuple)) and not isinstance(value, (list, tuple)):
-                filtered_df = _df[_df[column]==value].copy()
-            elif len(column) == len(value):
-                filtered_df = _df.query(" & ".join(["{}=={}".format(c, v) for c, v in zip(column, value)]))
-            else:
-                raise RuntimeError("Cols and values must match")
+#Columns of CATH tables that are filtered on, see to_hdf_table
+CATH_INDEX_COLUMNS = ["cath_domain", "cathcode"]
+
+def _scalar(value):
+    return value.item() if hasattr(value, "item") else value
+
+def _where_term(column, value):
+    """PyTables condition for column == value, or column in value for lists"""
+    if isinstance(value, (list, tuple, set)):
+        return "{} == {!r}".format(column, [_scalar(v) for v in value])
+    return "{} == {!r}".format(column, _scalar(value))
+
+def _mask(df, conditions):
+    mask = np.ones(len(df), dtype=bool)
+    for column, value in conditions.items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= df[column].isin(list(value)).values
         else:
-            filtered_df = _df.copy()
-        if filtered_df.shape[0]>0:
+            mask &= (df[column] == value).values
+    return mask
+
+def read_hdf_table(hdf_path, dataset, columns=None, drop_duplicates=False,
+  chunksize=1000000, **query):
+    """Select rows of a table where every column in query equals its value
+    (or is in it, for lists)
+
+    Conditions on data columns are compiled into a PyTables where, which uses
+    their index if there is one (see create_table_indexes). Conditions on other
+    columns, and on data columns whose names cannot be used in a where (e.g.
+    class), are applied as vectorized masks over chunks of chunksize rows.
+    Chunks are concatenated once at the end.
+
+    Returns
+    -------
+    pd.DataFrame, empty if no rows match
+    """
+    with pd.HDFStore(str(hdf_path), mode="r") as store:
+        storer = store.get_storer(dataset)
+        if not storer.is_table:
+            #Fixed format cannot be queried or read in chunks
+            df = store.select(dataset)
+            df = df[_mask(df, query)]
             if columns is not None:
-                filtered_df = filtered_df[columns]
-            if drop_duplicates:
-                filtered_df = filtered_df.drop_duplicates()
-            df = pd.concat((df, filtered_df), axis=0) if df is not None else filtered_df
+                df = df[columns]
+            return df.drop_duplicates() if drop_duplicates else df
+
+        #PyTables evaluates the where as Python, so keywords like class fail
+        data_columns = {c for c in storer.data_columns or [] if \
+            c.isidentifier() and not keyword.iskeyword(c)}
+        pushed = {c: v for c, v in query.items() if c in data_columns}
+        masked = {c: v for c, v in query.items() if c not in data_columns}
+
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns)+[c for c in masked if c not in columns]
+
+        where = [_where_term(c, v) for c, v in pushed.items()] or None
+        try:
+            chunks = store.select(dataset, where=where, columns=read_columns,
+                chunksize=chunksize)
+        except (ValueError, TypeError, SyntaxError, NotImplementedError):
+            #e.g. the value cannot be compared to the column, mask everything
+            chunks = store.select(dataset, columns=read_columns, chunksize=chunksize)
+            masked = query
+
+        parts = []
+        for chunk in chunks:
+            if len(masked) > 0:
+                chunk = chunk[_mask(chunk, masked)]
+            if columns is not None:
+                chunk = chunk[columns]
             if drop_duplicates:
-                df = df.drop_duplicates()
-            del _df
-            _df = None
-    if df is None:
-        raise TypeError("Unable to parse HDF")
+                chunk = chunk.drop_duplicates()
+            if len(chunk) > 0:
+                parts.append(chunk)
 
-    #Make sure store is closed
-    store.close()
+        if len(parts) == 0:
+            df = store.select(dataset, start=0, stop=0, columns=read_columns)
+            return df[columns] if columns is not None else df
+
+    df = pd.concat(parts, axis=0) if len(parts) > 1 else parts[0]
+    if drop_duplicates and len(parts) > 1:
+        df = df.drop_duplicates()
 
     return df
 
+def filter_hdf_chunks(hdf_path, dataset, column=None, value=None, columns=None,
+  chunksize=None, drop_duplicates=False, **query):
+    """read_hdf_table with the arguments of filter_hdf. Raises TypeError if
+    no rows match"""
+    if len(query) == 0 and column is not None and value is not None:
+        if not isinstance(column, (list, tuple)):
+            query = {column: value}
+        elif isinstance(value, (list, tuple)) and len(column) == len(value):
+            query = dict(zip(column, value))
+        else:
+            raise RuntimeError("Cols and values must match")
+
+    kwds = {"chunksize": chunksize} if chunksize is not None else {}
+    df = read_hdf_table(hdf_path, dataset, columns=columns, drop_duplicates=drop_duplicates,
+        **kwds, **query)
+
+    if len(df) == 0:
+        raise TypeError("Unable to parse HDF")
+
+    return df
+
+def create_table_indexes(hdf_path, dataset="table", columns=CATH_INDEX_COLUMNS,
+  optlevel=6, kind="medium"):
+    """Build PyTables indexes on data columns of a table so read_hdf_table
+    can find rows without scanning. Columns that are not data columns are
+    skipped
+
+    Returns
+    -------
+    List of indexed columns
+    """
+    with pd.HDFStore(str(hdf_path), mode="a") as store:
+        storer = store.get_storer(dataset)
+        data_columns = set(storer.data_columns or []) if storer.is_table else set()
+        indexed = [c for c in columns if c in data_columns]
+        skipped = [c for c in columns if c not in data_columns]
+        if len(skipped) > 0:
+            RealtimeLogger.info("Not indexing {} in {}, not data columns".format(skipped, hdf_path))
+        if len(indexed) > 0:
+            store.create_table_index(dataset, columns=indexed, optlevel=optlevel, kind=kind)
+    return indexed
+
+def to_hdf_table(df, hdf_path, dataset="table", data_columns=CATH_INDEX_COLUMNS,
+  index=True, **kwds):
+    """Write df as a compressed table with data_columns (those in df) that can
+    be queried by read_hdf_table. Set index=False when appending many chunks
+    and call create_table_indexes once at the end"""
+    for key, default in (("format", "table"), ("complevel", 9), ("complib", "bzip2"),
+      ("min_itemsize", 1024)):
+        kwds.setdefault(key, default)
+    data_columns = [c for c in data_columns if c in df.columns]
+    df.to_hdf(str(hdf_path), key=dataset, data_columns=data_columns, index=False, **kwds)
+    if index and len(data_columns) > 0:
+        create_table_indexes(hdf_path, dataset, columns=data_columns)
+
 def make_h5_tables(files, iostore):
     for f in files:
         iostore.read_input_file(f, f)
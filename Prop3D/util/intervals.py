@@ -0,0 +1,180 @@
+"""Join positions to intervals (e.g. residues to CATH domain segments) with
+binary search instead of merging every position with every interval.
+
+Intervals in the same group (e.g. the same pdb and chain) must not overlap.
+Each lookup is O(log m) for m intervals in the group.
+"""
+import numpy as np
+import pandas as pd
+
+def _group_codes(left, right, left_by, right_by):
+    """Integer code of the group of each row in left and right, shared by both"""
+    if left_by is None:
+        return np.zeros(len(left), dtype=int), np.zeros(len(right), dtype=int)
+
+    keys = pd.concat((
+        left[left_by].set_axis(range(len(left_by)), axis=1),
+        right[right_by].set_axis(range(len(right_by)), axis=1)),
+        axis=0, ignore_index=True)
+    codes = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup().values
+    return codes[:len(left)], codes[len(left):]
+
+def _by_group(left, right, left_by, right_by):
+    """Yield (left positions, right positions) for each group in left"""
+    left_codes, right_codes = _group_codes(left, right, left_by, right_by)
+    right_groups = pd.Series(np.arange(len(right))).groupby(right_codes).indices
+    empty = np.array([], dtype=int)
+    for code, left_pos in pd.Series(np.arange(len(left))).groupby(left_codes).indices.items():
+        yield left_pos, right_groups.get(code, empty)
+
+def _as_array(values):
+    return pd.to_numeric(pd.Series(values), errors="coerce").values.astype(float)
+
+def locate_intervals(values, starts, stops):
+    """Find the interval containing each value and the closest intervals
+    before and after it
+
+    Parameters
+    ----------
+    values : array-like
+    starts, stops : array-like
+        Inclusive bounds of non-overlapping intervals, in any order
+
+    Returns
+    -------
+    inside, previous, next : np.array of int
+        Position (in starts/stops) of the interval that contains each value,
+        that ends before it and that starts after it, or -1 if there is none
+    """
+    values, starts, stops = _as_array(values), _as_array(starts), _as_array(stops)
+    n = len(values)
+    inside = previous = following = np.full(n, -1, dtype=int)
+    valid = ~(np.isnan(starts) | np.isnan(stops))
+    if len(starts) == 0 or not valid.any():
+        return inside, previous.copy(), following.copy()
+
+    positions = np.flatnonzero(valid)
+    by_start = positions[np.argsort(starts[positions], kind="stable")]
+    by_stop = positions[np.argsort(stops[positions], kind="stable")]
+    sorted_starts = starts[by_start]
+    sorted_stops = stops[by_stop]
+    m = len(positions)
+
+    #Last interval starting at or before the value
+    i = np.searchsorted(sorted_starts, values, side="right")-1
+    candidate = by_start[np.clip(i, 0, m-1)]
+    inside = np.where((i >= 0) & (values <= stops[candidate]), candidate, -1)
+
+    #Last interval ending before the value
+    j = np.searchsorted(sorted_stops, values, side="left")-1
+    previous = np.where(j >= 0, by_stop[np.clip(j, 0, m-1)], -1)
+
+    #First interval starting after the value
+    k = np.searchsorted(sorted_starts, values, side="right")
+    following = np.where(k < m, by_start[np.clip(k, 0, m-1)], -1)
+
+    missing = np.isnan(values)
+    inside[missing] = previous[missing] = following[missing] = -1
+
+    return inside, previous, following
+
+def _locate_grouped(left, right, on, start, stop, left_by, right_by):
+    inside = np.full(len(left), -1, dtype=int)
+    previous = np.full(len(left), -1, dtype=int)
+    following = np.full(len(left), -1, dtype=int)
+
+    for left_pos, right_pos in _by_group(left, right, left_by, right_by):
+        if len(right_pos) == 0:
+            continue
+        group = locate_intervals(left[on].values[left_pos],
+            right[start].values[right_pos], right[stop].values[right_pos])
+        for result, found in zip((inside, previous, following), group):
+            result[left_pos] = np.where(found >= 0, right_pos[np.clip(found, 0, None)], -1)
+
+    return inside, previous, following
+
+def _take(right, positions, drop):
+    """Rows of right at positions, with NaN rows for -1"""
+    right = right.drop(columns=drop).reset_index(drop=True)
+    return right.reindex(np.where(positions >= 0, positions, len(right))).reset_index(drop=True)
+
+def interval_join(left, right, on, start, stop, by=None, left_by=None, right_by=None,
+  how="inner"):
+    """Join each row of left to the row of right whose [start, stop] interval
+    contains left[on]
+
+    Parameters
+    ----------
+    left : pd.DataFrame
+        Positions, e.g. residues with a residueNumber column
+    right : pd.DataFrame
+        Intervals, e.g. CATH domain segments
+    on : str
+        Column in left with the position
+    start, stop : str
+        Columns in right with the inclusive interval bounds
+    by, left_by, right_by : list of str
+        Only join rows with the same values in these columns (e.g. pdb and
+        chain). Columns of right that are in by (or share a name with left)
+        are not repeated in the result
+    how : 'inner' or 'left'
+        Keep positions that are not in any interval with NaN interval columns
+
+    Returns
+    -------
+    pd.DataFrame with the columns of left and right and the index of left
+    """
+    if by is not None:
+        left_by = right_by = list(by)
+
+    inside, _, _ = _locate_grouped(left, right, on, start, stop, left_by, right_by)
+
+    if how == "inner":
+        keep = inside >= 0
+    elif how == "left":
+        keep = np.ones(len(left), dtype=bool)
+    else:
+        raise ValueError("how must be 'inner' or 'left'")
+
+    drop = [c for c in right.columns if c in left.columns]
+    joined = pd.concat((
+        left[keep].reset_index(drop=True),
+        _take(right, inside[keep], drop)), axis=1)
+    joined.index = left.index[keep]
+
+    return joined
+
+def nearest_intervals(left, right, on, start, stop, by=None, left_by=None, right_by=None,
+  columns=None):
+    """Closest interval before and after each position in left
+
+    Parameters
+    ----------
+    columns : list of str
+        Columns of right to return for each closest interval. Default is all
+
+    Returns
+    -------
+    previous, next : pd.DataFrame
+        Columns of the interval ending before (starting after) each position
+        and its distance from the position (NaN if there is none), both with
+        the index of left
+    """
+    if by is not None:
+        left_by = right_by = list(by)
+
+    _, previous, following = _locate_grouped(left, right, on, start, stop, left_by, right_by)
+
+    values = _as_array(left[on].values)
+    columns = list(right.columns) if columns is None else list(columns)
+    result = []
+    for positions, bound, sign in ((previous, stop, 1), (following, start, -1)):
+        closest = _take(right[columns+[bound]] if bound not in columns else right[columns],
+            positions, [])
+        closest = closest.assign(distance=sign*(values-_as_array(closest[bound].values)))
+        if bound not in columns:
+            closest = closest.drop(columns=[bound])
+        closest.index = left.index
+        result.append(closest)
+
+    return tuple(result)
@@ -29,6 +29,7 @@ try:
 except ImportError:
     import SocketServer #Python 2.7
 import struct, socket, threading, tarfile, shutil
+import asyncio
 import tempfile
 import functools
 import random
@@ -51,6 +52,31 @@ except ImportError:
     have_s3 = False
     pass
 
+# Async S3 client is optional, S3IOStore falls back to threads without it
+try:
+    import aiobotocore.session
+    import aiobotocore.config
+    have_aiobotocore = True
+except ImportError:
+    have_aiobotocore = False
+
+def run_async(coroutine):
+    """
+    Run a coroutine to completion from synchronous code. If an event loop is
+    already running in this thread, the coroutine is run in a new thread with
+    its own loop.
+
+    """
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
 def robust_makedirs(directory):
     """
     Make a directory when other nodes may be trying to do the same on a shared
@@ -70,7 +96,8 @@ def robust_makedirs(directory):
     assert(os.path.exists(directory) and os.path.isdir(directory))
 
 
-def write_global_directory(file_store, path, cleanup=False, tee=None, compress=True):
+def write_global_directory(file_store, path, cleanup=False, tee=None, compress=True,
+  indexed=False, codec=None, threads=None):
     """
     Write the given directory into the file store, and return an ID that can be
     used to retrieve it. Writes the files in the directory and subdirectories
@@ -86,14 +113,25 @@ def write_global_directory(file_store, path, cleanup=False, tee=None, compress=T
     filename. The file thus created must not be modified after this function is
     called.
 
+    If indexed is True, an indexed archive (see util.archive) is written
+    instead of a tar file. Blocks are compressed with codec (zstd if
+    installed, else gzip) on threads cores at once, and read_global_directory
+    can extract single members without decompressing the rest.
+
     """
 
-    write_stream_mode = "w"
-    if compress:
-        write_stream_mode = "w|gz"
+    if indexed:
+        from Prop3D.util.archive import write_archive
+        if not compress:
+            codec = "none"
+        write = lambda file_handle: write_archive(path, file_handle, codec=codec,
+            threads=threads)
+    else:
+        write_stream_mode = "w"
+        if compress:
+            write_stream_mode = "w|gz"
 
-    if tee is not None:
-        with open(tee, "w") as file_handle:
+        def write(file_handle):
             # We have a stream, so start taring into it
             with tarfile.open(fileobj=file_handle, mode=write_stream_mode) as tar:
                 # Open it for streaming-only write (no seeking)
@@ -106,74 +144,70 @@ def write_global_directory(file_store, path, cleanup=False, tee=None, compress=T
                     # path
                     tar.add(os.path.join(path, file_name), arcname=file_name)
 
+    if tee is not None:
+        with open(tee, "wb") as file_handle:
+            write(file_handle)
+
         # Save the file on disk to the file store.
         return file_store.writeGlobalFile(tee)
     else:
-
         with file_store.writeGlobalFileStream(cleanup=cleanup) as (file_handle,
             file_id):
-            # We have a stream, so start taring into it
-            # TODO: don't duplicate this code.
-            with tarfile.open(fileobj=file_handle, mode=write_stream_mode) as tar:
-                # Open it for streaming-only write (no seeking)
-
-                # We can't just add the root directory, since then we wouldn't be
-                # able to extract it later with an arbitrary name.
-
-                for file_name in os.listdir(path):
-                    # Add each file in the directory to the tar, with a relative
-                    # path
-                    tar.add(os.path.join(path, file_name), arcname=file_name)
+            write(file_handle)
 
             # Spit back the ID to use to retrieve it
             return file_id
 
-def read_global_directory(file_store, directory_id, path):
+def read_global_directory(file_store, directory_id, path, members=None, threads=None):
     """
     Reads a directory with the given tar file id from the global file store and
     recreates it at the given path.
 
     The given path, if it exists, must be a directory.
 
+    If members is given (names or glob patterns), only matching files are
+    extracted. For indexed archives only the blocks of those files are
+    decompressed.
+
     Do not use to extract untrusted directories, since they could sneakily plant
     files anywhere on the filesystem.
 
     """
 
+    from Prop3D.util.archive import is_archive, extract_archive, select_members
+
     # Make the path
     robust_makedirs(path)
 
-    with file_store.readGlobalFileStream(directory_id) as file_handle:
-        # We need to pull files out of this tar stream
-
-        with tarfile.open(fileobj=file_handle, mode="r|*") as tar:
-            # Open it for streaming-only read (no seeking)
-
-            # We need to extract the whole thing into that new directory
-            
-            import os
-            
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, path)
+    # Seekable local copy, so indexed archives can be read out of order
+    local_file = file_store.readGlobalFile(directory_id)
+
+    if is_archive(local_file):
+        return extract_archive(local_file, path, members=members, threads=threads)
+
+    def is_within_directory(directory, target):
+
+        abs_directory = os.path.abspath(directory)
+        abs_target = os.path.abspath(target)
+
+        prefix = os.path.commonprefix([abs_directory, abs_target])
+
+        return prefix == abs_directory
+
+    with tarfile.open(local_file, mode="r:*") as tar:
+        tar_members = tar.getmembers()
+        for member in tar_members:
+            member_path = os.path.join(path, member.name)
+            if not is_within_directory(path, member_path):
+                raise Exception("Attempted Path Traversal in Tar File")
 
+        if members is not None:
+            names = set(select_members([m.name for m in tar_members], members))
+            tar_members = [m for m in tar_members if m.name in names]
+
+        tar.extractall(path, tar_members)
+
+        return [m.name for m in tar_members]
 
 class IOStore(object):
     """
@@ -290,6 +324,22 @@ class IOStore(object):
 
         raise NotImplementedError()
 
+    def get_version(self, path):
+        """
+        Returns a string that changes whenever the given file changes (e.g. an
+        ETag), or None if the file does not exist or has no version.
+
+        """
+
+        try:
+            mtime = self.get_mtime(path)
+            size = self.get_size(path)
+        except NotImplementedError:
+            return None
+        if mtime is None and size is None:
+            return None
+        return "{}-{}".format(mtime, size)
+
     def remove_file(self, path):
         """
         Removes the object from the store
@@ -297,6 +347,124 @@ class IOStore(object):
 
         raise NotImplementedError()
 
+    def read_many(self, files, ignore_missing=False):
+        """
+        Read many input files. files is a dict or list of (input_path,
+        local_path) pairs.
+
+        Returns a dict of input_path to local_path. If ignore_missing is True,
+        files that could not be read are left out instead of raising.
+
+        Stores that can transfer files concurrently override this.
+
+        """
+
+        files = files.items() if isinstance(files, dict) else files
+        results = {}
+        for input_path, local_path in files:
+            try:
+                self.read_input_file(input_path, local_path)
+                results[input_path] = local_path
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                if not ignore_missing:
+                    raise
+        return results
+
+    def write_many(self, files):
+        """
+        Write many output files. files is a dict or list of (local_path,
+        output_path) pairs.
+
+        """
+
+        files = files.items() if isinstance(files, dict) else files
+        for local_path, output_path in files:
+            self.write_output_file(local_path, output_path)
+
+    def exists_many(self, paths):
+        """
+        Returns a dict of path to whether it exists in the store.
+
+        """
+
+        return {path: self.exists(path) for path in paths}
+
+    # Async API. By default each call runs the synchronous method in a thread,
+    # with at most async_concurrency calls per event loop running at once.
+    # Stores with an async client override the _a* methods.
+
+    async_concurrency = 64
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphores = self.__dict__.setdefault("_semaphores", {})
+        if loop not in semaphores:
+            semaphores.clear()
+            semaphores[loop] = asyncio.Semaphore(self.async_concurrency)
+        return semaphores[loop]
+
+    async def aread(self, input_path, local_path):
+        """
+        Async read_input_file. Returns local_path.
+
+        """
+
+        async with self._semaphore():
+            await self._aread(input_path, local_path)
+        return local_path
+
+    async def awrite(self, local_path, output_path):
+        """
+        Async write_output_file.
+
+        """
+
+        async with self._semaphore():
+            await self._awrite(local_path, output_path)
+
+    async def aexists(self, path):
+        """
+        Async exists.
+
+        """
+
+        async with self._semaphore():
+            return await self._aexists(path)
+
+    async def alist(self, input_path=None, recursive=False, with_times=False):
+        """
+        Async list_input_directory. Returns a list instead of a generator.
+
+        """
+
+        async with self._semaphore():
+            return await self._alist(input_path, recursive, with_times)
+
+    async def aclose(self):
+        """
+        Close any async clients opened for the running event loop. Call it
+        before the loop ends, e.g. at the end of the coroutine given to
+        run_async.
+
+        """
+
+        pass
+
+    async def _aread(self, input_path, local_path):
+        await asyncio.to_thread(self.read_input_file, input_path, local_path)
+
+    async def _awrite(self, local_path, output_path):
+        await asyncio.to_thread(self.write_output_file, local_path, output_path)
+
+    async def _aexists(self, path):
+        return await asyncio.to_thread(self.exists, path)
+
+    async def _alist(self, input_path, recursive, with_times):
+        return await asyncio.to_thread(lambda: list(self.list_input_directory(
+            input_path, recursive=recursive, with_times=with_times)))
+
 
     @staticmethod
     def absolute(store_string):
@@ -350,11 +518,16 @@ class IOStore(object):
 
         azure:account:container/path/prefix (trailing slash added automatically)
 
+        cached:<any of the above> (read-through local cache, see CachedIOStore)
+
         """
 
         if isinstance(store_string, (IOStore, FileS3IOStore)):
             return store_string
 
+        if store_string.startswith("cached:"):
+            return CachedIOStore(IOStore.get(store_string[7:]))
+
         # Code adapted from toil's common.py loadJobStore()
 
         if store_string[0] in "/.":
@@ -626,7 +799,7 @@ class FileIOStore(IOStore):
 
     def remove_file(self, path):
         try:
-            os.remove(path)
+            os.remove(os.path.join(self.path_prefix, path))
         except OSError:
             pass
 
@@ -710,12 +883,23 @@ class S3IOStore(IOStore):
 
     """
 
-    def __init__(self, region, bucket_name, name_prefix=""):
+    async_concurrency = 256
+
+    #Directories with more keys than this are checked with HEAD requests
+    max_listing_keys = 10000
+
+    def __init__(self, region, bucket_name, name_prefix="", max_concurrency=None,
+      listing_ttl=300):
         """
         Make a new S3IOStore that reads from and writes to the given
         container in the given account, adding the given prefix to keys. All
         paths will be interpreted as keys or key prefixes.
 
+        max_concurrency is the number of threads used by the shared transfer
+        manager and by bulk existence checks (default from S3_MAX_CONCURRENCY
+        or 10). Prefix listings used by exists_many are kept for listing_ttl
+        seconds.
+
         """
 
         # Make sure s3 libraries actually loaded
@@ -729,6 +913,14 @@ class S3IOStore(IOStore):
             self.store_string += "/{}".format(name_prefix)
         self.s3 = None
 
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get("S3_MAX_CONCURRENCY", 10))
+        self.max_concurrency = max_concurrency
+        self.listing_ttl = listing_ttl
+        self._transfer_manager = None
+        self._listings = {}
+        self._listing_lock = threading.Lock()
+
     def connect(self):
         self.__connect()
 
@@ -746,7 +938,8 @@ class S3IOStore(IOStore):
 
             kwds = {}
             kwds["config"] = botocore.client.Config(signature_version='s3v4',
-                retries={"max_attempts":20})
+                retries={"max_attempts":20},
+                max_pool_connections=max(10, self.max_concurrency))
 
             if "S3_ENDPOINT" in os.environ:
                 kwds["endpoint_url"] = os.environ["S3_ENDPOINT"]
@@ -767,6 +960,274 @@ class S3IOStore(IOStore):
                         CreateBucketConfiguration={'LocationConstraint': self.region},
                     )
 
+    def _key(self, path):
+        return os.path.join(self.name_prefix, path)
+
+    async def _async_client(self):
+        """
+        aiobotocore client for the running event loop, or None if aiobotocore
+        is not installed. Clients are kept until aclose is called.
+
+        """
+
+        if not have_aiobotocore:
+            return None
+
+        from contextlib import AsyncExitStack
+
+        loop = asyncio.get_running_loop()
+        clients = self.__dict__.setdefault("_async_clients", {})
+        for closed_loop in [l for l in clients if l.is_closed()]:
+            #Loop ended without aclose, nothing left to close the client with
+            del clients[closed_loop]
+        if loop not in clients:
+            kwds = {"config": aiobotocore.config.AioConfig(signature_version='s3v4',
+                retries={"max_attempts":20}, max_pool_connections=self.async_concurrency)}
+            if "S3_ENDPOINT" in os.environ:
+                kwds["endpoint_url"] = os.environ["S3_ENDPOINT"]
+            stack = AsyncExitStack()
+            session = aiobotocore.session.get_session()
+            client = await stack.enter_async_context(session.create_client(
+                "s3", region_name=self.region, **kwds))
+            clients[loop] = (stack, client)
+        return clients[loop][1]
+
+    async def aclose(self):
+        """
+        Close the async client of the running event loop.
+
+        """
+
+        clients = self.__dict__.get("_async_clients", {})
+        stack_client = clients.pop(asyncio.get_running_loop(), None)
+        if stack_client is not None:
+            await stack_client[0].aclose()
+
+    async def _aread(self, input_path, local_path):
+        client = await self._async_client()
+        if client is None:
+            return await super()._aread(input_path, local_path)
+
+        response = await client.get_object(Bucket=self.bucket_name, Key=self._key(input_path))
+        async with response["Body"] as stream:
+            data = await stream.read()
+        with open(local_path, "wb") as fh:
+            fh.write(data)
+
+    async def _awrite(self, local_path, output_path):
+        client = await self._async_client()
+        if client is None or os.path.getsize(local_path) > 8*1024*1024:
+            #Large files use the multipart upload of the sync client
+            return await super()._awrite(local_path, output_path)
+
+        with open(local_path, "rb") as fh:
+            data = fh.read()
+        await client.put_object(Bucket=self.bucket_name, Key=self._key(output_path), Body=data)
+        self._add_to_listing(output_path)
+
+    async def _aexists(self, path):
+        listing = self._cached_listing(path)
+        if listing is not None and path in listing:
+            return True
+
+        client = await self._async_client()
+        if client is None:
+            return await super()._aexists(path)
+
+        try:
+            await client.head_object(Bucket=self.bucket_name, Key=self._key(path))
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def _alist(self, input_path, recursive, with_times):
+        client = await self._async_client()
+        if client is None:
+            return await super()._alist(input_path, recursive, with_times)
+
+        kwds = {"Bucket": self.bucket_name}
+        if input_path is not None:
+            kwds["Prefix"] = input_path
+
+        keys = []
+        paginator = client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(**kwds):
+            for obj in page.get("Contents", []):
+                keys.append((obj["Key"], obj["LastModified"]) if with_times else obj["Key"])
+        return keys
+
+    @property
+    def transfer_manager(self):
+        """
+        Transfer manager shared by all bulk transfers of this store. Each
+        transfer is split into concurrent multipart requests and at most
+        max_concurrency requests run at once.
+
+        """
+
+        self.__connect()
+
+        if self._transfer_manager is None:
+            from boto3.s3.transfer import TransferConfig, create_transfer_manager
+            config = TransferConfig(max_concurrency=self.max_concurrency, use_threads=True)
+            self._transfer_manager = create_transfer_manager(self.s3, config)
+
+        return self._transfer_manager
+
+    def read_many(self, files, ignore_missing=False):
+        """
+        Read many input files concurrently. files is a dict or list of
+        (input_path, local_path) pairs.
+
+        Returns a dict of input_path to local_path. If ignore_missing is True,
+        keys that do not exist are left out instead of raising.
+
+        """
+
+        files = files.items() if isinstance(files, dict) else files
+
+        futures = [(input_path, local_path, self.transfer_manager.download(
+            self.bucket_name, self._key(input_path), local_path)) for \
+            input_path, local_path in files]
+
+        results = {}
+        for input_path, local_path, future in futures:
+            try:
+                future.result()
+                results[input_path] = local_path
+            except botocore.exceptions.ClientError as e:
+                if ignore_missing and e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                    RealtimeLogger.debug("{} missing from S3IOStore".format(input_path))
+                    continue
+                raise
+
+        return results
+
+    def write_many(self, files):
+        """
+        Write many output files concurrently. files is a dict or list of
+        (local_path, output_path) pairs.
+
+        """
+
+        files = files.items() if isinstance(files, dict) else files
+
+        futures = [(output_path, self.transfer_manager.upload(
+            local_path, self.bucket_name, self._key(output_path))) for \
+            local_path, output_path in files]
+
+        for output_path, future in futures:
+            future.result()
+            self._add_to_listing(output_path)
+
+    def _list_prefix(self, prefix):
+        """
+        Set of the keys directly in directory prefix (relative to name_prefix,
+        ending with /), or None if it has more than max_listing_keys keys.
+        Listings are cached for listing_ttl seconds.
+
+        """
+
+        with self._listing_lock:
+            cached = self._listings.get(prefix)
+        if cached is not None and time.time()-cached[0] < self.listing_ttl:
+            return cached[1]
+
+        self.__connect()
+
+        key_prefix = self._key(prefix)
+        start = len(self.name_prefix)+1 if self.name_prefix != "" else 0
+
+        keys = set()
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=key_prefix,
+          Delimiter="/"):
+            keys.update(obj["Key"][start:] for obj in page.get("Contents", []))
+            if len(keys) > self.max_listing_keys:
+                return None
+
+        with self._listing_lock:
+            self._listings[prefix] = (time.time(), keys)
+
+        return keys
+
+    def _cached_listing(self, path):
+        """
+        Fresh cached listing that would contain path, or None
+
+        """
+
+        prefix = os.path.dirname(path)
+        with self._listing_lock:
+            cached = self._listings.get(prefix+"/" if prefix != "" else "")
+        if cached is not None and time.time()-cached[0] < self.listing_ttl:
+            return cached[1]
+        return None
+
+    def _add_to_listing(self, path, exists=True):
+        listing = self._cached_listing(path)
+        if listing is not None:
+            with self._listing_lock:
+                if exists:
+                    listing.add(path)
+                else:
+                    listing.discard(path)
+
+    def exists_many(self, paths, min_list_keys=4):
+        """
+        Returns a dict of path to whether it exists in the store.
+
+        Paths are grouped by directory. Directories with at least min_list_keys
+        paths are listed once (unless they have more than max_listing_keys
+        keys) and every path in them is answered from the listing. A listing
+        cached by an earlier call only answers paths that are in it, since
+        other writers may have added keys since. Remaining paths, and paths at
+        the top of the store, are checked with concurrent HEAD requests.
+
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        groups = collections.defaultdict(list)
+        for path in paths:
+            groups[os.path.dirname(path)].append(path)
+
+        results = {}
+        to_head = []
+        for prefix, group in groups.items():
+            listing = self._cached_listing(group[0])
+            if listing is not None:
+                results.update((path, True) for path in group if path in listing)
+                to_head += [path for path in group if path not in listing]
+                continue
+
+            #Listing the top of the store would list the whole bucket
+            if prefix != "" and len(group) >= min_list_keys:
+                listing = self._list_prefix(prefix+"/")
+                if listing is not None:
+                    results.update((path, path in listing) for path in group)
+                    continue
+
+            to_head += group
+
+        if len(to_head) > 0:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+                results.update(zip(to_head, pool.map(self._head, to_head)))
+
+        return results
+
+    def _head(self, path):
+        self.__connect()
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=self._key(path))
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
     #@backoff
     def read_input_file(self, input_path, local_path):
         """
@@ -863,6 +1324,7 @@ class S3IOStore(IOStore):
         # Download the file contents.
         #self.s3.upload_file(local_path, self.bucket_name, os.path.join(self.name_prefix, output_path))
         self.s3r.Bucket(self.bucket_name).upload_file(local_path, os.path.join(self.name_prefix, output_path))
+        self._add_to_listing(output_path)
 
     @backoff
     def exists(self, path):
@@ -872,11 +1334,12 @@ class S3IOStore(IOStore):
 
         """
 
-        self.__connect()
+        listing = self._cached_listing(path)
+        if listing is not None and path in listing:
+            return True
 
         try:
-            self.s3.get_object(Bucket=self.bucket_name, Key=path)
-            return True
+            return self._head(path)
         except (SystemExit, KeyboardInterrupt):
             raise
         except:
@@ -900,6 +1363,19 @@ class S3IOStore(IOStore):
 
         return self.s3.head_object(Bucket=self.bucket_name, Key=path)['ContentLength']
 
+    def get_version(self, path):
+        """
+        Returns the ETag of the given file if it exists, or None otherwise.
+
+        """
+
+        self.__connect()
+
+        try:
+            return self.s3.head_object(Bucket=self.bucket_name, Key=self._key(path))["ETag"]
+        except botocore.exceptions.ClientError:
+            return None
+
     @backoff
     def get_number_of_items(self, path=None):
         """
@@ -910,8 +1386,9 @@ class S3IOStore(IOStore):
 
     def remove_file(self, path):
         self.s3r.Object(self.bucket_name, path).delete()
+        self._add_to_listing(path, exists=False)
 
-class FileS3IOStore(object):
+class FileS3IOStore(IOStore):
     """
     A class that lets you get input from and send output to AWS S3 Storage but
     checks local filesystem first
@@ -936,6 +1413,8 @@ class FileS3IOStore(object):
             self.store_string += "/{}".format(name_prefix)
         self.store_string += ":{}".format(file_path_dir)
 
+    async def aclose(self):
+        await self.S3IOStore.aclose()
 
     #@backoff
     def read_input_file(self, input_path, local_path):
@@ -1026,3 +1505,168 @@ class FileS3IOStore(object):
     def remove_file(self, path):
         self.FileIOStore.remove_file(path)
         self.S3IOStore.remove_file(path)
+
+    def get_version(self, path):
+        return self.S3IOStore.get_version(path)
+
+class CachedIOStore(IOStore):
+    """
+    Read-through wrapper around any IOStore that keeps a copy of every file
+    it reads in a local cache directory shared by all processes on the node.
+
+    Cached files are checked against the version of the file in the store
+    (ETag for S3, mtime and size for files) at most every validate_interval
+    seconds, so a changed file is downloaded again. The cache is kept under
+    max_bytes by removing the least recently used files. Use stats() to get
+    the hit rate and bytes saved.
+
+    All other methods are passed to the wrapped store.
+
+    """
+
+    def __init__(self, store, cache_dir=None, max_bytes=None, validate_interval=60):
+        from Prop3D.util.cache import LRUFileCache
+
+        self.store = IOStore.get(store)
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("PROP3D_IOSTORE_CACHE",
+                os.path.join(tempfile.gettempdir(), "Prop3D-iostore-cache"))
+        if max_bytes is None:
+            max_bytes = os.environ.get("PROP3D_IOSTORE_CACHE_SIZE")
+
+        self.cache = LRUFileCache(cache_dir, max_bytes=max_bytes)
+        self.validate_interval = validate_interval
+        self.store_name = self.store.store_name
+        self.store_string = self.store.store_string
+
+    def __getattr__(self, name):
+        if name == "store":
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    async def aclose(self):
+        await self.store.aclose()
+
+    def _cache_key(self, path):
+        return "{}/{}".format(self.store_string, path)
+
+    def _read_cached(self, input_path, local_path):
+        """
+        Copy a valid cached file to local_path. Returns None on a miss.
+
+        """
+
+        key = self._cache_key(input_path)
+        meta = self.cache.get_meta(key)
+        if meta is None or not self.cache.contains(key):
+            return None
+
+        if time.time()-meta.get("validated", 0) > self.validate_interval:
+            version = self.store.get_version(input_path)
+            if version is None or version != meta.get("version"):
+                RealtimeLogger.debug("{} changed in {}, removing from cache".format(
+                    input_path, self.store_string))
+                self.cache.remove(key)
+                return None
+            self.cache.update_meta(key, validated=time.time())
+
+        return self.cache.get(key, local_path)
+
+    def _add(self, path, local_path):
+        self.cache.put(self._cache_key(path), local_path, meta={
+            "version": self.store.get_version(path), "validated": time.time()})
+
+    def read_input_file(self, input_path, local_path):
+        """
+        Read from the local cache or from the store on a miss.
+
+        """
+
+        if self._read_cached(input_path, local_path) is not None:
+            return local_path
+
+        with self.cache.key_lock(self._cache_key(input_path)):
+            #Another process may have filled the entry while we waited
+            if self._read_cached(input_path, local_path) is not None:
+                return local_path
+
+            self.cache.record_miss()
+            self.store.read_input_file(input_path, local_path)
+            self._add(input_path, local_path)
+
+        return local_path
+
+    def read_many(self, files, ignore_missing=False):
+        """
+        Read many files, reading all cache misses from the store at once.
+
+        """
+
+        files = files.items() if isinstance(files, dict) else files
+
+        results, misses = {}, []
+        for input_path, local_path in files:
+            if self._read_cached(input_path, local_path) is not None:
+                results[input_path] = local_path
+            else:
+                misses.append((input_path, local_path))
+
+        if len(misses) > 0:
+            self.cache.record_miss(len(misses))
+            read = self.store.read_many(misses, ignore_missing=ignore_missing)
+            for input_path, local_path in read.items():
+                self._add(input_path, local_path)
+            results.update(read)
+
+        return results
+
+    def write_output_file(self, local_path, output_path):
+        """
+        Write to the store and keep a copy in the cache.
+
+        """
+
+        self.store.write_output_file(local_path, output_path)
+        self._add(output_path, local_path)
+
+    def write_many(self, files):
+        files = list(files.items() if isinstance(files, dict) else files)
+        self.store.write_many(files)
+        for local_path, output_path in files:
+            self._add(output_path, local_path)
+
+    def exists(self, path):
+        return self.store.exists(path)
+
+    def exists_many(self, paths):
+        return self.store.exists_many(paths)
+
+    def list_input_directory(self, input_path=None, recursive=False, with_times=False):
+        return self.store.list_input_directory(input_path, recursive=recursive,
+            with_times=with_times)
+
+    def get_mtime(self, path):
+        return self.store.get_mtime(path)
+
+    def get_size(self, path):
+        return self.store.get_size(path)
+
+    def get_version(self, path):
+        return self.store.get_version(path)
+
+    def get_number_of_items(self, path=None):
+        return self.store.get_number_of_items(path)
+
+    def remove_file(self, path):
+        self.store.remove_file(path)
+        self.cache.remove(self._cache_key(path))
+
+    def stats(self, save=True):
+        """
+        Hit rate, bytes saved and evictions for this process and in total for
+        all processes sharing the cache directory.
+
+        """
+
+        return self.cache.stats(save=save)
@@ -0,0 +1,199 @@
+"""Optimal superposition of matched coordinates with the Kabsch algorithm.
+
+The coordinates must already be in correspondence, e.g. the CA atoms of the
+same residues in decoys of one complex. Use TM-align or MM-align
+(parsers.superpose.Align) when they are not.
+
+Every function works on stacks of structures: a structure is (N, 3) and a batch
+is (M, N, 3). The rotations of a whole batch come from one call to
+np.linalg.svd on the stacked 3x3 covariance matrices, and the RMSD comes
+straight from the singular values, so nothing is written to disk.
+
+TM-scores here use the RMSD-optimal superposition instead of searching for the
+superposition that maximizes the TM-score, so they are a lower bound of the
+TM-align score for the same residue correspondence.
+"""
+import numpy as np
+
+def _center(coords):
+    centroid = coords.mean(axis=-2, keepdims=True)
+    return coords-centroid, centroid
+
+def _rotations(covariance):
+    """Proper rotations that best map the rows of P onto Q from stacked
+    covariance matrices P^T Q of shape (..., 3, 3)
+
+    Returns
+    -------
+    rotation : np.array (..., 3, 3)
+        P @ rotation is superposed on Q
+    s : np.array (..., 3)
+        Singular values, with the smallest one negated where the SVD
+        would give a reflection
+    """
+    u, s, vt = np.linalg.svd(covariance)
+    d = np.where(np.linalg.det(np.matmul(u, vt)) < 0, -1., 1.)
+    #Flip the axis of the smallest singular value instead of reflecting
+    s = s.copy()
+    s[..., -1] *= d
+    u = u.copy()
+    u[..., :, -1] *= d[..., None]
+    return np.matmul(u, vt), s
+
+def _as_coords(coords):
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim < 2 or coords.shape[-1] != 3:
+        raise ValueError("Coordinates must have shape (..., N, 3), not {}".format(coords.shape))
+    return coords
+
+def kabsch(mobile, target):
+    """Rotation and translation that minimize the RMSD of mobile onto target
+
+    Parameters
+    ----------
+    mobile, target : array-like (..., N, 3)
+        Matched coordinates. Leading dimensions are broadcast, so one
+        structure can be superposed onto many or many onto one
+
+    Returns
+    -------
+    rotation : np.array (..., 3, 3)
+    translation : np.array (..., 3)
+        mobile @ rotation + translation is superposed on target
+    rmsd : np.array (...)
+        RMSD after superposition
+    """
+    mobile, target = _as_coords(mobile), _as_coords(target)
+    if mobile.shape[-2] != target.shape[-2]:
+        raise ValueError("mobile and target must have the same number of atoms")
+    if mobile.shape[-2] == 0:
+        raise ValueError("Cannot superpose empty coordinates")
+
+    p, p_center = _center(mobile)
+    q, q_center = _center(target)
+
+    rotation, s = _rotations(np.matmul(np.swapaxes(p, -1, -2), q))
+    translation = (q_center-np.matmul(p_center, rotation))[..., 0, :]
+
+    #|P R - Q|^2 = |P|^2 + |Q|^2 - 2 tr(R^T P^T Q)
+    error = np.square(p).sum(axis=(-2, -1))+np.square(q).sum(axis=(-2, -1))-2*s.sum(axis=-1)
+    rmsd = np.sqrt(np.clip(error, 0, None)/mobile.shape[-2])
+
+    return rotation, translation, rmsd
+
+def transform(coords, rotation, translation):
+    """Apply a rotation and translation from kabsch to coords (..., N, 3)"""
+    return np.matmul(_as_coords(coords), rotation)+np.expand_dims(translation, -2)
+
+def rmsd(coords1, coords2):
+    """RMSD of matched coordinates (..., N, 3) without superposing them"""
+    return np.sqrt(np.square(_as_coords(coords1)-_as_coords(coords2)).sum(axis=-1).mean(axis=-1))
+
+def tm_d0(length):
+    """Distance scale of the TM-score for a target of length residues"""
+    if length <= 21:
+        return 0.5
+    return max(1.24*np.cbrt(length-15)-1.8, 0.5)
+
+def _tm(distances, length):
+    d0 = tm_d0(length)
+    return (1./(1.+np.square(distances/d0))).sum(axis=-1)/length
+
+def superpose(mobile, target, length=None):
+    """Superpose mobile onto target
+
+    Parameters
+    ----------
+    mobile, target : array-like (..., N, 3)
+        Matched CA coordinates
+    length : int
+        Length used to normalize the TM-score. Default is N
+
+    Returns
+    -------
+    superposed : np.array (..., N, 3)
+        mobile after superposition
+    rmsd : np.array (...)
+    tm_score : np.array (...)
+    """
+    rotation, translation, rms = kabsch(mobile, target)
+    superposed = transform(mobile, rotation, translation)
+    distances = np.linalg.norm(superposed-_as_coords(target), axis=-1)
+    length = length or superposed.shape[-2]
+    return superposed, rms, _tm(distances, length)
+
+def one_vs_many(reference, models, length=None):
+    """Superpose each model onto one reference
+
+    Parameters
+    ----------
+    reference : array-like (N, 3)
+    models : array-like (M, N, 3)
+    length : int
+        Length used to normalize the TM-score. Default is N
+
+    Returns
+    -------
+    rmsd, tm_score : np.array (M,)
+    rotation : np.array (M, 3, 3)
+    translation : np.array (M, 3)
+    """
+    reference, models = _as_coords(reference), _as_coords(models)
+    rotation, translation, rms = kabsch(models, reference[None])
+    distances = np.linalg.norm(transform(models, rotation, translation)-reference, axis=-1)
+    length = length or reference.shape[-2]
+    return rms, _tm(distances, length), rotation, translation
+
+def many_vs_many(models, length=None, tm_score=True, max_memory=256*1024**2):
+    """Superpose every model onto every other model
+
+    Covariance matrices of all pairs in a block of rows are built with one
+    einsum and solved with one SVD. Blocks are sized so the rotated
+    coordinates of a block use about max_memory bytes.
+
+    Parameters
+    ----------
+    models : array-like (M, N, 3)
+    length : int
+        Length used to normalize the TM-score. Default is N
+    tm_score : bool
+        Also calculate TM-scores. RMSD only needs the singular values, so
+        it is much faster without them
+
+    Returns
+    -------
+    rmsd : np.array (M, M)
+        Symmetric RMSD matrix
+    tm_score : np.array (M, M)
+        TM-score of model i superposed onto model j at [i, j]. Only returned
+        if tm_score is True
+    """
+    models = _as_coords(models)
+    n_models, n_atoms = models.shape[0], models.shape[1]
+    length = length or n_atoms
+
+    centered, _ = _center(models)
+    squares = np.square(centered).sum(axis=(1, 2))
+
+    rms = np.zeros((n_models, n_models))
+    tms = np.ones((n_models, n_models)) if tm_score else None
+
+    block_size = max(1, int(max_memory//max(n_models*n_atoms*3*8, 1)))
+    for start in range(0, n_models, block_size):
+        stop = min(start+block_size, n_models)
+        block = centered[start:stop]
+        rotation, s = _rotations(np.einsum("bnk,mnl->bmkl", block, centered))
+        error = squares[start:stop, None]+squares[None, :]-2*s.sum(axis=-1)
+        rms[start:stop] = np.sqrt(np.clip(error, 0, None)/n_atoms)
+        if tm_score:
+            rotated = np.einsum("bnk,bmkl->bmnl", block, rotation)
+            distances = np.linalg.norm(rotated-centered[None], axis=-1)
+            tms[start:stop] = _tm(distances, length)
+
+    #Rounding can make the SVD path slightly asymmetric
+    rms = (rms+rms.T)/2.
+    np.fill_diagonal(rms, 0.)
+
+    if tm_score:
+        return rms, tms
+    return rms
@@ -13,6 +13,7 @@ from botocore.exceptions import ClientError
 
 from Prop3D.util import SubprocessChain, natural_keys
 from Prop3D.util.iostore import IOStore
+from Prop3D.pdb_tools.pipeline import pipeline
 
 #Auto-scaling on AWS with toil has trouble finding modules? Heres the workaround
 PDB_TOOLS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "pdb_tools")
@@ -209,8 +210,7 @@ def rottrans_from_symop(moving_pdb, symmetry_operation, new_file=None):
 
 def tidy(pdb_file, replace=False, new_file=None):
     _new_file = pdb_file+".tidy.pdb" if new_file is None else new_file
-    with open(_new_file, "w") as f:
-        subprocess.call([sys.executable, os.path.join(PDB_TOOLS, "pdb_tidy.py"), pdb_file], stdout=f)
+    pipeline(pdb_file).tidy().write(_new_file)
 
     if replace and new_file is None:
         try:
@@ -226,8 +226,7 @@ def delocc_pdb(pdb_file, updated_pdb=None):
     if updated_pdb is None:
         updated_pdb = "{}.delocc.pdb".format(os.path.splitext(pdb_file)[0])
 
-    with open(updated_pdb, "w") as f:
-        subprocess.call([sys.executable, os.path.join(PDB_TOOLS, "pdb_delocc.py"), pdb_file], stdout=f)
+    pipeline(pdb_file).delocc().write(updated_pdb)
 
     return updated_pdb
 
@@ -0,0 +1,310 @@
+"""Lightweight timing and resource instrumentation for pipeline stages.
+
+Wrap a stage in ``with stage("dssp"):`` or decorate a function with
+``@timed("prepare_domain")``. Each stage records its wall time, CPU time
+(including child processes, e.g. pdb2pqr or SCWRL), RSS and bytes
+read/written.
+
+The kernel only keeps the peak RSS of the whole process (and of its largest
+child), not of a time span. max_rss is that peak when the stage ended and
+new_peak says whether it rose during the stage. If it did not, the stage
+used at most max_rss, but its own peak is unknown. rss_start and rss_end are
+the current RSS of the process. Stages run inside ``stage_context(cath_domain=..., superfamily=...)``
+are tagged with the domain, and the records are flushed when the outermost
+context exits.
+
+Records are only collected if the environment variable PROP3D_STAGE_LOG is set
+to a directory (each worker process appends to its own CSV file there) or to
+a file ending in .csv or .parquet. Summarize them with:
+
+    python -m Prop3D.util.stages PROP3D_STAGE_LOG_DIR --by superfamily stage
+"""
+import os
+import time
+import socket
+import resource
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+import pandas as pd
+
+STAGE_LOG_ENV = "PROP3D_STAGE_LOG"
+
+_state = threading.local()
+_records = []
+_records_lock = threading.Lock()
+
+def _get_stack():
+    if not hasattr(_state, "stack"):
+        _state.stack = []
+        _state.tags = {}
+    return _state.stack
+
+def _get_tags():
+    _get_stack()
+    return _state.tags
+
+def _io_counters():
+    """Bytes read and written by this process from /proc/self/io (Linux only)"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+def _usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = self_usage.ru_utime+self_usage.ru_stime+child_usage.ru_utime+child_usage.ru_stime
+    #ru_maxrss is in kilobytes on Linux
+    max_rss = max(self_usage.ru_maxrss, child_usage.ru_maxrss)*1024
+    return cpu, max_rss
+
+def _rss():
+    """Current RSS of this process in bytes from /proc/self/statm (Linux only)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def enabled():
+    return os.environ.get(STAGE_LOG_ENV) is not None
+
+@contextmanager
+def stage(name, **tags):
+    """Time a stage of the pipeline. Counters can be added to the yielded dict
+    or with count(). Stages can be nested; the name of nested stages is
+    prefixed by their parents, e.g. prepare_domain/pdb2pqr. Nothing is
+    measured or kept unless instrumentation is enabled
+
+    Parameters
+    ----------
+    name : str
+        Name of stage
+    tags : dict
+        Extra columns to save with this record
+    """
+    stack = _get_stack()
+    full_name = "/".join([s["stage"] for s in stack[-1:]]+[name])
+
+    record = {"stage": full_name, "status": "ok"}
+    record.update(_get_tags())
+    record.update(tags)
+
+    stack.append(record)
+
+    active = enabled()
+    if active:
+        start_cpu, start_max_rss = _usage()
+        start_rss = _rss()
+        start_read, start_write = _io_counters()
+    start = time.time()
+
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+
+        if active:
+            wall_time = time.time()-start
+            end_cpu, max_rss = _usage()
+            end_read, end_write = _io_counters()
+
+            record.update({
+                "start_time": start,
+                "wall_time": wall_time,
+                "cpu_time": end_cpu-start_cpu,
+                "max_rss": max_rss,
+                "new_peak": max_rss > start_max_rss,
+                "rss_start": start_rss,
+                "rss_end": _rss(),
+                "bytes_read": end_read-start_read,
+                "bytes_written": end_write-start_write,
+                "host": socket.gethostname(),
+                "pid": os.getpid()
+            })
+
+            with _records_lock:
+                _records.append(record)
+
+def timed(name=None, **tags):
+    """Decorator to run a function inside of a stage. Uses the function name
+    if name is None"""
+    def decorator(func):
+        stage_name = name if name is not None else func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            with stage(stage_name, **tags):
+                return func(*args, **kwds)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    """Add value to a counter in the current stage. Ignored outside of a stage"""
+    stack = _get_stack()
+    if len(stack) > 0:
+        stack[-1][name] = stack[-1].get(name, 0)+value
+
+@contextmanager
+def stage_context(**tags):
+    """Tag every stage inside of this context (e.g. cath_domain and superfamily)
+    and flush the records when the outermost context exits"""
+    current_tags = _get_tags()
+    old_tags = dict(current_tags)
+    current_tags.update(tags)
+    try:
+        yield
+    finally:
+        _state.tags = old_tags
+        if len(old_tags) == 0 and len(_get_stack()) == 0:
+            flush()
+
+def get_records(clear=False):
+    """Records collected in this process that have not been flushed"""
+    global _records
+    with _records_lock:
+        records = list(_records)
+        if clear:
+            _records = []
+    return records
+
+def _default_path():
+    path = os.environ.get(STAGE_LOG_ENV)
+    if path is None:
+        return None
+    if not path.endswith((".csv", ".parquet")):
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        path = os.path.join(path, "stages-{}-{}.csv".format(socket.gethostname(), os.getpid()))
+    return path
+
+def flush(path=None):
+    """Write all collected records and clear them. CSV files are appended to;
+    Parquet files cannot be appended to, so a numbered file is written next
+    to path for each flush.
+
+    Parameters
+    ----------
+    path : str
+        File to write to. If None, use PROP3D_STAGE_LOG. Records are dropped if
+        neither is set.
+
+    Returns
+    -------
+    Path of the written file or None
+    """
+    records = get_records(clear=True)
+    if path is None:
+        path = _default_path()
+
+    if path is None or len(records) == 0:
+        return None
+
+    df = pd.DataFrame(records)
+
+    if path.endswith(".parquet"):
+        prefix = path[:-len(".parquet")]
+        path = "{}-{}-{}-{}.parquet".format(prefix, socket.gethostname(), os.getpid(),
+            int(time.time()*1000))
+        df.to_parquet(path, index=False)
+    else:
+        #Columns may differ between flushes, so keep the header of the existing file
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            header = pd.read_csv(path, nrows=0).columns.tolist()
+            df = df.reindex(columns=header+[c for c in df.columns if c not in header])
+            if len(df.columns) > len(header):
+                old_df = pd.read_csv(path)
+                df = pd.concat((old_df, df), axis=0)
+                df.to_csv(path, index=False)
+            else:
+                df.to_csv(path, mode="a", header=False, index=False)
+        else:
+            df.to_csv(path, index=False)
+
+    return path
+
+def load_stage_records(path):
+    """Read stage records from a CSV/Parquet file or a directory of them"""
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path)) \
+            if f.endswith((".csv", ".parquet"))]
+    else:
+        files = [path]
+
+    dfs = [pd.read_parquet(f) if f.endswith(".parquet") else pd.read_csv(f) \
+        for f in files]
+
+    if len(dfs) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(dfs, axis=0, ignore_index=True)
+
+def summarize_stages(records, by=("superfamily", "stage")):
+    """Aggregate stage records, e.g. to find out which stage is limiting a
+    superfamily
+
+    Parameters
+    ----------
+    records : pd.DataFrame or str
+        Records or path to load them from with load_stage_records
+    by : list
+        Columns to group by
+
+    Returns
+    -------
+    pd.DataFrame with the number of records, failures, total/mean/median/max wall
+    time, total CPU time, max RSS and total bytes read and written per group.
+    max_rss only counts records that raised the peak of their process
+    (new_peak), and new_peaks is how many did
+    """
+    if isinstance(records, str):
+        records = load_stage_records(records)
+
+    by = [col for col in by if col in records.columns]
+    if len(by) == 0:
+        by = ["stage"]
+
+    records = records.assign(failed=records["status"]!="ok")
+    if "new_peak" in records.columns:
+        #Records that did not raise the peak only carry the peak of earlier stages
+        new_peak = records["new_peak"].astype(str).str.lower()=="true"
+        records = records.assign(new_peak=new_peak, max_rss=records["max_rss"].where(new_peak))
+    else:
+        records = records.assign(new_peak=True)
+
+    summary = records.groupby(by).agg(
+        n=("wall_time", "size"),
+        failed=("failed", "sum"),
+        wall_time=("wall_time", "sum"),
+        mean_wall_time=("wall_time", "mean"),
+        median_wall_time=("wall_time", "median"),
+        max_wall_time=("wall_time", "max"),
+        cpu_time=("cpu_time", "sum"),
+        max_rss=("max_rss", "max"),
+        new_peaks=("new_peak", "sum"),
+        bytes_read=("bytes_read", "sum"),
+        bytes_written=("bytes_written", "sum"))
+
+    return summary.sort_values("wall_time", ascending=False)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarize pipeline stage timings")
+    parser.add_argument("path", help="Stage log file or directory (PROP3D_STAGE_LOG)")
+    parser.add_argument("--by", nargs="+", default=["superfamily", "stage"])
+    parser.add_argument("--out", default=None, help="Save summary as CSV")
+    args = parser.parse_args()
+
+    summary = summarize_stages(args.path, by=args.by)
+
+    if args.out is not None:
+        summary.to_csv(args.out)
+    else:
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(summary)
@@ -2,6 +2,7 @@
 #By John Vivian January 13 2018
 
 import os
+import time
 from math import ceil
 import tarfile
 import uuid
@@ -115,6 +116,228 @@ def map_job(job, func, inputs, *args, **kwds):
     #     for sample in inputs:
     #         job.addChildJobFn(func, sample, *args, **kwds)
 
+def memory_to_bytes(memory):
+    """
+    >>> memory_to_bytes("2G")
+    2147483648
+    >>> memory_to_bytes(1024)
+    1024
+    """
+    if not isinstance(memory, str):
+        return int(memory)
+    units = {"K":1024, "M":1024**2, "G":1024**3, "T":1024**4}
+    memory = memory.strip().upper().rstrip("IB")
+    if memory[-1] in units:
+        return int(float(memory[:-1])*units[memory[-1]])
+    return int(float(memory))
+
+class BatchCostEstimator(object):
+    """Linear cost model for map_job_batched: a sample of a given size (e.g.
+    domain_length or number of atoms) is expected to take
+    base_time+time_per_unit*size seconds and base_memory+memory_per_unit*size
+    bytes. The per unit costs are updated from the runtimes of finished
+    batches with an exponential moving average.
+
+    Parameters
+    ----------
+    time_per_unit : float
+        Starting guess of seconds per unit of size
+    base_time : float
+        Fixed seconds per sample (downloads, start up)
+    memory_per_unit : float
+        Bytes per unit of size
+    base_memory : float
+        Fixed bytes per sample
+    default_size : float
+        Size to use for samples without a known size
+    smoothing : float
+        Weight of new measurements in the moving average
+    """
+    def __init__(self, time_per_unit=0.5, base_time=30., memory_per_unit=2e6,
+      base_memory=5e8, default_size=200, smoothing=0.5):
+        self.time_per_unit = time_per_unit
+        self.base_time = base_time
+        self.memory_per_unit = memory_per_unit
+        self.base_memory = base_memory
+        self.default_size = default_size
+        self.smoothing = smoothing
+        self.n_updates = 0
+
+    def size(self, size):
+        try:
+            size = float(size)
+        except (TypeError, ValueError):
+            return self.default_size
+        return size if size == size and size > 0 else self.default_size
+
+    def estimate_time(self, size):
+        return self.base_time+self.time_per_unit*self.size(size)
+
+    def estimate_memory(self, size):
+        return self.base_memory+self.memory_per_unit*self.size(size)
+
+    def update(self, stats):
+        """Update per unit time from batch stats returned by run_batch_job
+
+        Parameters
+        ----------
+        stats : list of dicts
+            Each with the keys n_samples, total_size, runtime and cores
+        """
+        stats = [s for s in stats if isinstance(s, dict) and s.get("total_size", 0) > 0]
+        if len(stats) == 0:
+            return self
+
+        #Total core seconds spent on the size dependent part of each batch
+        work = sum(max(s["runtime"]*s["cores"]-self.base_time*s["n_samples"], 0) for s in stats)
+        total_size = sum(s["total_size"] for s in stats)
+        measured = work/total_size
+
+        if self.n_updates == 0:
+            self.time_per_unit = measured
+        else:
+            self.time_per_unit = (1-self.smoothing)*self.time_per_unit+self.smoothing*measured
+        self.n_updates += 1
+
+        RealtimeLogger.info("Updated batch cost estimate to {:.3f}s per unit from {} batches".format(
+            self.time_per_unit, len(stats)))
+
+        return self
+
+def make_batches(inputs, sizes, estimator, target_time=3600, cores=1, max_batch_size=None):
+    """Greedily group inputs (keeping their order) into batches whose estimated
+    runtime on the given number of cores is close to target_time. Samples
+    that are expected to take longer than target_time get their own batch.
+
+    Returns
+    -------
+    A list of (batch_inputs, batch_sizes)
+    """
+    batches = []
+    batch, batch_sizes, batch_time = [], [], 0.
+    for sample, size in zip(inputs, sizes):
+        sample_time = estimator.estimate_time(size)/cores
+        if len(batch) > 0 and (batch_time+sample_time > target_time or \
+          (max_batch_size is not None and len(batch) >= max_batch_size)):
+            batches.append((batch, batch_sizes))
+            batch, batch_sizes, batch_time = [], [], 0.
+        batch.append(sample)
+        batch_sizes.append(size)
+        batch_time += sample_time
+
+    if len(batch) > 0:
+        batches.append((batch, batch_sizes))
+
+    return batches
+
+def run_batch_job(job, func, inputs, sizes, *args, batch_cores=1, **kwds):
+    """Run func over all inputs inside of this job using loop_job_rv and report
+    the runtime so it can be fed back into the BatchCostEstimator"""
+    start = time.time()
+    for _ in loop_job_rv(job, func, inputs, *args, cores=batch_cores, **kwds):
+        pass
+    runtime = time.time()-start
+
+    RealtimeLogger.info("Finished batch of {} samples in {:.1f}s".format(len(inputs), runtime))
+
+    return {
+        "n_samples": len(inputs),
+        "total_size": float(sum(sizes)),
+        "runtime": runtime,
+        "cores": batch_cores
+    }
+
+def update_batch_estimator(job, func, inputs, sizes, estimator, stats, *args, **kwds):
+    estimator.update(stats)
+    return map_job_batched(job, func, inputs, *args, sizes=sizes, estimator=estimator, **kwds)
+
+def map_job_batched(job, func, inputs, *args, sizes=None, target_time=3600,
+  target_memory=None, cores=1, batch_cores=None, estimator=None, batches_per_wave=100,
+  max_batch_size=None, **kwds):
+    """
+    Alternative to map_job that groups inputs into child jobs that are expected
+    to run for about target_time seconds instead of creating one job per sample.
+    Samples inside of a batch are run with loop_job_rv. Batches are started in
+    waves of batches_per_wave; the runtimes of each wave are used to update
+    the cost estimator before the next wave is batched.
+
+    The next wave is a follow-on of this job, so it only starts once every
+    batch of the current wave has finished: one slow batch holds back the
+    rest of the run until it is done. Use a larger batches_per_wave (fewer
+    barriers) or a smaller target_time (shorter stragglers) if that matters.
+
+    When this function is added as a Toil job, Toil takes cores as the
+    requirement of that job and the function never sees it. Pass batch_cores
+    instead, which overrides cores.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: Function to run, passes one sample as first argument
+    :param list inputs: Array of samples to be batched
+    :param list args: any arguments to be passed to the function
+    :param sizes: Cost of each sample (e.g. domain_length from the CATH domain list or
+        number of atoms). Either a list the same length as inputs, a dict or a function
+        mapping a sample to its size. Samples without a size use estimator.default_size
+    :param float target_time: Wall time in seconds for each batch
+    :param target_memory: Maximum memory for each batch in bytes or as a string (e.g. '8G').
+        The number of cores used in a batch is reduced so that cores*memory of the largest
+        sample fits
+    :param int cores: Number of cores used to run each batch
+    :param int batch_cores: Same as cores, for when this function is a Toil job
+    :param BatchCostEstimator estimator: Cost model, uses defaults if None
+    """
+    if batch_cores is not None:
+        cores = batch_cores
+
+    if estimator is None:
+        estimator = BatchCostEstimator()
+
+    inputs = list(inputs)
+
+    if sizes is None:
+        sizes = [None]*len(inputs)
+    elif callable(sizes):
+        sizes = [sizes(sample) for sample in inputs]
+    elif isinstance(sizes, dict):
+        sizes = [sizes.get(sample) for sample in inputs]
+    else:
+        sizes = list(sizes)
+        assert len(sizes) == len(inputs), "sizes must be the same length as inputs"
+
+    sizes = [estimator.size(size) for size in sizes]
+
+    if target_memory is not None and isinstance(target_memory, str):
+        target_memory = memory_to_bytes(target_memory)
+
+    batches = make_batches(inputs, sizes, estimator, target_time=target_time,
+        cores=cores, max_batch_size=max_batch_size)
+
+    #Only run the first wave now if there are more to run, the rest will use updated costs
+    wave, rest = batches[:batches_per_wave], batches[batches_per_wave:]
+
+    RealtimeLogger.info("MAP_JOB_BATCHED: total: {}; batches: {}; running now: {}".format(
+        len(inputs), len(batches), len(wave)))
+
+    stats = []
+    for batch, batch_sizes in wave:
+        batch_memory = max(estimator.estimate_memory(size) for size in batch_sizes)
+        job_cores = cores
+        if target_memory is not None:
+            job_cores = int(max(min(cores, target_memory//batch_memory), 1))
+
+        #cores and memory are used by toil as job requirements
+        batch_job = job.addChildJobFn(run_batch_job, func, batch, batch_sizes, *args,
+            batch_cores=job_cores, cores=job_cores, memory=int(batch_memory*job_cores),
+            **kwds)
+        stats.append(batch_job.rv())
+
+    if len(rest) > 0:
+        rest_inputs = [sample for batch, _ in rest for sample in batch]
+        rest_sizes = [size for _, batch_sizes in rest for size in batch_sizes]
+        job.addFollowOnJobFn(update_batch_estimator, func, rest_inputs, rest_sizes,
+            estimator, stats, *args, target_time=target_time, target_memory=target_memory,
+            batch_cores=cores, batches_per_wave=batches_per_wave, max_batch_size=max_batch_size,
+            **kwds)
+
 def map_job_rv(job, func, inputs, *args, **kwds):
     """
     Spawns a tree of jobs to avoid overloading the number of jobs spawned by a single parent.
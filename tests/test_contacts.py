@@ -0,0 +1,89 @@
+"""ContactMap and compare_contacts must agree with brute-force contacts and
+set intersections"""
+import itertools
+
+import numpy as np
+import pytest
+
+from Prop3D.util.contacts import ContactMap, compare_contacts
+
+class Atom(object):
+    def __init__(self, coord, element="C"):
+        self.coord = np.asarray(coord, dtype=float)
+        self.element = element
+
+class Residue(list):
+    def __init__(self, resid, atoms):
+        super().__init__(atoms)
+        self.id = (" ", resid, " ")
+
+def random_chain(rng, n_residues, offset):
+    return [Residue(i+1, [Atom(rng.uniform(0, 12, 3)+offset) for _ in range(3)]) \
+        for i in range(n_residues)]
+
+def brute_force_contacts(chain1, chain2, cutoff):
+    return {(r1.id, r2.id) for r1, r2 in itertools.product(chain1, chain2) \
+        if any(np.linalg.norm(a1.coord-a2.coord) <= cutoff for a1 in r1 for a2 in r2)}
+
+def contact_set(contacts):
+    return {(contacts.rows[i], contacts.cols[j]) for i, j in contacts.pairs}
+
+@pytest.mark.parametrize("seed", range(3))
+def test_from_chains_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    chain1, chain2 = random_chain(rng, 15, 0.), random_chain(rng, 12, 6.)
+    contacts = ContactMap.from_chains(chain1, chain2, cutoff=4.)
+    expected = brute_force_contacts(chain1, chain2, 4.)
+    assert len(expected) > 0
+    assert contact_set(contacts) == expected
+    assert contacts.to_dense().sum() == len(expected)
+
+    face1, face2 = contacts.interface()
+    assert set(face1) == {r1 for r1, _ in expected}
+    assert set(face2) == {r2 for _, r2 in expected}
+
+def test_no_atoms():
+    contacts = ContactMap.from_chains([], [Residue(1, [Atom([0, 0, 0])])])
+    assert len(contacts) == 0
+    assert contacts.shape == (0, 1)
+
+def test_compare_contacts_matches_sets():
+    rng = np.random.default_rng(7)
+    chain1, chain2 = random_chain(rng, 15, 0.), random_chain(rng, 12, 6.)
+    reference = ContactMap.from_chains(chain1, chain2, cutoff=4.)
+    ref_set = contact_set(reference)
+
+    decoys = []
+    for _ in range(4):
+        moved1 = [Residue(r.id[1], [Atom(a.coord+rng.normal(0, 1., 3)) for a in r]) for r in chain1]
+        moved2 = [Residue(r.id[1], [Atom(a.coord+rng.normal(0, 1., 3)) for a in r]) for r in chain2]
+        decoys.append(ContactMap.from_chains(moved1, moved2, cutoff=4.))
+    #A decoy with residues that are not in the reference and no contacts
+    decoys.append(ContactMap.from_chains(random_chain(rng, 3, 100.)[:1],
+        random_chain(rng, 3, 0.), cutoff=4.))
+
+    scores = compare_contacts(reference, decoys, index=list(range(len(decoys))))
+    assert list(scores.index) == list(range(len(decoys)))
+
+    for i, decoy in enumerate(decoys):
+        decoy_set = contact_set(decoy)
+        common = len(ref_set & decoy_set)
+        assert scores.loc[i, "fcc"] == pytest.approx(common/len(ref_set))
+        assert scores.loc[i, "recall"] == scores.loc[i, "fcc"]
+        assert scores.loc[i, "precision"] == pytest.approx(
+            common/len(decoy_set) if len(decoy_set) > 0 else 0.)
+        assert scores.loc[i, "jaccard"] == pytest.approx(
+            common/len(ref_set | decoy_set))
+
+        for axis, name in ((0, "interface_jaccard_1"), (1, "interface_jaccard_2")):
+            ref_face = set(reference.interface()[axis])
+            decoy_face = set(decoy.interface()[axis])
+            assert scores.loc[i, name] == pytest.approx(
+                len(ref_face & decoy_face)/len(ref_face | decoy_face))
+
+def test_identical_decoy():
+    rng = np.random.default_rng(3)
+    chain1, chain2 = random_chain(rng, 10, 0.), random_chain(rng, 10, 6.)
+    reference = ContactMap.from_chains(chain1, chain2, cutoff=4.)
+    scores = compare_contacts(reference, [reference]).iloc[0]
+    assert scores.tolist() == pytest.approx([1.]*len(scores))
@@ -0,0 +1,58 @@
+"""Batched Kabsch superpositions must agree with one pair at a time and always
+give proper rotations"""
+import numpy as np
+import pytest
+
+from Prop3D.util import kabsch
+
+def random_rotation(rng):
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q = q*np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:, 0] *= -1
+    return q
+
+def test_recovers_rotation():
+    rng = np.random.default_rng(0)
+    target = rng.normal(0, 10, (20, 3))
+    rotation = random_rotation(rng)
+    mobile = np.matmul(target-5., rotation.T)
+    rot, trans, rmsd = kabsch.kabsch(mobile, target)
+    assert rmsd == pytest.approx(0., abs=1e-6)
+    assert np.allclose(kabsch.transform(mobile, rot, trans), target, atol=1e-6)
+
+def test_batched_matches_pairs():
+    rng = np.random.default_rng(1)
+    target = rng.normal(0, 10, (25, 3))
+    models = np.stack([np.matmul(target, random_rotation(rng))+rng.normal(0, 1., target.shape) \
+        for _ in range(5)])
+
+    rot, trans, rmsd = kabsch.kabsch(models, target[None])
+    rms, tm_score, _, _ = kabsch.one_vs_many(target, models)
+    for i, model in enumerate(models):
+        rot_i, trans_i, rmsd_i = kabsch.kabsch(model, target)
+        assert np.allclose(rot[i], rot_i)
+        assert np.allclose(trans[i], trans_i)
+        assert rmsd[i] == pytest.approx(rmsd_i)
+        assert rms[i] == pytest.approx(rmsd_i)
+        #RMSD from the singular values matches the superposed coordinates
+        superposed, rmsd_s, tm_s = kabsch.superpose(model, target)
+        assert kabsch.rmsd(superposed, target) == pytest.approx(rmsd_i)
+        assert tm_score[i] == pytest.approx(tm_s)
+
+    all_rms, all_tm = kabsch.many_vs_many(models)
+    for i in range(len(models)):
+        for j in range(len(models)):
+            _, rmsd_ij, tm_ij = kabsch.superpose(models[i], models[j])
+            assert all_rms[i, j] == pytest.approx(rmsd_ij, abs=1e-6)
+            assert all_tm[i, j] == pytest.approx(tm_ij)
+
+def test_reflected_input():
+    rng = np.random.default_rng(2)
+    target = rng.normal(0, 10, (15, 3))
+    mirror = target*np.array([-1., 1., 1.])
+    rot, trans, rmsd = kabsch.kabsch(mirror, target)
+    assert np.linalg.det(rot) == pytest.approx(1.)
+    #A mirror image cannot be superposed exactly without a reflection
+    assert rmsd > 0.1
+    assert rmsd == pytest.approx(kabsch.rmsd(kabsch.transform(mirror, rot, trans), target))
@@ -0,0 +1,94 @@
+"""The in-process pdb_tools pipeline must write the same bytes as piping the
+original pdb_*.py scripts together"""
+import os
+import io
+import sys
+import subprocess
+
+import pytest
+
+from Prop3D.pdb_tools.pipeline import pipeline
+
+PDB_TOOLS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "Prop3D", "pdb_tools")
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+MULTI_MODEL = os.path.join(DATA, "multi_model.pdb")
+ALTLOC = os.path.join(DATA, "altloc_inscode_het.pdb")
+
+#(pdb file, script steps, equivalent pipeline steps)
+CASES = {
+    "extract_domain": (ALTLOC,
+        [("pdb_selmodel.py", ["-1"]), ("pdb_selchain.py", ["-A"]), ("pdb_delocc.py", []),
+         ("pdb_striphet.py", []), ("pdb_tidy.py", [])],
+        [("selmodel", [1]), ("selchain", ["A"]), ("delocc", []), ("striphet", []),
+         ("tidy", [])]),
+    "extract_domain_rslice": (ALTLOC,
+        [("pdb_selmodel.py", ["-1"]), ("pdb_selchain.py", ["-A"]), ("pdb_delocc.py", []),
+         ("pdb_striphet.py", []), ("pdb_rslice.py", ["2:52A", "53:60"]), ("pdb_tidy.py", []),
+         ("pdb_chain.py", ["-1"])],
+        [("selmodel", [1]), ("selchain", ["A"]), ("delocc", []), ("striphet", []),
+         ("rslice", ["2:52A", "53:60"]), ("tidy", []), ("chain", ["1"])]),
+    "keep_hetatm": (ALTLOC,
+        [("pdb_selmodel.py", ["-1"]), ("pdb_selchain.py", ["-B"]), ("pdb_tidy.py", [])],
+        [("selmodel", [1]), ("selchain", ["B"]), ("tidy", [])]),
+    "first_model": (MULTI_MODEL,
+        [("pdb_selmodel.py", ["-1"]), ("pdb_selchain.py", ["-A"]), ("pdb_delocc.py", []),
+         ("pdb_striphet.py", []), ("pdb_tidy.py", [])],
+        [("selmodel", [1]), ("selchain", ["A"]), ("delocc", []), ("striphet", []),
+         ("tidy", [])]),
+    "second_model": (MULTI_MODEL,
+        [("pdb_selmodel.py", ["-2"]), ("pdb_selchain.py", ["-B"]), ("pdb_tidy.py", [])],
+        [("selmodel", [2]), ("selchain", ["B"]), ("tidy", [])]),
+    "clean_pdb2pqr": (ALTLOC,
+        [("pdb_stripheader.py", []), ("pdb_chain.py", ["-A"]), ("pdb_tidy.py", [])],
+        [("stripheader", []), ("chain", ["A"]), ("tidy", [])]),
+    "tidy": (MULTI_MODEL, [("pdb_tidy.py", [])], [("tidy", [])]),
+    "delocc": (ALTLOC, [("pdb_delocc.py", [])], [("delocc", [])]),
+}
+
+def run_scripts(pdb_file, steps):
+    """Output of the scripts piped together, as bytes"""
+    with open(pdb_file, "rb") as f:
+        data = f.read()
+    for script, args in steps:
+        data = subprocess.run([sys.executable, os.path.join(PDB_TOOLS, script)]+args,
+            input=data, stdout=subprocess.PIPE, check=True).stdout
+    return data
+
+def run_pipeline(source, steps):
+    pipe = pipeline(source)
+    for step, args in steps:
+        getattr(pipe, step)(*args)
+    out = io.StringIO()
+    pipe.write(out)
+    return out.getvalue().encode("utf-8")
+
+@pytest.mark.parametrize("case", sorted(CASES.keys()))
+def test_pipeline_matches_scripts(case):
+    pdb_file, script_steps, pipeline_steps = CASES[case]
+    expected = run_scripts(pdb_file, script_steps)
+    assert len(expected) > 0
+    assert run_pipeline(pdb_file, pipeline_steps) == expected
+
+@pytest.mark.parametrize("case", sorted(CASES.keys()))
+def test_pipeline_from_lines(case):
+    pdb_file, script_steps, pipeline_steps = CASES[case]
+    with open(pdb_file) as f:
+        lines = f.readlines()
+    assert run_pipeline(lines, pipeline_steps) == run_scripts(pdb_file, script_steps)
+
+def test_pipeline_write_path(tmp_path):
+    pdb_file, script_steps, pipeline_steps = CASES["extract_domain_rslice"]
+    out_file = str(tmp_path / "domain.pdb")
+    pipe = pipeline(pdb_file)
+    for step, args in pipeline_steps:
+        getattr(pipe, step)(*args)
+    pipe.write(out_file)
+    with open(out_file, "rb") as f:
+        assert f.read() == run_scripts(pdb_file, script_steps)
+
+def test_prep_steps():
+    pipe = pipeline(ALTLOC).selmodel(1).selchain("A").delocc().rslice("2:52A").tidy().chain("1")
+    assert pipe.prep_steps == ["pdb_selmodel.py -1", "pdb_selchain.py -A", "pdb_delocc.py",
+        "pdb_rslice.py 2:52A", "pdb_tidy.py", "pdb_chain.py -1"]